@@ -1,8 +1,10 @@
 import tensorflow as tf
 
 
-def build_MNIST_encoder():
-    model_input = tf.placeholder(tf.float32, (None, 28, 28, 1), name='model_input')
+def build_MNIST_encoder(model_input=None):
+    # A placeholder to feed, unless the images come from an input pipeline
+    if model_input is None:
+        model_input = tf.placeholder(tf.float32, (None, 28, 28, 1), name='model_input')
 
     conv_layer_1 = tf.layers.conv2d(
         model_input, 
@@ -52,7 +54,7 @@ def build_MNIST_encoder():
     return encoder, model_input
 
 
-def build_MNIST_decoder(encoder):
+def build_MNIST_decoder(encoder, model_targets=None):
     upsample_1 = tf.image.resize_nearest_neighbor(encoder, (7, 7))
 
     conv_layer_1 = tf.layers.conv2d(
@@ -91,7 +93,9 @@ def build_MNIST_decoder(encoder):
         activation=None
     )
 
-    model_targets = tf.placeholder(tf.float32, (None, 28, 28, 1), name='model_targets')
+    if model_targets is None:
+        model_targets = tf.placeholder(tf.float32, (None, 28, 28, 1), name='model_targets')
+
     decoder = tf.nn.sigmoid(logits, name='decoder')
     cost_function = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=model_targets, logits=logits))
     optimiser = tf.train.AdamOptimizer().minimize(cost_function)
@@ -99,10 +103,10 @@ def build_MNIST_decoder(encoder):
     return optimiser, cost_function, decoder, model_targets
 
 
-def buil_MNIST_autoencoder():
+def buil_MNIST_autoencoder(model_input=None, model_targets=None):
     
-    encoder, model_input = build_MNIST_encoder()
-    optimiser, cost_function, decoder, model_targets = build_MNIST_decoder(encoder)
+    encoder, model_input = build_MNIST_encoder(model_input)
+    optimiser, cost_function, decoder, model_targets = build_MNIST_decoder(encoder, model_targets)
 
     return dict(
         optimiser=optimiser, 
@@ -0,0 +1,358 @@
+'''
+    Denoising service over a trained MNIST autoencoder.
+
+    The graph is loaded once, from a checkpoint saved by train.py or from a
+    frozen graph made by freeze, and kept in one session. Requests from any
+    number of threads are queued and a single worker thread runs them in
+    micro-batches, up to max_batch_size images or max_latency_ms after the
+    first one, whichever comes first, so that concurrent requests share one
+    call of the decoder.
+
+        with DenoisingService('checkpoints') as service:
+            future = service.submit(noisy_image)
+            denoised = future.result()
+'''
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+import tensorflow as tf
+from collections import deque
+from concurrent.futures import Future
+
+import autoencoder
+
+
+def _load_checkpoint(path):
+    '''
+        A session with the weights of a checkpoint restored, and the tensors
+        of the autoencoder, see buil_MNIST_autoencoder.
+    '''
+    graph = tf.Graph()
+
+    with graph.as_default():
+        MNIST_autoencoder = autoencoder.buil_MNIST_autoencoder()
+        session = tf.Session(graph=graph)
+
+        if path is None:
+            # Untrained weights, only useful for timing the service
+            session.run(tf.global_variables_initializer())
+        else:
+            checkpoint = tf.train.latest_checkpoint(path) if tf.gfile.IsDirectory(path) else path
+            tf.train.Saver().restore(session, checkpoint)
+
+    return session, MNIST_autoencoder
+
+
+def _load_frozen(path):
+    graph = tf.Graph()
+    graph_def = tf.GraphDef()
+
+    with tf.gfile.GFile(path, 'rb') as fh:
+        graph_def.ParseFromString(fh.read())
+
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+
+    return (
+        tf.Session(graph=graph),
+        graph.get_tensor_by_name('model_input:0'),
+        graph.get_tensor_by_name('decoder:0')
+    )
+
+
+def freeze(checkpoint, path):
+    '''
+        Saves the decoder of a checkpoint as a frozen graph, with the weights
+        as constants and without the optimiser.
+    '''
+    session, MNIST_autoencoder = _load_checkpoint(checkpoint)
+    decoder = MNIST_autoencoder['decoder']
+
+    with session:
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            session,
+            session.graph.as_graph_def(),
+            [decoder.op.name]
+        )
+
+    with tf.gfile.GFile(path, 'wb') as fh:
+        fh.write(graph_def.SerializeToString())
+
+
+class DenoisingService():
+    def __init__(self, path=None, max_batch_size=64, max_latency_ms=5.0, window=10000):
+        '''
+            path            - checkpoint directory or prefix saved by train.py,
+                              or a .pb frozen graph saved by freeze. Without
+                              it the weights are random.
+
+            max_batch_size  - largest number of images run in one call.
+
+            max_latency_ms  - longest time the first request of a batch waits
+                              for more requests to join it.
+
+            window          - number of latest requests the latency
+                              percentiles are computed over.
+        '''
+        if path is not None and path.endswith('.pb'):
+            self.__session, self.__input, self.__output = _load_frozen(path)
+        else:
+            self.__session, MNIST_autoencoder = _load_checkpoint(path)
+            self.__input = MNIST_autoencoder['model_input']
+            self.__output = MNIST_autoencoder['decoder']
+
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.
+
+        self.__requests = queue.Queue()
+        self.__lock = threading.Lock()
+        self.__closed = False
+        self.__latencies = deque(maxlen=window)
+        self.__n_requests = 0
+        self.__n_batches = 0
+        self.__busy = 0.0
+        self.__started = time.time()
+
+        self.__worker = threading.Thread(target=self.__serve, daemon=True)
+        self.__worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, image):
+        '''
+            Queues a 28x28 (or 784 or 28x28x1) image with values in [0, 1] and
+            returns a Future of its denoised 28x28x1 image, which can be
+            cancelled until its batch is run. Raises RuntimeError once the
+            service is closed.
+        '''
+        image = np.asarray(image, dtype=np.float32).reshape(28, 28, 1)
+        future = Future()
+
+        # Under the lock, so no request is queued behind the one of close
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError('submit to a closed DenoisingService')
+
+            self.__requests.put((image, future, time.time()))
+
+        return future
+
+    def denoise(self, images):
+        '''
+            Denoises the images, e.g. a batch of them, blocking until done.
+        '''
+        futures = [self.submit(image) for image in images]
+
+        return np.stack([future.result() for future in futures])
+
+    def __next_batch(self):
+        batch = [self.__requests.get()]
+
+        if batch[0] is None:
+            return None
+
+        deadline = time.time() + self.max_latency
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+
+            try:
+                request = self.__requests.get(timeout=timeout) if timeout > 0 else self.__requests.get_nowait()
+            except queue.Empty:
+                break
+
+            if request is None:
+                # Serve what has been collected, then stop
+                self.__requests.put(None)
+                break
+
+            batch.append(request)
+
+        return batch
+
+    def __serve(self):
+        while True:
+            batch = self.__next_batch()
+
+            if batch is None:
+                return
+
+            # Requests cancelled while queued are dropped, the others can no
+            # longer be cancelled and always get a result or an exception
+            batch = [request for request in batch if request[1].set_running_or_notify_cancel()]
+
+            if not batch:
+                continue
+
+            images, futures, submitted = zip(*batch)
+            started = time.time()
+
+            try:
+                output = self.__session.run(self.__output, feed_dict={self.__input: np.stack(images)})
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+
+                continue
+
+            finished = time.time()
+
+            with self.__lock:
+                self.__n_requests += len(batch)
+                self.__n_batches += 1
+                self.__busy += finished - started
+                self.__latencies.extend(finished - t for t in submitted)
+
+            for future, denoised in zip(futures, output):
+                future.set_result(denoised)
+
+    def stats(self):
+        '''
+            Throughput and latency counters since the service started.
+        '''
+        with self.__lock:
+            latencies = 1000 * np.array(self.__latencies)
+            elapsed = time.time() - self.__started
+
+            stats = dict(
+                requests=self.__n_requests,
+                batches=self.__n_batches,
+                mean_batch_size=self.__n_requests / self.__n_batches if self.__n_batches else 0.0,
+                requests_per_second=self.__n_requests / elapsed,
+                utilisation=self.__busy / elapsed,
+                queued=self.__requests.qsize()
+            )
+
+        if len(latencies):
+            stats.update(
+                latency_ms_mean=latencies.mean(),
+                latency_ms_p50=np.percentile(latencies, 50),
+                latency_ms_p99=np.percentile(latencies, 99)
+            )
+
+        return stats
+
+    def close(self):
+        '''
+            Serves the queued requests, then stops the worker and the session.
+        '''
+        with self.__lock:
+            if self.__closed:
+                return
+
+            self.__closed = True
+            self.__requests.put(None)
+
+        self.__worker.join()
+        self.__session.close()
+
+
+def generate_load(service, images, clients=32, requests=2000):
+    '''
+        Closed-loop load: clients threads each submit a request and wait for
+        its result before submitting the next one, requests in total.
+        Returns the requests/s achieved.
+    '''
+    remaining = iter(range(requests))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                i = next(remaining, None)
+
+            if i is None:
+                return
+
+            service.submit(images[i % len(images)]).result()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.time()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return requests / (time.time() - started)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument(
+        '-m',
+        '--model',
+        help='path to a checkpoint (directory) or a .pb frozen graph, random weights if missing'
+    )
+
+    ap.add_argument(
+        '-f',
+        '--freeze',
+        help='path to save the model as a frozen graph to, instead of benchmarking'
+    )
+
+    ap.add_argument(
+        '-b',
+        '--max_batch_size',
+        type=int,
+        nargs='+',
+        default=[1, 16, 64],
+        help='largest batch sizes to benchmark, 1 is no batching'
+    )
+
+    ap.add_argument(
+        '-t',
+        '--max_latency_ms',
+        type=float,
+        default=5.0,
+        help='longest time a request waits for a batch to fill'
+    )
+
+    ap.add_argument(
+        '-c',
+        '--clients',
+        type=int,
+        default=32,
+        help='number of concurrent clients of the load generator'
+    )
+
+    ap.add_argument(
+        '-n',
+        '--requests',
+        type=int,
+        default=2000,
+        help='number of requests of the load generator'
+    )
+
+    args = ap.parse_args()
+
+    if args.freeze:
+        freeze(args.model, args.freeze)
+        raise SystemExit
+
+    images = np.random.RandomState(7).rand(256, 28, 28).astype(np.float32)
+
+    print('{:>10}{:>12}{:>12}{:>12}{:>12}'.format('batch', 'requests/s', 'mean batch', 'p50 ms', 'p99 ms'))
+
+    for max_batch_size in args.max_batch_size:
+        with DenoisingService(args.model, max_batch_size, args.max_latency_ms) as service:
+            # The first run of the graph is slow
+            service.denoise(images[:1])
+            throughput = generate_load(service, images, args.clients, args.requests)
+            stats = service.stats()
+
+        print('{:>10}{:>12.0f}{:>12.1f}{:>12.2f}{:>12.2f}'.format(
+            max_batch_size,
+            throughput,
+            stats['mean_batch_size'],
+            stats['latency_ms_p50'],
+            stats['latency_ms_p99']
+        ))
@@ -0,0 +1,634 @@
+'''
+    Store of the 4x4x16 bottleneck codes of the autoencoder and a nearest
+    neighbour index over them.
+
+    The codes are written batch by batch to memory-mapped .npy files, as
+    float16 or as uint8 quantised per code, 512 or 256 bytes per image. The
+    index scans them chunk by chunk with one matrix product per chunk, so a
+    million codes are searched without ever being loaded into memory whole.
+
+        write_codes('latents', batches_of_codes, n_images, dtype='uint8')
+        index = LatentIndex('latents')
+        neighbours, distances = index.query(query_codes, k=10)
+'''
+import os
+import json
+import time
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+DTYPES = ['float16', 'uint8']
+
+
+def _quantise(codes):
+    '''
+        uint8 codes with the offset and scale of every row.
+    '''
+    lows = codes.min(axis=1)
+    scales = (codes.max(axis=1) - lows) / 255.
+    scales[scales == 0] = 1.
+
+    quantised = np.rint((codes - lows[:, None]) / scales[:, None]).astype(np.uint8)
+
+    return quantised, lows, scales
+
+
+def write_codes(path, batches, n, dtype='float16'):
+    '''
+        Writes n codes, given in batches of any shape (batch, ...), to the
+        directory path and returns a LatentIndex over them.
+    '''
+    if dtype not in DTYPES:
+        raise ValueError('dtype must be one of {}'.format(DTYPES))
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    codes, lows, scales, norms = None, None, None, None
+    start = 0
+
+    for batch in batches:
+        batch = np.asarray(batch, dtype=np.float32).reshape(len(batch), -1)
+
+        if start + len(batch) > n:
+            raise ValueError('got more than {} codes'.format(n))
+
+        if codes is None:
+            codes = open_memmap(os.path.join(path, 'codes.npy'), 'w+', dtype, (n, batch.shape[1]))
+            norms = open_memmap(os.path.join(path, 'norms.npy'), 'w+', np.float32, (n,))
+
+            if dtype == 'uint8':
+                lows = open_memmap(os.path.join(path, 'lows.npy'), 'w+', np.float32, (n,))
+                scales = open_memmap(os.path.join(path, 'scales.npy'), 'w+', np.float32, (n,))
+
+        stop = start + len(batch)
+
+        if dtype == 'uint8':
+            codes[start:stop], lows[start:stop], scales[start:stop] = _quantise(batch)
+            stored = codes[start:stop] * scales[start:stop, None] + lows[start:stop, None]
+        else:
+            codes[start:stop] = batch
+            stored = codes[start:stop].astype(np.float32)
+
+        # Norms of the codes as stored, so that the distances are consistent
+        norms[start:stop] = np.sqrt(np.einsum('ij,ij->i', stored, stored))
+        start = stop
+
+    if start != n:
+        raise ValueError('got {} codes, expected {}'.format(start, n))
+
+    for array in [codes, lows, scales, norms]:
+        if array is not None:
+            array.flush()
+
+    with open(os.path.join(path, 'meta.json'), 'w') as fh:
+        json.dump(dict(dtype=dtype, n=n, dim=codes.shape[1]), fh)
+
+    return LatentIndex(path)
+
+
+def _kmeans(codes, n_lists, n_iter, rng, chunk_size=8192):
+    '''
+        Lloyd's k-means of codes, with the centroids started from random codes.
+    '''
+    centroids = codes[rng.choice(len(codes), n_lists, replace=False)]
+
+    for _ in range(n_iter):
+        labels = _nearest_centroids(codes, centroids, chunk_size)
+        order = np.argsort(labels, kind='stable')
+        counts = np.bincount(labels, minlength=n_lists)
+        starts = np.r_[0, np.cumsum(counts)[:-1]]
+
+        filled = counts > 0
+
+        # Only the lists with codes, every one of their sums then ends where
+        # the next one starts. Empty lists keep their centroid
+        sums = np.add.reduceat(codes[order], starts[filled], axis=0)
+        centroids[filled] = sums / counts[filled, None]
+
+    return centroids
+
+
+def _take(a, indices):
+    # np.take_along_axis(a, indices, axis=1), which needs numpy 1.15
+    return a[np.arange(len(a))[:, None], indices]
+
+
+def _nearest_centroids(codes, centroids, chunk_size=8192):
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+
+    return np.concatenate([
+        np.argmin(centroid_norms - 2 * codes[start:start + chunk_size] @ centroids.T, axis=1)
+        for start in range(0, len(codes), chunk_size)
+    ])
+
+
+class LatentIndex():
+    def __init__(self, path, chunk_size=32768, n_probe=8):
+        '''
+            path        - directory written by write_codes.
+
+            chunk_size  - number of codes compared with the queries at a time.
+
+            n_probe     - number of inverted lists searched per query, once
+                          the lists are built with build_lists.
+        '''
+        self.path = path
+        self.chunk_size = chunk_size
+        self.n_probe = n_probe
+        self.__load()
+
+    def __load(self):
+        with open(os.path.join(self.path, 'meta.json')) as fh:
+            self.meta = json.load(fh)
+
+        self.codes = np.load(os.path.join(self.path, 'codes.npy'), mmap_mode='r')
+        self.norms = np.load(os.path.join(self.path, 'norms.npy'), mmap_mode='r')
+
+        if self.meta['dtype'] == 'uint8':
+            self.lows = np.load(os.path.join(self.path, 'lows.npy'), mmap_mode='r')
+            self.scales = np.load(os.path.join(self.path, 'scales.npy'), mmap_mode='r')
+
+        # The codes are stored list by list once the lists are built
+        self.centroids, self.offsets, self.ids = None, None, None
+
+        if os.path.exists(os.path.join(self.path, 'lists.npz')):
+            with np.load(os.path.join(self.path, 'lists.npz')) as lists:
+                self.centroids, self.offsets = lists['centroids'], lists['offsets']
+
+            self.ids = np.load(os.path.join(self.path, 'ids.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.codes)
+
+    def decode(self, start=0, stop=None):
+        '''
+            float32 codes of stored rows start to stop.
+        '''
+        codes = np.asarray(self.codes[start:stop], dtype=np.float32)
+
+        if self.meta['dtype'] == 'uint8':
+            codes *= self.scales[start:stop, None]
+            codes += self.lows[start:stop, None]
+
+        return codes
+
+    def __distances(self, queries, query_norms, start, stop, metric):
+        # For uint8 codes the offsets and the scales are applied to the dot
+        # products rather than to the codes, a whole pass over them cheaper
+        dots = queries @ np.asarray(self.codes[start:stop], dtype=np.float32).T
+
+        if self.meta['dtype'] == 'uint8':
+            dots *= self.scales[start:stop]
+            dots += np.outer(queries.sum(axis=1), self.lows[start:stop])
+
+        norms = self.norms[start:stop]
+
+        if metric == 'l2':
+            dots *= -2
+            dots += query_norms[:, None] ** 2 + norms ** 2
+
+            return np.maximum(dots, 0, out=dots)
+
+        dots /= np.maximum(query_norms[:, None] * norms, 1e-12)
+
+        return np.subtract(1, dots, out=dots)
+
+    def __scan(self, queries, query_norms, ranges, k, metric):
+        '''
+            The k nearest stored rows of every query among the rows of ranges,
+            a list of (start, stop) pairs.
+        '''
+        best_distances = np.zeros((len(queries), 0), dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+
+        for start, stop in ranges:
+            for chunk_start in range(start, stop, self.chunk_size):
+                chunk_stop = min(chunk_start + self.chunk_size, stop)
+
+                best_distances = np.concatenate([
+                    best_distances,
+                    self.__distances(queries, query_norms, chunk_start, chunk_stop, metric)
+                ], axis=1)
+                best_rows = np.concatenate([
+                    best_rows,
+                    np.broadcast_to(np.arange(chunk_start, chunk_stop), (len(queries), chunk_stop - chunk_start))
+                ], axis=1)
+
+                # Only the k nearest so far are kept
+                if best_distances.shape[1] > k:
+                    nearest = np.argpartition(best_distances, k - 1, axis=1)[:, :k]
+                    best_distances = _take(best_distances, nearest)
+                    best_rows = _take(best_rows, nearest)
+
+        return best_rows, best_distances
+
+    def __probe(self, queries, query_norms, probes, k, metric):
+        '''
+            The k nearest stored rows of every query among the rows of the
+            lists it probes, probes being (queries, n_probe) list numbers.
+            Every probed list is read once and compared with all of the
+            queries probing it in one product.
+        '''
+        rows = np.zeros((len(queries), k), dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+
+        # The queries probing every list
+        flat = probes.ravel()
+        order = np.argsort(flat, kind='stable')
+        lists, starts = np.unique(flat[order], return_index=True)
+
+        for j, probing in zip(lists, np.split(order // probes.shape[1], starts[1:])):
+            found_rows, found_distances = self.__scan(
+                queries[probing],
+                query_norms[probing],
+                [(self.offsets[j], self.offsets[j + 1])],
+                k,
+                metric
+            )
+
+            merged_rows = np.concatenate([rows[probing], found_rows], axis=1)
+            merged_distances = np.concatenate([distances[probing], found_distances], axis=1)
+            nearest = np.argpartition(merged_distances, k - 1, axis=1)[:, :k]
+
+            rows[probing] = _take(merged_rows, nearest)
+            distances[probing] = _take(merged_distances, nearest)
+
+        return rows, distances
+
+    def query(self, queries, k=10, metric='l2', exact=False):
+        '''
+            The k nearest codes of every query, by Euclidean ('l2') or cosine
+            ('cosine') distance. Returns their indices and distances, both of
+            shape (queries, k) and nearest first.
+
+            Once build_lists has been run only the n_probe lists nearest to a
+            query are searched, unless exact is True.
+        '''
+        if metric not in ['l2', 'cosine']:
+            raise ValueError("metric must be 'l2' or 'cosine'")
+
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.meta['dim'])
+        query_norms = np.sqrt(np.einsum('ij,ij->i', queries, queries))
+        k = min(k, len(self))
+
+        if self.centroids is None or exact:
+            rows, distances = self.__scan(queries, query_norms, [(0, len(self))], k, metric)
+        else:
+            probes = np.argsort(
+                np.einsum('ij,ij->i', self.centroids, self.centroids) - 2 * queries @ self.centroids.T,
+                axis=1
+            )[:, :self.n_probe]
+
+            rows, distances = self.__probe(queries, query_norms, probes, k, metric)
+
+        order = np.argsort(distances, axis=1)
+        rows = _take(rows, order)
+        distances = _take(distances, order)
+
+        if metric == 'l2':
+            distances = np.sqrt(distances)
+
+        if self.ids is not None:
+            rows = np.where(np.isfinite(distances), self.ids[rows], -1)
+
+        return rows, distances
+
+    def build_lists(self, n_lists=256, n_iter=10, sample_size=65536, random_state=7):
+        '''
+            Clusters the codes into n_lists inverted lists with k-means over a
+            sample of them and rewrites the store list by list, so that the
+            rows of a list are contiguous on disk. Queries then only search
+            the n_probe lists nearest to them.
+        '''
+        rng = np.random.RandomState(random_state)
+        sample = np.sort(rng.choice(len(self), min(sample_size, len(self)), replace=False))
+
+        sample_codes = np.asarray(self.codes[sample], dtype=np.float32)
+
+        if self.meta['dtype'] == 'uint8':
+            sample_codes *= self.scales[sample, None]
+            sample_codes += self.lows[sample, None]
+
+        centroids = _kmeans(sample_codes, min(n_lists, len(self)), n_iter, rng)
+
+        labels = np.concatenate([
+            _nearest_centroids(self.decode(start, start + self.chunk_size), centroids)
+            for start in range(0, len(self), self.chunk_size)
+        ])
+
+        # Rows of the current store, list by list
+        order = np.argsort(labels, kind='stable')
+        ids = order if self.ids is None else np.asarray(self.ids)[order]
+        offsets = np.r_[0, np.cumsum(np.bincount(labels, minlength=len(centroids)))]
+
+        names = ['codes', 'norms'] + (['lows', 'scales'] if self.meta['dtype'] == 'uint8' else [])
+
+        for name in names:
+            array = getattr(self, name)
+            reordered = open_memmap(os.path.join(self.path, name + '.part.npy'), 'w+', array.dtype, array.shape)
+
+            for start in range(0, len(self), self.chunk_size):
+                reordered[start:start + self.chunk_size] = array[order[start:start + self.chunk_size]]
+
+            reordered.flush()
+            del reordered
+
+        np.save(os.path.join(self.path, 'ids.part.npy'), ids)
+
+        self.codes, self.norms = None, None
+
+        for name in names + ['ids']:
+            os.replace(
+                os.path.join(self.path, name + '.part.npy'),
+                os.path.join(self.path, name + '.npy')
+            )
+
+        np.savez(os.path.join(self.path, 'lists.npz'), centroids=centroids, offsets=offsets)
+        self.__load()
+
+
+def iter_codes(images, checkpoint, batch_size=1024):
+    '''
+        Yields the codes of batch_size images at a time, encoded with the
+        encoder of a checkpoint saved by train.py. The images are an array of
+        28x28 (or 784) images with values in [0, 1].
+    '''
+    # TensorFlow takes a while to import, the index itself does not need it
+    from inference import _load_checkpoint
+
+    session, MNIST_autoencoder = _load_checkpoint(checkpoint)
+
+    with session:
+        for start in range(0, len(images), batch_size):
+            batch = np.asarray(images[start:start + batch_size], dtype=np.float32)
+
+            yield session.run(
+                MNIST_autoencoder['encoder'],
+                feed_dict={MNIST_autoencoder['model_input']: batch.reshape(-1, 28, 28, 1)}
+            ).reshape(len(batch), -1)
+
+
+def encode_images(images, path, checkpoint, batch_size=1024, dtype='float16'):
+    '''
+        Writes the codes of the images to path, see iter_codes, and returns a
+        LatentIndex over them.
+    '''
+    return write_codes(path, iter_codes(images, checkpoint, batch_size), len(images), dtype)
+
+
+def benchmark(path, n, dtype, k, n_queries, n_lists, n_probe, batch_size=65536):
+    '''
+        Times writing and querying n random codes, sparse like the ReLU codes
+        of the encoder and clustered like the codes of similar images, with
+        an exact scan and with inverted lists.
+    '''
+    rng = np.random.RandomState(7)
+    centers = np.maximum(rng.randn(1000, 256), 0).astype(np.float32)
+
+    def batches():
+        for start in range(0, n, batch_size):
+            size = min(batch_size, n - start)
+            codes = centers[rng.randint(len(centers), size=size)] + 0.3 * rng.randn(size, 256)
+
+            yield np.maximum(codes, 0)
+
+    started = time.time()
+    index = write_codes(path, batches(), n, dtype)
+    print('Wrote {} {} codes in {:.1f}s, {:.0f} MB'.format(
+        n,
+        dtype,
+        time.time() - started,
+        sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)) / 2 ** 20
+    ))
+
+    queries = index.decode(0, n_queries) + 0.1 * rng.randn(n_queries, 256).astype(np.float32)
+
+    def timed_queries(name, exact):
+        for size in [1, n_queries]:
+            index.query(queries[:size], k, exact=exact)
+
+            started = time.time()
+            neighbours, _ = index.query(queries[:size], k, exact=exact)
+            elapsed = time.time() - started
+
+            print('{:<14}{:>8}{:>12.1f}{:>12.2f}'.format(name, size, 1000 * elapsed, 1000 * elapsed / size))
+
+        return neighbours
+
+    print('\n{:<14}{:>8}{:>12}{:>12}'.format('', 'queries', 'ms', 'ms/query'))
+    exact = timed_queries('exact', True)
+
+    if not n_lists:
+        return
+
+    started = time.time()
+    index.build_lists(n_lists)
+    index.n_probe = n_probe
+    elapsed = time.time() - started
+
+    probed = timed_queries('{} lists'.format(n_lists), False)
+
+    print('\nBuilt {} lists in {:.1f}s, recall@{} with {} probes: {:.1f}%'.format(
+        n_lists,
+        elapsed,
+        k,
+        n_probe,
+        100 * np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(exact, probed)])
+    ))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    subparsers = ap.add_subparsers(dest='command')
+    subparsers.required = True
+
+    build_parser = subparsers.add_parser(
+        'build',
+        help='encode the MNIST training images into a latent store'
+    )
+
+    build_parser.add_argument(
+        '-o',
+        '--output',
+        required=True,
+        help='path to the latent store directory'
+    )
+
+    build_parser.add_argument(
+        '-t',
+        '--dtype',
+        choices=DTYPES,
+        default='float16',
+        help='how the codes are stored'
+    )
+
+    build_parser.add_argument(
+        '-b',
+        '--batch_size',
+        type=int,
+        default=1024,
+        help='number of images encoded at a time'
+    )
+
+    query_parser = subparsers.add_parser(
+        'query',
+        help='find the nearest stored images of MNIST test images'
+    )
+
+    query_parser.add_argument(
+        '-i',
+        '--index',
+        required=True,
+        help='path to the latent store directory'
+    )
+
+    query_parser.add_argument(
+        '-n',
+        '--num_queries',
+        type=int,
+        default=10,
+        help='number of test images to query'
+    )
+
+    query_parser.add_argument(
+        '-k',
+        type=int,
+        default=10,
+        help='number of neighbours per query'
+    )
+
+    query_parser.add_argument(
+        '-p',
+        '--n_probe',
+        type=int,
+        default=8,
+        help='number of inverted lists searched per query'
+    )
+
+    query_parser.add_argument(
+        '--metric',
+        choices=['l2', 'cosine'],
+        default='l2',
+        help='distance between the codes'
+    )
+
+    for parser in [build_parser, query_parser]:
+        parser.add_argument(
+            '-m',
+            '--model',
+            required=True,
+            help='path to a checkpoint (directory) saved by train.py'
+        )
+
+        parser.add_argument(
+            '-d',
+            '--data_dir',
+            default='MNIST_data',
+            help='path to the MNIST data, downloaded if missing'
+        )
+
+    benchmark_parser = subparsers.add_parser(
+        'benchmark',
+        help='time writing and querying random codes'
+    )
+
+    benchmark_parser.add_argument(
+        '-o',
+        '--output',
+        required=True,
+        help='path to the latent store directory'
+    )
+
+    benchmark_parser.add_argument(
+        '-n',
+        '--num_codes',
+        type=int,
+        default=1000000,
+        help='number of codes'
+    )
+
+    benchmark_parser.add_argument(
+        '-t',
+        '--dtype',
+        choices=DTYPES,
+        default='uint8',
+        help='how the codes are stored'
+    )
+
+    benchmark_parser.add_argument(
+        '-k',
+        type=int,
+        default=10,
+        help='number of neighbours per query'
+    )
+
+    benchmark_parser.add_argument(
+        '-q',
+        '--num_queries',
+        type=int,
+        default=64,
+        help='number of queries in a batch'
+    )
+
+    benchmark_parser.add_argument(
+        '-p',
+        '--n_probe',
+        type=int,
+        default=8,
+        help='number of inverted lists searched per query'
+    )
+
+    for parser in [build_parser, benchmark_parser]:
+        parser.add_argument(
+            '-l',
+            '--n_lists',
+            type=int,
+            default=256,
+            help='number of inverted lists, 0 for exact search only'
+        )
+
+    args = ap.parse_args()
+
+    if args.command == 'benchmark':
+        benchmark(
+            args.output,
+            args.num_codes,
+            args.dtype,
+            args.k,
+            args.num_queries,
+            args.n_lists,
+            args.n_probe
+        )
+        raise SystemExit
+
+    from tensorflow.examples.tutorials.mnist import input_data
+
+    MNIST_data = input_data.read_data_sets(args.data_dir, validation_size=0)
+
+    if args.command == 'build':
+        index = encode_images(MNIST_data.train.images, args.output, args.model, args.batch_size, args.dtype)
+
+        if args.n_lists:
+            index.build_lists(args.n_lists)
+
+        raise SystemExit
+
+    queries = np.concatenate(list(iter_codes(MNIST_data.test.images[:args.num_queries], args.model)))
+
+    started = time.time()
+    neighbours, distances = LatentIndex(args.index, n_probe=args.n_probe).query(queries, args.k, args.metric)
+
+    print('{} queries in {:.1f} ms'.format(len(queries), 1000 * (time.time() - started)))
+
+    for i, (row, distance) in enumerate(zip(neighbours, distances)):
+        print('Test image {} ({}): {}'.format(
+            i,
+            MNIST_data.test.labels[i],
+            ', '.join(
+                '{} ({}, {:.3f})'.format(j, MNIST_data.train.labels[j], d)
+                for j, d in zip(row, distance)
+            )
+        ))
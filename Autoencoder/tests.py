@@ -0,0 +1,104 @@
+'''
+    Tests of the autoencoder tools. The ones that build the TensorFlow graph
+    are skipped where TensorFlow is not installed.
+
+        python -m unittest tests
+'''
+import tempfile
+import importlib.util
+import numpy as np
+from unittest import TestCase, main, skipUnless
+
+from latent_index import _kmeans, write_codes
+
+
+HAS_TENSORFLOW = importlib.util.find_spec('tensorflow') is not None
+
+
+def codes(n, rng):
+    centers = np.maximum(rng.randn(20, 256), 0)
+
+    return np.maximum(centers[rng.randint(20, size=n)] + 0.3 * rng.randn(n, 256), 0).astype(np.float32)
+
+
+class Test(TestCase):
+    def test_kmeans_empty_lists(self):
+        points = np.array([[0.], [0.], [10.], [10.], [12.], [100.]], dtype=np.float32)
+
+        class Choice():
+            # Starts the centroids from the given rows
+            def choice(self, n, size, replace):
+                return [0, 2, 1, 3]
+
+        # The last two centroids repeat the first two, their lists are left
+        # empty and keep them
+        centroids = _kmeans(points, 4, 1, Choice())
+
+        np.testing.assert_allclose(centroids.ravel(), [0., 33., 0., 10.])
+
+
+    def test_latent_index(self):
+        rng = np.random.RandomState(7)
+        stored, queries = codes(3000, rng), codes(50, rng)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index = write_codes(tmp_dir, np.array_split(stored, 4), len(stored), dtype='float16')
+            index.chunk_size = 1000
+
+            # The exact scan against all the distances at once
+            decoded = index.decode()
+            distances = np.sqrt(((queries[:, None] - decoded[None]) ** 2).sum(axis=2))
+            neighbours, found = index.query(queries, k=5, exact=True)
+
+            np.testing.assert_allclose(found, np.sort(distances, axis=1)[:, :5], rtol=1e-3, atol=1e-2)
+            np.testing.assert_allclose(distances[np.arange(50)[:, None], neighbours], found, rtol=1e-3, atol=1e-2)
+
+            # Every query of a batch probes the lists it would probe alone
+            index.build_lists(n_lists=16, sample_size=2000)
+            neighbours, found = index.query(queries, k=5)
+
+            for i in range(len(queries)):
+                alone = index.query(queries[i], k=5)
+
+                self.assertEqual(neighbours[i].tolist(), alone[0][0].tolist())
+                np.testing.assert_allclose(found[i], alone[1][0], rtol=1e-5)
+
+            # Every probed neighbour is a stored code that far away
+            np.testing.assert_allclose(distances[np.arange(50)[:, None], neighbours], found, rtol=1e-3, atol=1e-2)
+
+            index.n_probe = 16
+            self.assertEqual(index.query(queries, k=5)[0].tolist(), index.query(queries, k=5, exact=True)[0].tolist())
+
+
+    @skipUnless(HAS_TENSORFLOW, 'needs TensorFlow')
+    def test_denoising_service_close(self):
+        from inference import DenoisingService
+
+        service = DenoisingService(max_batch_size=4)
+        future = service.submit(np.zeros((28, 28)))
+        service.close()
+
+        # Queued requests are served, later ones refused rather than lost
+        self.assertEqual(future.result(timeout=60).shape, (28, 28, 1))
+        self.assertRaises(RuntimeError, service.submit, np.zeros((28, 28)))
+
+        service.close()
+
+
+    @skipUnless(HAS_TENSORFLOW, 'needs TensorFlow')
+    def test_denoising_service_cancel(self):
+        from inference import DenoisingService
+
+        # The batch waits long enough for the requests to be cancelled first
+        with DenoisingService(max_batch_size=4, max_latency_ms=500) as service:
+            futures = [service.submit(np.zeros((28, 28))) for _ in range(3)]
+
+            self.assertTrue(all(future.cancel() for future in futures))
+
+            # The worker skipped them rather than dying on them
+            self.assertEqual(service.submit(np.zeros((28, 28))).result(timeout=60).shape, (28, 28, 1))
+            self.assertEqual(service.stats()['requests'], 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+'''
+    Trains the denoising MNIST autoencoder from a tf.data input pipeline.
+
+    The images are fed to the graph once, when the pipeline is initialised,
+    and the pipeline shuffles them, batches them, adds the noise and
+    prefetches the next batches while the current one is being trained on.
+    No NumPy batches are copied into the graph through feed_dict each step.
+'''
+import os
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from multiprocessing import cpu_count
+from tensorflow.examples.tutorials.mnist import input_data
+
+import autoencoder
+
+
+def add_noise(images, noise_strength):
+    '''
+        Noisy inputs and clean targets of a batch of flattened images.
+    '''
+    targets = tf.reshape(images, (-1, 28, 28, 1))
+    noisy = targets + noise_strength * tf.random_normal(tf.shape(targets))
+
+    return tf.clip_by_value(noisy, 0., 1.), targets
+
+
+def make_dataset(
+    images,
+    batch_size=256,
+    noise_strength=0.5,
+    shuffle_buffer=10000,
+    num_parallel_calls=4,
+    prefetch=2,
+    repeat=True
+):
+    '''
+        (noisy, targets) batches of the images, a tensor, e.g. a placeholder
+        that is fed once when the iterator is initialised.
+
+        The noise is added to whole batches, one vectorised op per batch
+        rather than per image, and prefetch batches are kept ready ahead of
+        the training step.
+    '''
+    dataset = tf.data.Dataset.from_tensor_slices(images)
+
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer)
+
+    if repeat:
+        dataset = dataset.repeat()
+
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(
+        lambda batch: add_noise(batch, noise_strength),
+        num_parallel_calls=num_parallel_calls
+    )
+
+    return dataset.prefetch(prefetch)
+
+
+def time_input(session, next_batch, steps):
+    '''
+        Examples/s of the input pipeline on its own, an upper bound of the
+        training throughput.
+    '''
+    session.run(next_batch)
+
+    started = time.time()
+    examples = sum(len(session.run(next_batch)[0]) for _ in range(steps))
+
+    return examples / (time.time() - started)
+
+
+def train(
+    train_images,
+    test_images,
+    epochs=10,
+    batch_size=256,
+    noise_strength=0.5,
+    shuffle_buffer=10000,
+    num_parallel_calls=4,
+    prefetch=2,
+    checkpoint_dir='checkpoints',
+    log_every=50
+):
+    '''
+        Trains the autoencoder and saves a checkpoint of it to checkpoint_dir
+        after every epoch. Returns the test loss of every epoch.
+    '''
+    tf.reset_default_graph()
+
+    # Fed once per initialisation, large arrays are not embedded in the graph
+    images = tf.placeholder(tf.float32, (None, 784), name='images')
+
+    train_dataset = make_dataset(
+        images,
+        batch_size,
+        noise_strength,
+        shuffle_buffer,
+        num_parallel_calls,
+        prefetch
+    )
+    test_dataset = make_dataset(
+        images,
+        batch_size,
+        noise_strength,
+        shuffle_buffer=0,
+        num_parallel_calls=num_parallel_calls,
+        prefetch=prefetch,
+        repeat=False
+    )
+
+    iterator = tf.data.Iterator.from_structure(
+        train_dataset.output_types,
+        train_dataset.output_shapes
+    )
+    model_input, model_targets = iterator.get_next()
+
+    MNIST_autoencoder = autoencoder.buil_MNIST_autoencoder(model_input, model_targets)
+    saver = tf.train.Saver()
+
+    steps_per_epoch = len(train_images) // batch_size
+    test_losses = []
+
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    with tf.Session() as session:
+        session.run(tf.global_variables_initializer())
+        session.run(iterator.make_initializer(train_dataset), feed_dict={images: train_images})
+
+        print('Input pipeline: {:.0f} examples/s'.format(
+            time_input(session, (model_input, model_targets), min(steps_per_epoch, 50))
+        ))
+
+        for epoch in range(epochs):
+            started = time.time()
+            step_times = []
+
+            for step in range(steps_per_epoch):
+                step_started = time.time()
+
+                loss, _ = session.run([
+                    MNIST_autoencoder['cost_function'],
+                    MNIST_autoencoder['optimiser']
+                ])
+
+                step_times.append(time.time() - step_started)
+
+                if log_every and (step + 1) % log_every == 0:
+                    print('Epoch {} step {}/{}: loss {:.4f}, {:.1f} ms/step, {:.0f} examples/s'.format(
+                        epoch + 1,
+                        step + 1,
+                        steps_per_epoch,
+                        loss,
+                        1000 * np.mean(step_times[-log_every:]),
+                        batch_size / np.mean(step_times[-log_every:])
+                    ))
+
+            elapsed = time.time() - started
+
+            # Only the cost on the test images, they are never trained on
+            session.run(iterator.make_initializer(test_dataset), feed_dict={images: test_images})
+            losses = []
+
+            try:
+                while True:
+                    losses.append(session.run(MNIST_autoencoder['cost_function']))
+            except tf.errors.OutOfRangeError:
+                pass
+
+            test_losses.append(np.mean(losses))
+            path = saver.save(session, os.path.join(checkpoint_dir, 'autoencoder'), global_step=epoch + 1)
+
+            print('Epoch {}/{}: {:.1f}s, {:.1f} ms/step (median), {:.0f} examples/s, test loss {:.4f}, saved {}'.format(
+                epoch + 1,
+                epochs,
+                elapsed,
+                1000 * np.median(step_times),
+                steps_per_epoch * batch_size / elapsed,
+                test_losses[-1],
+                path
+            ))
+
+            session.run(iterator.make_initializer(train_dataset), feed_dict={images: train_images})
+
+    return test_losses
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument(
+        '-d',
+        '--data_dir',
+        default='MNIST_data',
+        help='path to the MNIST data, downloaded if missing'
+    )
+
+    ap.add_argument(
+        '-e',
+        '--epochs',
+        type=int,
+        default=10,
+        help='number of passes over the training images'
+    )
+
+    ap.add_argument(
+        '-b',
+        '--batch_size',
+        type=int,
+        default=256,
+        help='number of images per training step'
+    )
+
+    ap.add_argument(
+        '-n',
+        '--noise_strength',
+        type=float,
+        default=0.5,
+        help='standard deviation of the noise added to the inputs'
+    )
+
+    ap.add_argument(
+        '-s',
+        '--shuffle_buffer',
+        type=int,
+        default=10000,
+        help='number of images shuffled at a time, 0 for no shuffling'
+    )
+
+    ap.add_argument(
+        '-j',
+        '--num_parallel_calls',
+        type=int,
+        default=cpu_count(),
+        help='number of batches the noise is added to in parallel'
+    )
+
+    ap.add_argument(
+        '-p',
+        '--prefetch',
+        type=int,
+        default=2,
+        help='number of batches prepared ahead of the training step'
+    )
+
+    ap.add_argument(
+        '-c',
+        '--checkpoint_dir',
+        default='checkpoints',
+        help='path to save the checkpoints to'
+    )
+
+    args = ap.parse_args()
+
+    MNIST_data = input_data.read_data_sets(args.data_dir, validation_size=0)
+
+    train(
+        MNIST_data.train.images,
+        MNIST_data.test.images,
+        epochs=args.epochs,
+        batch_size=args.batch_size,
+        noise_strength=args.noise_strength,
+        shuffle_buffer=args.shuffle_buffer,
+        num_parallel_calls=args.num_parallel_calls,
+        prefetch=args.prefetch,
+        checkpoint_dir=args.checkpoint_dir
+    )
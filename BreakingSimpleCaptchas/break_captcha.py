@@ -1,50 +1,80 @@
-import cv2
-import imutils
+import os
+import csv
+import json
+import time
 import argparse
 import numpy as np
-from imutils import contours
-from keras.models import load_model
-from preprocess_images import preprocess
-from keras.preprocessing.image import img_to_array
+from glob import glob
+from multiprocessing import Pool
 
+import numpy_runtime
+
+
+def segment(imgpath):
+    '''
+        Reads a captcha and splits it into digits. Returns the padded gray
+        image, the (N, 4) bounding rectangles of the digits from left to right
+        and an (N, 28, 28, 1) float32 array of the digits scaled to [0, 1],
+        ready for the model.
+    '''
+    # Here rather than at the top, so that -h does not wait for OpenCV and
+    # imutils. Only the first call of every process pays for them
+    import cv2
+    from preprocess_images import preprocess_rois
 
-def break_captcha(imgpath, model):
     img = cv2.imread(imgpath)
-    
+
+    if img is None:
+        raise IOError('Could not read image "%s"' % imgpath)
+
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     gray = cv2.copyMakeBorder(
         gray,
         20, 20, 20, 20,
         cv2.BORDER_REPLICATE
     )
-    
+
     # Binarise image to reveal digits
     threshold = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
-    
+
     # Find the 4 largest contours
     contours = cv2.findContours(threshold.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = contours[0] if imutils.is_cv2() else contours[1]
+    # Second to last of what OpenCV 2, 3 and 4 return alike
+    contours = contours[-2]
     contours = sorted(contours, key=cv2.contourArea, reverse=True)[:4]
 
+    # Read the digits from left to right
+    rectangles = sorted(cv2.boundingRect(contour) for contour in contours)
+    rectangles = np.array(rectangles, dtype=np.int32).reshape(-1, 4)
+
+    rois = preprocess_rois(gray, rectangles, 28, 28, padding=5)
+
+    return gray, rectangles, rois
+
+
+def _segment_digits(imgpath):
+    # Only the digits are sent back from the worker processes
+    try:
+        return imgpath, segment(imgpath)[2], None
+    except Exception as e:
+        return imgpath, None, str(e)
+
+
+def break_captcha(imgpath, model):
+    import cv2
+
+    gray, rectangles, rois = segment(imgpath)
+
     output = cv2.merge([gray] * 3)
     predictions = []
 
-    # Predict digit for each contour
-    for contour in contours:
-        x, y, w, h = cv2.boundingRect(contour)
-        
-        roi = gray[
-            (y-5):(y + h + 5),
-            (x - 5):(x + w + 5)
-        ]
-        roi = preprocess(roi, 28, 28)
-        roi = np.expand_dims(img_to_array(roi), axis=0) / 255.0
-        
-        prediction = model.predict(roi).argmax(axis=1)[0] + 1
-        predictions.append(str(prediction))
+    # Predict all the digits in one go
+    if len(rois):
+        predictions = [str(p) for p in model.predict(rois).argmax(axis=1) + 1]
 
+    for (x, y, w, h), prediction in zip(rectangles, predictions):
         cv2.rectangle(
-            output, 
+            output,
             (x - 2, y - 2),
             (x + w + 4, y + h + 4),
             (0, 255, 0),
@@ -53,7 +83,7 @@ def break_captcha(imgpath, model):
 
         cv2.putText(
             output,
-            str(prediction),
+            prediction,
             (x - 5, y - 5),
             cv2.FONT_HERSHEY_SCRIPT_SIMPLEX,
             0.55,
@@ -64,35 +94,157 @@ def break_captcha(imgpath, model):
     return output, predictions
 
 
+def break_captchas(imgpaths, model, batch_size=4096, workers=None, chunksize=16):
+    '''
+        Breaks many captchas at once. The images are read and segmented in a
+        pool of worker processes, while the digits of many images are stacked
+        into batches of up to batch_size digits, each classified by a single
+        model call.
+
+        Yields (image path, captcha, error) tuples in the order of imgpaths;
+        captcha is None and error describes the problem when an image could
+        not be processed.
+    '''
+    def flush(pending):
+        digits = [rois for _, rois, _ in pending if rois is not None and len(rois)]
+
+        if digits:
+            predictions = model.predict(np.concatenate(digits), batch_size=batch_size)
+            predictions = iter(predictions.argmax(axis=1) + 1)
+
+        for imgpath, rois, error in pending:
+            if rois is None:
+                yield imgpath, None, error
+            else:
+                yield imgpath, ''.join(str(next(predictions)) for _ in range(len(rois))), None
+
+    with Pool(workers) as pool:
+        pending = []
+        pending_digits = 0
+
+        for imgpath, rois, error in pool.imap(_segment_digits, imgpaths, chunksize):
+            pending.append((imgpath, rois, error))
+            pending_digits += 0 if rois is None else len(rois)
+
+            if pending_digits >= batch_size:
+                for result in flush(pending):
+                    yield result
+
+                pending = []
+                pending_digits = 0
+
+        for result in flush(pending):
+            yield result
+
+
+def write_results(results, path):
+    '''
+        Writes (image path, captcha, error) tuples to a .csv or .jsonl file as
+        they come. Returns the number of images and the number of failures.
+    '''
+    count, failed = 0, 0
+    jsonl = path.endswith('.jsonl')
+
+    with open(path, 'w', newline='') as fh:
+        writer = csv.writer(fh)
+
+        if not jsonl:
+            writer.writerow(['image', 'captcha', 'error'])
+
+        for imgpath, captcha, error in results:
+            if jsonl:
+                fh.write(json.dumps(dict(image=imgpath, captcha=captcha, error=error)) + '\n')
+            else:
+                writer.writerow([imgpath, captcha or '', error or ''])
+
+            count += 1
+            failed += captcha is None
+
+    return count, failed
+
+
 if __name__ == '__main__':
     ap = argparse.ArgumentParser()
 
     ap.add_argument(
         '-i',
         '--image-path',
-        required=True,
         help='path to a captcha image'
     )
+    ap.add_argument(
+        '-d',
+        '--image-dir',
+        help='path to a directory of captcha images to break in batch mode'
+    )
     ap.add_argument(
         '-m',
         '--model-path',
         required=True,
-        help='path to a model'
+        help='path to a Keras model (.h5) or a model exported by numpy_runtime.py (.npz)'
     )
     ap.add_argument(
         '-o',
         '--output-path',
         help='path to save the output to'
     )
+    ap.add_argument(
+        '-r',
+        '--results-path',
+        default='results.csv',
+        help='path to save the batch mode results to, .csv or .jsonl'
+    )
+    ap.add_argument(
+        '-b',
+        '--batch-size',
+        type=int,
+        default=4096,
+        help='number of digits classified per model call in batch mode'
+    )
+    ap.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        help='number of image segmentation processes in batch mode (default: number of CPUs)'
+    )
 
     args = vars(ap.parse_args())
 
-    model = load_model(args['model_path'])
-    output, predictions = break_captcha(args['image_path'], model)
+    if not args['image_path'] and not args['image_dir']:
+        ap.error('one of -i/--image-path or -d/--image-dir is required')
+
+    # The LeNet runs in NumPy, importing Keras would take longer than
+    # breaking a captcha
+    model = numpy_runtime.load_model(args['model_path'])
+
+    if args['image_dir']:
+        imgpaths = sorted(glob(os.path.join(args['image_dir'], '*')))
+        started = time.time()
+
+        count, failed = write_results(
+            break_captchas(
+                imgpaths,
+                model,
+                batch_size=args['batch_size'],
+                workers=args['workers']
+            ),
+            args['results_path']
+        )
+
+        elapsed = time.time() - started
+        print('Broke {} captchas in {:.2f}s ({:.1f} images/s), {} failed'.format(
+            count,
+            elapsed,
+            count / elapsed if elapsed else 0.0,
+            failed
+        ))
+    else:
+        import cv2
+
+        output, predictions = break_captcha(args['image_path'], model)
 
-    if 'output_path' in args:
-        cv2.imwrite(args['output_path'], output)
+        if args['output_path']:
+            cv2.imwrite(args['output_path'], output)
 
-    print('Captcha: {}'.format(''.join(predictions)))
-    cv2.imshow('Output', output)
-    cv2.waitKey()
\ No newline at end of file
+        print('Captcha: {}'.format(''.join(predictions)))
+        cv2.imshow('Output', output)
+        cv2.waitKey()
@@ -3,11 +3,166 @@ import time
 import tqdm
 import requests
 import argparse
+import threading
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 URL = "https://www.e-zpassny.com/vector/jcaptcha.do"
 
 
+class RateLimiter():
+    '''
+        Spaces out the starts of requests shared by many threads so that no
+        more than rate requests are started per second. A rate of 0 disables
+        the limit.
+    '''
+    def __init__(self, rate):
+        self.__interval = 1.0 / rate if rate else 0.0
+        self.__next = time.time()
+        self.__lock = threading.Lock()
+
+    def wait(self):
+        if not self.__interval:
+            return
+
+        with self.__lock:
+            now = time.time()
+            start = max(now, self.__next)
+            self.__next = start + self.__interval
+
+        time.sleep(start - now)
+
+
+def make_session(concurrency):
+    '''
+        A session whose connection pool is big enough for every worker thread
+        to keep its own connection alive between requests.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def download_image(session, url, path, limiter, retries=3, backoff=0.5, timeout=60):
+    '''
+        Downloads a single image to path, retrying with exponential backoff.
+        The file is written under a temporary name and renamed when complete,
+        so an interrupted download never leaves a truncated image behind.
+    '''
+    tmp_path = path + '.part'
+
+    for attempt in range(retries + 1):
+        try:
+            limiter.wait()
+            req = session.get(url, timeout=timeout)
+            req.raise_for_status()
+
+            with open(tmp_path, 'wb') as fh:
+                fh.write(req.content)
+
+            os.replace(tmp_path, path)
+            return
+        except (requests.RequestException, IOError):
+            if attempt == retries:
+                # Nothing of a failed download is left behind
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+                raise
+
+            time.sleep(backoff * 2 ** attempt)
+
+
+def download_images(
+    output,
+    num_images,
+    url=URL,
+    concurrency=8,
+    rate=10.0,
+    retries=3,
+    backoff=0.5,
+    timeout=60,
+    pbar=None
+):
+    '''
+        Downloads num_images images from url into the output directory using
+        concurrency threads that share one pooled session, at no more than
+        rate requests per second in total. Images that already exist are
+        skipped, so an interrupted run can simply be restarted.
+
+        Returns the numbers of downloaded, skipped and failed images.
+    '''
+    if not os.path.exists(output):
+        os.mkdir(output)
+
+    paths = [
+        os.path.sep.join([
+            output,
+            '{}.jpg'.format(
+                str(i).zfill(
+                    len(str(num_images))
+                )
+            )
+        ])
+        for i in range(num_images)
+    ]
+
+    missing = [
+        path for path in paths
+        if not (os.path.exists(path) and os.path.getsize(path) > 0)
+    ]
+    skipped = num_images - len(missing)
+    downloaded, failed = 0, 0
+
+    if pbar is not None:
+        pbar.update(skipped)
+
+    session = make_session(concurrency)
+    limiter = RateLimiter(rate)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(
+                download_image,
+                session,
+                url,
+                path,
+                limiter,
+                retries,
+                backoff,
+                timeout
+            ): path
+            for path in missing
+        }
+
+        try:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    downloaded += 1
+                except BaseException as e:
+                    failed += 1
+
+                    if pbar is not None:
+                        pbar.write('Error "%s" downloading image "%s"' % (e, futures[future]))
+
+                if pbar is not None:
+                    pbar.update(1)
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+
+            raise
+
+    session.close()
+
+    return downloaded, skipped, failed
+
+
 if __name__ == '__main__':
     ap = argparse.ArgumentParser()
 
@@ -26,34 +181,50 @@ if __name__ == '__main__':
         help='number of images to download'
     )
 
-    args = vars(ap.parse_args())
+    ap.add_argument(
+        '-u',
+        '--url',
+        default=URL,
+        help='URL to download the captchas from'
+    )
+
+    ap.add_argument(
+        '-c',
+        '--concurrency',
+        type=int,
+        default=8,
+        help='number of concurrent downloads'
+    )
 
-    if not os.path.exists(args['output']):
-        os.mkdir(args['output'])
+    ap.add_argument(
+        '-r',
+        '--rate',
+        type=float,
+        default=10.0,
+        help='maximum number of requests per second, 0 for no limit'
+    )
+
+    ap.add_argument(
+        '--retries',
+        type=int,
+        default=3,
+        help='number of retries of a failed download'
+    )
+
+    args = vars(ap.parse_args())
 
     with tqdm.tqdm(total=args['num_images']) as pbar:
-        for i in range(args['num_images']):
-            try:
-                req = requests.get(URL, timeout=60)
-
-                filename = os.path.sep.join([
-                    args['output'],
-                    '{}.jpg'.format(
-                        str(i).zfill(
-                            len(str(args['num_images']))
-                        )
-                    )
-                ])
-
-                with open(filename, 'wb') as fh:
-                    fh.write(req.content)
-
-                pbar.update(1)
-                pbar.set_description('Success')
-            except KeyboardInterrupt as keyboard_interrupt:
-                break
-            except BaseException as e:
-                pbar.update(1)
-                pbar.write('Error "%s" downloading image #%d' % (e, i + 1))
-
-            time.sleep(0.1)
\ No newline at end of file
+        try:
+            downloaded, skipped, failed = download_images(
+                args['output'],
+                args['num_images'],
+                url=args['url'],
+                concurrency=args['concurrency'],
+                rate=args['rate'],
+                retries=args['retries'],
+                pbar=pbar
+            )
+        except KeyboardInterrupt:
+            raise SystemExit
+
+    print('Downloaded {}, skipped {} existing, {} failed'.format(downloaded, skipped, failed))
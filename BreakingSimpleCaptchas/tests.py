@@ -0,0 +1,209 @@
+'''
+    Tests of the captcha downloader and breaker.
+
+        python -m unittest tests
+'''
+import os
+import cv2
+import tempfile
+import threading
+import numpy as np
+from unittest import TestCase, main
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from numpy_runtime import load_model
+from preprocess_images import preprocess, preprocess_rois
+from break_captcha import break_captcha, break_captchas
+from download_images import download_image, download_images, make_session, RateLimiter
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Sample captchas and the digits they show, read off the images
+CAPTCHAS = {
+    '0000.jpg': '3413',
+    '0001.jpg': '4764',
+    '0002.jpg': '9556',
+    '0003.jpg': '9342',
+    '0250.jpg': '8689',
+    '0500.jpg': '9421',
+    '0750.jpg': '5977',
+    '0999.jpg': '5779'
+}
+
+
+class CaptchaServer(ThreadingMixIn, HTTPServer):
+    '''
+        Local stand-in for the captcha site. It serves generated JPEGs and
+        answers the first `failures` requests with a 503.
+    '''
+    daemon_threads = True
+
+    def __init__(self, failures=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), CaptchaHandler)
+
+        self.failures = failures
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.image = cv2.imencode(
+            '.jpg',
+            np.random.RandomState(7).randint(0, 256, (24, 72)).astype(np.uint8)
+        )[1].tobytes()
+
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/jcaptcha.do' % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class CaptchaHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+            fail = self.server.requests <= self.server.failures
+
+        if fail:
+            self.send_error(503)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.server.image)))
+        self.end_headers()
+        self.wfile.write(self.server.image)
+
+    def log_message(self, *args):
+        pass
+
+
+class Test(TestCase):
+    def test_preprocess_rois(self):
+        img = np.random.RandomState(7).randint(0, 256, (60, 100)).astype(np.uint8)
+        rectangles = [
+            (30, 20, 10, 14),   # Inside the image
+            (-3, -2, 10, 12),   # Over the top left corner
+            (95, 55, 10, 10),   # Over the bottom right corner
+            (200, 10, 5, 5),    # Outside the image
+            (-30, -30, 10, 10)  # Outside, where negative indices would wrap
+        ]
+
+        # Every region is written over, even the ones left as zeros
+        out = np.full((len(rectangles), 28, 28, 1), 7, dtype=np.float32)
+        rois = preprocess_rois(img, rectangles, 28, 28, padding=5, out=out)
+
+        self.assertIs(rois, out)
+
+        # The same as preprocess on the padded crops, clipped to the image
+        for roi, crop in zip(rois, [img[15:39, 25:45], img[0:15, 0:12], img[50:60, 90:100]]):
+            np.testing.assert_allclose(roi[..., 0], preprocess(crop, 28, 28) / 255., rtol=1e-6)
+
+        self.assertFalse(rois[3:].any())
+        self.assertEqual(preprocess_rois(img, np.empty((0, 4), dtype=np.int32), 28, 28).shape, (0, 28, 28, 1))
+
+
+    def test_break_captcha(self):
+        # A smaller LeNet than the one of model.ipynb, trained the same way
+        # on annotated_digits and exported with int8 weights
+        model = load_model(os.path.join(ROOT, 'fixtures', 'model_int8.npz'))
+        paths = [os.path.join(ROOT, 'captchas', name) for name in sorted(CAPTCHAS)]
+
+        for path in paths:
+            output, predictions = break_captcha(path, model)
+
+            self.assertEqual(''.join(predictions), CAPTCHAS[os.path.basename(path)])
+            self.assertEqual(output.shape, (36 + 40, 150 + 40, 3))
+
+        # Batch mode gives the same, in order, and reports unreadable images
+        results = list(break_captchas(paths + [os.path.join(ROOT, 'missing.jpg')], model, batch_size=8, workers=2))
+
+        self.assertEqual(
+            [(os.path.basename(path), captcha) for path, captcha, _ in results[:-1]],
+            sorted(CAPTCHAS.items())
+        )
+        self.assertEqual(results[-1][1], None)
+        self.assertIn('missing.jpg', results[-1][2])
+
+
+    def test_download_images(self):
+        server = CaptchaServer(failures=3)
+
+        with tempfile.TemporaryDirectory() as output:
+            # A finished image, the leftover of an interrupted download and
+            # an empty image, only the first one counts as downloaded
+            with open(os.path.join(output, '0.jpg'), 'wb') as fh:
+                fh.write(server.image)
+
+            open(os.path.join(output, '1.jpg.part'), 'wb').close()
+            open(os.path.join(output, '2.jpg'), 'wb').close()
+
+            counts = download_images(
+                output,
+                5,
+                url=server.url,
+                concurrency=2,
+                rate=0,
+                retries=3,
+                backoff=0
+            )
+
+            self.assertEqual(counts, (4, 1, 0))
+            self.assertEqual(sorted(os.listdir(output)), ['%d.jpg' % i for i in range(5)])
+
+            for name in os.listdir(output):
+                self.assertEqual(cv2.imread(os.path.join(output, name), 0).shape, (24, 72))
+
+        server.stop()
+
+        # Every failed request was retried
+        self.assertEqual(server.requests, 4 + 3)
+
+
+    def test_download_images_give_up(self):
+        server = CaptchaServer(failures=100)
+
+        with tempfile.TemporaryDirectory() as output:
+            counts = download_images(
+                output,
+                3,
+                url=server.url,
+                concurrency=3,
+                rate=0,
+                retries=2,
+                backoff=0
+            )
+
+            self.assertEqual(counts, (0, 0, 3))
+            self.assertEqual(os.listdir(output), [])
+
+        server.stop()
+
+        self.assertEqual(server.requests, 3 * (2 + 1))
+
+
+    def test_download_image_removes_part(self):
+        server = CaptchaServer()
+
+        with tempfile.TemporaryDirectory() as output:
+            # The image cannot be renamed over a directory
+            path = os.path.join(output, '0.jpg')
+            os.mkdir(path)
+
+            with self.assertRaises(IOError):
+                download_image(make_session(1), server.url, path, RateLimiter(0), retries=1, backoff=0)
+
+            self.assertFalse(os.path.exists(path + '.part'))
+
+        server.stop()
+
+        self.assertEqual(server.requests, 2)
+
+
+if __name__ == "__main__":
+    main()
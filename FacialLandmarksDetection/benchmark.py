@@ -0,0 +1,118 @@
+'''
+    Benchmarks the facial landmarks detection stages on synthetic frames, so
+    it runs offline and without a camera or a display.
+
+    Haar cascades will not find faces in synthetic frames, so the cascade is
+    run for its cost only and the later stages are fed the true rectangles
+    of the synthetic faces instead. With --track_every the cascade only runs
+    when the FaceTracker asks for a detection, which shows how many cascade
+    calls tracking saves and how closely the tracked boxes follow the faces.
+'''
+import cv2
+import time
+import argparse
+import numpy as np
+
+from detect import annotate
+from face_tracker import FaceTracker, iou
+from headless import StageTimer, synthetic_video
+from landmarks_detector import LandmarksDetector
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument(
+        '-c',
+        '--cascade_path',
+        default='cascades/haarcascade_frontalface_default.xml',
+        help='path to the face haar cascade'
+    )
+
+    ap.add_argument(
+        '-m',
+        '--model_path',
+        default='model.h5',
+        help='path to a trained CNN facial landmarks model, .h5 or .npz exported by numpy_runtime.py'
+    )
+
+    ap.add_argument(
+        '-n',
+        '--num_frames',
+        type=int,
+        default=300,
+        help='number of synthetic frames to process'
+    )
+
+    ap.add_argument(
+        '-f',
+        '--faces',
+        type=int,
+        default=2,
+        help='number of synthetic faces per frame'
+    )
+
+    ap.add_argument(
+        '-t',
+        '--track_every',
+        type=int,
+        default=0,
+        help='only run the face detector every N frames and track the faces in between'
+    )
+
+    args = ap.parse_args()
+
+    model = LandmarksDetector(args.model_path, args.cascade_path)
+    tracker = FaceTracker(detect_every=args.track_every) if args.track_every else None
+    timer = StageTimer()
+    cascade_calls = 0
+    overlaps = []
+
+    # Warm up the model so its one-off setup is not counted
+    model.predict([np.zeros((96, 96), np.uint8)], [np.array([[0, 0, 96, 96]])])
+
+    started = time.perf_counter()
+
+    for frame, truth in synthetic_video(args.num_frames, args.faces):
+        frame_start = time.perf_counter()
+
+        with timer('preprocessing'):
+            gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+
+        def detect_faces(gray):
+            global cascade_calls
+            cascade_calls += 1
+            model.detect_faces(gray)
+
+            return truth
+
+        with timer('detection'):
+            if tracker is None:
+                rectangles = detect_faces(gray)
+            else:
+                rectangles, _ = tracker.update(gray, detect_faces)
+
+        if len(rectangles):
+            overlaps.append(iou(rectangles, truth).max(axis=1).mean())
+
+        with timer('landmarks'):
+            all_landmarks, = model.predict([gray], [rectangles])
+
+        with timer('rendering'):
+            annotate(frame.copy(), rectangles, all_landmarks)
+
+        timer.add('total', time.perf_counter() - frame_start)
+
+    elapsed = time.perf_counter() - started
+
+    print('{} frames, {} faces per frame: {:.1f} frames/s overall'.format(
+        args.num_frames,
+        args.faces,
+        args.num_frames / elapsed
+    ))
+    print('Cascade calls: {} ({:.1f}x fewer than frames), mean IoU with the true faces: {:.3f}\n'.format(
+        cascade_calls,
+        args.num_frames / max(cascade_calls, 1),
+        np.mean(overlaps) if overlaps else 0.0
+    ))
+    print(timer.report())
@@ -4,14 +4,92 @@ Created on Sun Nov  5 00:56:10 2017
 
 @author: Karolis
 """
-import cv2
 import time
-import imageio
-import imutils
 import argparse
-from landmarks_detector import LandmarksDetector
 
-        
+
+def annotate(frame, rectangles, all_landmarks, ids=None):
+    import cv2
+
+    if ids is None:
+        ids = [None] * len(rectangles)
+
+    for (x, y, w, h), landmarks, i in zip(rectangles, all_landmarks, ids):
+        # Draw a rectangle around the face
+        cv2.rectangle(
+            frame,
+            (x, y),
+            (x + w, y + h),
+            (0, 0, 255),
+            2
+        )
+
+        if i is not None:
+            cv2.putText(
+                frame,
+                '#%d' % i,
+                (x, y - 10),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.45,
+                (0, 0, 255),
+                2
+            )
+
+        # Mark the landmakrs
+        for (xx, yy) in zip(landmarks[0::2], landmarks[1::2]):
+            cv2.circle(
+                frame,
+                (int(xx), int(yy)),
+                3,
+                (0, 0, 255),
+                -1
+            )
+
+    return frame
+
+
+def detect_frames(model, camera, batch_size=1):
+    '''
+        Reads the camera until it runs out of frames and yields
+        (frame index, annotated frame, rectangles, landmarks) tuples.
+        With batch_size > 1 the faces of that many frames share one CNN call.
+        When the model tracks faces, the frames go one by one so that every
+        frame is labelled with its own track ids.
+    '''
+    if model.tracker is not None:
+        batch_size = 1
+
+    i = 0
+    done = False
+
+    while not done:
+        frames = []
+
+        while len(frames) < batch_size:
+            _, frame = camera.read()
+
+            if frame is None:
+                done = True
+                break
+
+            frames.append(frame)
+
+        if not frames:
+            break
+
+        if batch_size == 1:
+            detections = [model.detect(frames[0])]
+        else:
+            detections = model.detect_batch(frames)
+
+        ids = model.tracker.ids if model.tracker else None
+
+        for frame, (rectangles, all_landmarks) in zip(frames, detections):
+            frame = annotate(frame.copy(), rectangles, all_landmarks, ids)
+            yield i, frame, rectangles, all_landmarks
+            i += 1
+
+
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
 
@@ -26,7 +104,7 @@ if __name__ == "__main__":
         '-m',
         '--model_path',
         required=True,
-        help='path to a trained CNN smile model'
+        help='path to a trained CNN facial landmarks model, .h5 or .npz exported by numpy_runtime.py'
     )
 
     ap.add_argument(
@@ -40,55 +118,132 @@ if __name__ == "__main__":
         '--output_path',
         help='path to save the output to (optional)'
     )
-       
-    
+
+    ap.add_argument(
+        '--headless',
+        action='store_true',
+        help='process the videos as fast as possible without displaying them'
+    )
+
+    ap.add_argument(
+        '-i',
+        '--inputs',
+        nargs='+',
+        default=[],
+        help='video files and/or directories of videos to process in the headless mode'
+    )
+
+    ap.add_argument(
+        '-r',
+        '--results_path',
+        help='path to save the per-frame boxes and landmarks to, .jsonl or .npz (optional)'
+    )
+
+    ap.add_argument(
+        '-b',
+        '--batch_size',
+        type=int,
+        default=16,
+        help='number of frames whose faces share one CNN call in the headless mode'
+    )
+
+    ap.add_argument(
+        '-t',
+        '--track_every',
+        type=int,
+        default=0,
+        help='only run the face detector every N frames and track the faces in between (optional)'
+    )
+
     args = ap.parse_args()
-       
+
+    # Imported once the arguments are parsed, -h and usage errors should not
+    # wait for OpenCV or the model runtimes
+    import cv2
+    from face_tracker import FaceTracker
+    from video_writer import VideoWriter
+    from landmarks_detector import LandmarksDetector
+    from headless import find_videos, ResultsWriter
+
+    if args.headless:
+        sources = find_videos(args.inputs + ([args.video_path] if args.video_path else []))
+
+        if not sources:
+            ap.error('the headless mode needs at least one video, see -v and -i')
+    else:
+        sources = [args.video_path if args.video_path else 0]
+
     model = LandmarksDetector(args.model_path, args.cascade_path)
-    camera = cv2.VideoCapture(0) if 'video_path' not in args else cv2.VideoCapture(args.video_path)
-    output = []
-            
-    while True:
-        _, frame = camera.read()
+    writer = VideoWriter(args.output_path) if args.output_path else None
+    results = ResultsWriter(args.results_path) if args.results_path else None
 
-        if frame is None:
-            break
-       
-        frame_copy = frame.copy()
-        rectangles, all_landmarks = model.detect(frame_copy)
-        
-        for (x, y, w, h), landmarks in zip(rectangles, all_landmarks):
-            # Draw a rectangle around the face
-            cv2.rectangle(
-                frame_copy, 
-                (x, y), 
-                (x + w, y + h), 
-                (0, 0, 255), 
-                2
-            )
-            
-            # Mark the landmakrs
-            for (xx, yy) in zip(landmarks[0::2], landmarks[1::2]):
-                cv2.circle(
-                    frame_copy, 
-                    (xx, yy),
-                    3,
-                    (0, 0, 255), 
-                    -1
+    quit = False
+    total_frames = 0
+    started = time.time()
+
+    for source in sources:
+        camera = cv2.VideoCapture(source)
+
+        # Every video starts with fresh tracks
+        if args.track_every:
+            model.tracker = FaceTracker(detect_every=args.track_every)
+
+        frames = detect_frames(
+            model,
+            camera,
+            batch_size=args.batch_size if args.headless else 1
+        )
+
+        for i, frame_copy, rectangles, all_landmarks in frames:
+            total_frames += 1
+
+            if results is not None:
+                tracks = dict(ids=model.tracker.ids) if model.tracker else {}
+                results.write(
+                    str(source),
+                    i,
+                    boxes=rectangles,
+                    landmarks=all_landmarks,
+                    **tracks
                 )
-        
-        cv2.imshow('Frame', frame_copy)
-        output.append(frame_copy)
 
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+            if writer is not None:
+                writer.write(frame_copy)
+
+            if args.headless:
+                continue
+
+            cv2.imshow('Frame', frame_copy)
+
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                quit = True
+                break
+
+        if model.tracker is not None:
+            print('Ran the face detector on {} of {} frames'.format(
+                model.tracker.detections,
+                model.tracker.frames
+            ))
+
+        camera.release()
+
+        if quit:
             break
 
+    if args.headless:
+        elapsed = time.time() - started
+        print('Processed {} frames from {} videos in {:.2f}s ({:.2f} FPS)'.format(
+            total_frames,
+            len(sources),
+            elapsed,
+            total_frames / elapsed if elapsed else 0.0
+        ))
+
+    if results is not None:
+        results.close()
 
-    if 'output_path' in args:
-        with imageio.get_writer(args.output_path, mode='I') as writer:
-            for frame in output:
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                writer.append_data(frame)
+    if writer is not None:
+        writer.close()
 
-    camera.release()
-    cv2.destroyAllWindows()
+    if not args.headless:
+        cv2.destroyAllWindows()
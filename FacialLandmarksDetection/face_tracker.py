@@ -0,0 +1,192 @@
+'''
+    Carries face rectangles between frames with sparse optical flow, so the
+    expensive Haar cascade only has to run every few frames.
+'''
+import cv2
+import numpy as np
+
+
+def iou(a, b):
+    '''
+        Intersection over union of every (x, y, w, h) rectangle in a with
+        every rectangle in b. Returns a len(a) x len(b) matrix.
+    '''
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(1, -1, 4)
+
+    w = np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    h = np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    intersection = np.clip(w, 0, None) * np.clip(h, 0, None)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+
+    return intersection / np.maximum(union, 1e-9)
+
+
+class FaceTracker():
+    def __init__(self,
+        detect_every=10,
+        min_confidence=0.5,
+        iou_threshold=0.3,
+        max_corners=30
+    ):
+        '''
+            detect_every   - run the face detector every detect_every frames
+                             and track the faces in between.
+
+            min_confidence - minimum fraction of a face's feature points that
+                             must be tracked successfully into the next frame.
+                             When any face drops below it the detector is run
+                             on that frame instead.
+
+            iou_threshold  - minimum overlap for a new detection to inherit
+                             the id of a tracked face.
+
+            max_corners    - maximum number of feature points tracked per face.
+        '''
+        self.detect_every = detect_every
+        self.min_confidence = min_confidence
+        self.iou_threshold = iou_threshold
+        self.max_corners = max_corners
+
+        self.frames = 0
+        self.detections = 0
+
+        self.__next_id = 0
+        self.__shape = None
+        self.__prev_gray = None
+        self.__rectangles = np.empty((0, 4), dtype=np.float32)
+        self.__ids = np.empty(0, dtype=np.int32)
+        self.__points = []
+
+    @property
+    def rectangles(self):
+        rectangles = np.round(self.__rectangles).astype(np.int32)
+
+        if self.__shape is None or not len(rectangles):
+            return rectangles
+
+        # Tracked faces may partly drift out of the frame, clip them to it
+        height, width = self.__shape
+        x1 = np.clip(rectangles[:, 0], 0, width - 1)
+        y1 = np.clip(rectangles[:, 1], 0, height - 1)
+        x2 = np.clip(rectangles[:, 0] + rectangles[:, 2], x1 + 1, width)
+        y2 = np.clip(rectangles[:, 1] + rectangles[:, 3], y1 + 1, height)
+
+        return np.stack([x1, y1, x2 - x1, y2 - y1], axis=1)
+
+    @property
+    def ids(self):
+        return self.__ids.copy()
+
+    def __find_points(self, gray):
+        self.__points = []
+
+        for x, y, w, h in self.rectangles:
+            # Only look at the inner part of the face, the border of the
+            # rectangle is mostly background
+            mask = np.zeros_like(gray)
+            mask[y + h // 8:y + h - h // 8, x + w // 8:x + w - w // 8] = 255
+
+            points = cv2.goodFeaturesToTrack(
+                gray,
+                maxCorners=self.max_corners,
+                qualityLevel=0.01,
+                minDistance=3,
+                mask=mask
+            )
+
+            self.__points.append(
+                points if points is not None else np.empty((0, 1, 2), dtype=np.float32)
+            )
+
+    def __detect(self, gray, detect_faces):
+        rectangles = np.asarray(detect_faces(gray), dtype=np.float32).reshape(-1, 4)
+        self.detections += 1
+
+        ids = np.full(len(rectangles), -1, dtype=np.int32)
+
+        # Greedily give every new rectangle the id of the tracked face it
+        # overlaps the most
+        if len(rectangles) and len(self.__rectangles):
+            overlaps = iou(self.__rectangles, rectangles)
+
+            for flat in np.argsort(overlaps, axis=None)[::-1]:
+                old, new = np.unravel_index(flat, overlaps.shape)
+
+                if overlaps[old, new] < self.iou_threshold:
+                    break
+
+                if ids[new] == -1 and self.__ids[old] not in ids:
+                    ids[new] = self.__ids[old]
+
+        for i in np.flatnonzero(ids == -1):
+            ids[i] = self.__next_id
+            self.__next_id += 1
+
+        self.__rectangles = rectangles
+        self.__ids = ids
+        self.__find_points(gray)
+
+    def __track(self, gray):
+        '''
+            Moves every face by the median optical flow of its feature points.
+            Returns False when any face could not be tracked reliably.
+        '''
+        if not len(self.__rectangles):
+            return True
+
+        counts = [len(points) for points in self.__points]
+
+        if min(counts) == 0:
+            return False
+
+        points = np.concatenate(self.__points)
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(
+            self.__prev_gray,
+            gray,
+            points,
+            None,
+            winSize=(15, 15),
+            maxLevel=2
+        )
+        status = status.ravel().astype(bool)
+
+        offsets = np.cumsum(counts)[:-1]
+        height, width = gray.shape[:2]
+
+        for i, (p0, p1, ok) in enumerate(zip(
+            np.split(points, offsets),
+            np.split(moved, offsets),
+            np.split(status, offsets)
+        )):
+            if ok.mean() < self.min_confidence:
+                return False
+
+            dx, dy = np.median(p1[ok] - p0[ok], axis=0).ravel()
+            x, y, w, h = self.__rectangles[i] + (dx, dy, 0, 0)
+
+            # Faces leaving the frame have to be re-detected
+            if not (0 <= x + w / 2 < width and 0 <= y + h / 2 < height):
+                return False
+
+            self.__rectangles[i] = (x, y, w, h)
+            self.__points[i] = p1[ok].reshape(-1, 1, 2)
+
+        return True
+
+    def update(self, gray, detect_faces):
+        '''
+            Returns the (N, 4) face rectangles and their (N,) track ids in the
+            gray frame. detect_faces(gray) is only called when a detection is
+            due or tracking has failed.
+        '''
+        due = self.frames % self.detect_every == 0 or self.__prev_gray is None
+        self.__shape = gray.shape[:2]
+
+        if due or not self.__track(gray):
+            self.__detect(gray, detect_faces)
+
+        self.__prev_gray = gray
+        self.frames += 1
+
+        return self.rectangles, self.ids
@@ -6,62 +6,175 @@ Created on Wed Nov  8 00:35:05 2017
 """
 import cv2
 import numpy as np
-from keras.models import load_model
+
+import numpy_runtime
 
 
 class LandmarksDetector():
-    def __init__(self, cnn_model_path, face_cascade_path):
-        
-        self.__cnn_model = load_model(cnn_model_path)
+    def __init__(self, cnn_model_path, face_cascade_path, tracker=None, batch_size=32):
+        '''
+            cnn_model_path - a Keras model (.h5), or a model exported by
+                             numpy_runtime.py (.npz), which runs without Keras.
+
+            tracker - optional FaceTracker, used by detect() and detect_batch()
+                      to skip running the face detector on most frames.
+
+            batch_size - largest number of faces passed through the CNN at
+                         once, which bounds its memory however many frames
+                         detect_batch is given.
+        '''
+        if cnn_model_path.endswith('.npz'):
+            self.__cnn_model = numpy_runtime.load_model(cnn_model_path)
+        else:
+            from keras.models import load_model
+            self.__cnn_model = load_model(cnn_model_path)
         self.__face_detector = cv2.CascadeClassifier(face_cascade_path)
+        self.tracker = tracker
+        self.batch_size = batch_size
 
-    def detect(self, 
-        img, 
+    def detect_faces(self,
+        gray,
+        scale_factor=1.1,
+        minNeighbors=5,
+        minSize=(30, 30)
+    ):
+        '''
+            Returns an (N, 4) array of face rectangles found in the gray image.
+        '''
+        rectangles = self.__face_detector.detectMultiScale(
+            gray,
+            scaleFactor=scale_factor,
+            minNeighbors=minNeighbors,
+            minSize=minSize,
+            flags=cv2.CASCADE_SCALE_IMAGE,
+        )
+
+        # detectMultiScale returns an empty tuple when nothing is found
+        return np.asarray(rectangles, dtype=np.int32).reshape(-1, 4)
+
+    def find_faces(self, gray, **kwargs):
+        '''
+            Same as detect_faces, but goes through the tracker if there is one,
+            in which case the frames must be passed in in order.
+        '''
+        if self.tracker is None:
+            return self.detect_faces(gray, **kwargs)
+
+        rectangles, _ = self.tracker.update(
+            gray,
+            lambda gray: self.detect_faces(gray, **kwargs)
+        )
+
+        return rectangles
+
+    @staticmethod
+    def __extract_rois(gray, rectangles, rois):
+        '''
+            Resizes every face in rectangles to 96x96 and writes it, scaled
+            to [0, 1], straight into the preallocated rois tensor.
+        '''
+        for roi, (x, y, w, h) in zip(rois, rectangles):
+            face = cv2.resize(gray[y:y + h, x:x + w], (96, 96))
+            np.multiply(face, 1 / 255.0, out=roi[..., 0], casting='unsafe')
+
+    @staticmethod
+    def __denormalise(landmarks, rectangles):
+        '''
+            Maps the [-1, 1] model outputs of all faces back to image
+            coordinates in one broadcast.
+        '''
+        x, y, w, h = (rectangles[:, i:i + 1].astype(np.float32) for i in range(4))
+
+        # x coordinates
+        landmarks[:, 0::2] = (landmarks[:, 0::2] * 48 + 48) * w / 96 + x
+
+        # y coordinates
+        landmarks[:, 1::2] = (landmarks[:, 1::2] * 48 + 48) * h / 96 + y
+
+        return landmarks
+
+    def predict(self, grays, all_rectangles):
+        '''
+            Runs the faces of all the given gray frames through the CNN,
+            batch_size at a time, and returns the denormalised landmarks split
+            back per frame.
+        '''
+        counts = [len(rectangles) for rectangles in all_rectangles]
+        total = sum(counts)
+
+        if not total:
+            outputs = self.__cnn_model.output_shape[-1]
+            return [np.empty((0, outputs), dtype=np.float32) for _ in counts]
+
+        rois = np.empty((total, 96, 96, 1), dtype=np.float32)
+        offset = 0
+
+        for gray, rectangles, count in zip(grays, all_rectangles, counts):
+            self.__extract_rois(gray, rectangles, rois[offset:offset + count])
+            offset += count
+
+        landmarks = self.__cnn_model.predict(rois, batch_size=min(total, self.batch_size))
+        landmarks = self.__denormalise(
+            landmarks.reshape(total, -1),
+            np.concatenate(all_rectangles)
+        )
+
+        return np.split(landmarks, np.cumsum(counts)[:-1])
+
+    def detect(self,
+        img,
         scale_factor=1.1,
         minNeighbors=5,
         minSize=(30, 30)
     ):
         '''
             scaleFactor  - parameter specifying how much the image size is reduced
-                           at each image scale, i.e. is used to creat a scale 
+                           at each image scale, i.e. is used to creat a scale
                            pyramid.
-                          
-            minNeighbors - how many neighbors each candidate rectangle should 
+
+            minNeighbors - how many neighbors each candidate rectangle should
                            have to retain.
-                           
+
             minSize      - minimum possible object size. Objects smaller than
                            minSize are ignored.
-        '''            
+
+            All faces found in the image are passed through the CNN together,
+            batch_size at a time. Returns an (N, 4) array of rectangles and an (N, 30) array
+            of landmarks, one row per face.
+        '''
         gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-        
-        rectangles = self.__face_detector.detectMultiScale(
+        rectangles = self.find_faces(
             gray,
-            scaleFactor=scale_factor,
+            scale_factor=scale_factor,
             minNeighbors=minNeighbors,
-            minSize=minSize,
-            flags=cv2.CASCADE_SCALE_IMAGE,
+            minSize=minSize
         )
-        
-        all_landmarks = []
-        
-        for x, y, w, h in rectangles:
-            x_min, x_max = x, x + w
-            y_min, y_max = y, y + h
-            
-            roi = gray[y_min:y_max, x_min:x_max]
-            roi = cv2.resize(roi, (96, 96)) 
-            roi = roi.astype(float) / 255.0
-            roi = np.expand_dims(np.expand_dims(roi, axis=-1), axis=0)
-            
-            landmarks = self.__cnn_model.predict(roi)
-            landmarks = np.squeeze(landmarks)
-            
-            # x coordinates
-            landmarks[0::2] = (landmarks[0::2] * 48 + 48) * (x_max - x_min) / 96 + x_min
-            
-            # y coordinates
-            landmarks[1::2] = (landmarks[1::2] * 48 + 48) * (y_max - y_min) / 96 + y_min
-        
-            all_landmarks.append(landmarks)
-            
-        return rectangles, all_landmarks
\ No newline at end of file
+        all_landmarks, = self.predict([gray], [rectangles])
+
+        return rectangles, all_landmarks
+
+    def detect_batch(self,
+        imgs,
+        scale_factor=1.1,
+        minNeighbors=5,
+        minSize=(30, 30)
+    ):
+        '''
+            Same as detect, but for a list of frames, e.g. a chunk of an offline
+            video. The faces of all the frames are stacked and classified in
+            batches of batch_size, rather than one frame at a time.
+
+            Returns a list of (rectangles, landmarks) tuples, one per frame.
+        '''
+        grays = [cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) for img in imgs]
+        all_rectangles = [
+            self.find_faces(
+                gray,
+                scale_factor=scale_factor,
+                minNeighbors=minNeighbors,
+                minSize=minSize
+            )
+            for gray in grays
+        ]
+
+        return list(zip(all_rectangles, self.predict(grays, all_rectangles)))
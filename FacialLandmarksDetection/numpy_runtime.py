@@ -0,0 +1,391 @@
+'''
+    Keras-free inference of the Sequential CNNs trained in the notebooks.
+
+    A model saved by Keras (.h5) is read with h5py and run in NumPy, with the
+    convolutions turned into one matrix product each (im2col). export writes
+    its weights at reduced precision, float16 or int8 with a scale per output
+    channel, to a .npz file a fraction of the size, which NumpyModel runs as
+    well. Either way the model has the predict method of a Keras model:
+
+        model = load_model('model_int8.npz')
+        predictions = model.predict(images)
+
+    python numpy_runtime.py -m model.h5 exports the model at every precision
+    and reports the size, the output differences and the speed of each.
+'''
+import os
+import json
+import time
+import argparse
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+PRECISIONS = ['float32', 'float16', 'int8']
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'tanh': np.tanh,
+    'softmax': lambda x: _softmax(x)
+}
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def _decode(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+
+def read_h5(path):
+    '''
+        The layer configs and the weights of every layer of a Sequential model
+        saved by Keras.
+    '''
+    # h5py is only needed to read Keras files, not the exported ones
+    import h5py
+
+    with h5py.File(path, 'r') as fh:
+        if 'model_config' not in fh.attrs:
+            raise ValueError('"%s" has no model config, save the model with model.save' % path)
+
+        config = json.loads(_decode(fh.attrs['model_config']))
+
+        if config['class_name'] != 'Sequential':
+            raise ValueError('only Sequential models are supported, got %s' % config['class_name'])
+
+        group = fh['model_weights'] if 'model_weights' in fh else fh
+        weights = {}
+
+        for name in group.attrs['layer_names']:
+            layer = group[_decode(name)]
+            weights[_decode(name)] = [
+                np.asarray(layer[_decode(weight)]) for weight in layer.attrs['weight_names']
+            ]
+
+    # Keras 2.2 keeps the layers in the config itself, later versions under 'layers'
+    layers = config['config']
+
+    if isinstance(layers, dict):
+        layers = layers['layers']
+
+    return layers, weights
+
+
+def _quantise(kernel):
+    '''
+        Symmetric int8 quantisation with a scale per output channel, the last
+        axis of both Conv2D and Dense kernels.
+    '''
+    scale = np.abs(kernel).reshape(-1, kernel.shape[-1]).max(axis=0) / 127.
+    scale[scale == 0] = 1.
+
+    return np.round(kernel / scale).astype(np.int8), scale.astype(np.float32)
+
+
+def export(h5_path, path, precision='int8'):
+    '''
+        Writes the model of h5_path to a .npz file with its kernels stored in
+        the given precision. The biases stay float32, they are tiny.
+    '''
+    if precision not in PRECISIONS:
+        raise ValueError('precision must be one of {}'.format(PRECISIONS))
+
+    layers, weights = read_h5(h5_path)
+    arrays = dict(config=np.array(json.dumps(dict(layers=layers, precision=precision))))
+
+    for name, layer_weights in ((name, w) for name, w in weights.items() if w):
+        kernel = layer_weights[0]
+
+        if precision == 'int8':
+            arrays[name + '/kernel'], arrays[name + '/scale'] = _quantise(kernel)
+        else:
+            arrays[name + '/kernel'] = kernel.astype(precision)
+
+        # Layers with use_bias=False have none
+        if len(layer_weights) > 1:
+            arrays[name + '/bias'] = layer_weights[1].astype(np.float32)
+
+    np.savez(path, **arrays)
+
+
+def read_npz(path):
+    '''
+        The layer configs and the float32 weights of a model written by export.
+    '''
+    with np.load(path) as arrays:
+        config = json.loads(str(arrays['config']))
+        weights = {}
+
+        for layer in config['layers']:
+            name = layer['config']['name']
+
+            if name + '/kernel' not in arrays:
+                continue
+
+            kernel = arrays[name + '/kernel'].astype(np.float32)
+
+            if name + '/scale' in arrays:
+                kernel *= arrays[name + '/scale']
+
+            weights[name] = [kernel]
+
+            if name + '/bias' in arrays:
+                weights[name].append(arrays[name + '/bias'])
+
+    return config['layers'], weights
+
+
+def _same_padding(size, kernel_size, stride):
+    # The padding of TensorFlow, any odd pixel goes to the bottom/right
+    total = max((-(-size // stride) - 1) * stride + kernel_size - size, 0)
+
+    return total // 2, total - total // 2
+
+
+def _windows(x, kernel_size, strides):
+    '''
+        (N, OH, OW, KH, KW, C) view of the sliding windows of x, no copy.
+    '''
+    n, h, w, c = x.shape
+    (kh, kw), (sh, sw) = kernel_size, strides
+    sn, sy, sx, sc = x.strides
+
+    return as_strided(
+        x,
+        (n, (h - kh) // sh + 1, (w - kw) // sw + 1, kh, kw, c),
+        (sn, sy * sh, sx * sw, sy, sx, sc),
+        writeable=False
+    )
+
+
+def conv2d(x, kernel, bias, strides=(1, 1), padding='valid'):
+    '''
+        Keras Conv2D (channels_last) as a single matrix product of the
+        unrolled windows of x (im2col) and the kernel.
+    '''
+    kh, kw, c, filters = kernel.shape
+
+    if padding == 'same':
+        x = np.pad(x, [
+            (0, 0),
+            _same_padding(x.shape[1], kh, strides[0]),
+            _same_padding(x.shape[2], kw, strides[1]),
+            (0, 0)
+        ], mode='constant')
+
+    windows = _windows(x, (kh, kw), strides)
+    n, oh, ow = windows.shape[:3]
+
+    output = windows.reshape(n * oh * ow, kh * kw * c) @ kernel.reshape(kh * kw * c, filters)
+    output += bias
+
+    return output.reshape(n, oh, ow, filters)
+
+
+def max_pooling2d(x, pool_size=(2, 2), strides=None, padding='valid'):
+    strides = strides or pool_size
+
+    if padding == 'same':
+        x = np.pad(x, [
+            (0, 0),
+            _same_padding(x.shape[1], pool_size[0], strides[0]),
+            _same_padding(x.shape[2], pool_size[1], strides[1]),
+            (0, 0)
+        ], mode='constant', constant_values=-np.inf)
+
+    n, h, w, c = x.shape
+    (ph, pw), (sh, sw) = pool_size, strides
+
+    # Non-overlapping windows are a reshape away
+    if (ph, pw) == (sh, sw):
+        oh, ow = h // ph, w // pw
+
+        return x[:, :oh * ph, :ow * pw].reshape(n, oh, ph, ow, pw, c).max(axis=(2, 4))
+
+    return _windows(x, pool_size, strides).max(axis=(3, 4))
+
+
+class NumpyModel():
+    def __init__(self, layers, weights):
+        '''
+            layers  - the layer configs of a Keras Sequential model.
+
+            weights - {layer name: [kernel, bias]} of the layers with weights,
+                      [kernel] of the ones with use_bias=False.
+        '''
+        self.layers = layers
+
+        # A zero bias for the layers without one, so every layer adds one
+        self.weights = {
+            name: w if len(w) != 1 else [w[0], np.zeros(w[0].shape[-1], dtype=np.float32)]
+            for name, w in weights.items()
+        }
+
+        for layer in layers:
+            if layer['class_name'] not in [
+                'Conv2D', 'MaxPooling2D', 'Dense', 'Activation', 'Dropout', 'Flatten'
+            ]:
+                raise ValueError('unsupported layer %s' % layer['class_name'])
+
+            if layer['config'].get('data_format', 'channels_last') != 'channels_last':
+                raise ValueError('only channels_last models are supported')
+
+            if np.any(np.asarray(layer['config'].get('dilation_rate', 1)) != 1):
+                raise ValueError('dilated convolutions are not supported, %s has dilation_rate %s' % (
+                    layer['config']['name'],
+                    layer['config']['dilation_rate']
+                ))
+
+        self.input_shape = (None,) + tuple(layers[0]['config']['batch_input_shape'][1:])
+        self.output_shape = (None,) + self.__forward(
+            np.zeros((1,) + self.input_shape[1:], dtype=np.float32)
+        ).shape[1:]
+
+    def __forward(self, x):
+        for layer in self.layers:
+            kind, config = layer['class_name'], layer['config']
+
+            if kind == 'Conv2D':
+                x = conv2d(x, *self.weights[config['name']], config['strides'], config['padding'])
+                x = ACTIVATIONS[config['activation']](x)
+            elif kind == 'Dense':
+                x = x @ self.weights[config['name']][0] + self.weights[config['name']][1]
+                x = ACTIVATIONS[config['activation']](x)
+            elif kind == 'MaxPooling2D':
+                x = max_pooling2d(x, config['pool_size'], config['strides'], config['padding'])
+            elif kind == 'Activation':
+                x = ACTIVATIONS[config['activation']](x)
+            elif kind == 'Flatten':
+                x = x.reshape(len(x), -1)
+
+            # Dropout does nothing at inference
+
+        return x
+
+    def predict(self, x, batch_size=32):
+        '''
+            Same as the predict of a Keras model, the inputs are run batch_size
+            at a time to bound the memory of the unrolled windows.
+        '''
+        x = np.asarray(x, dtype=np.float32)
+
+        if not len(x):
+            return np.empty((0,) + self.output_shape[1:], dtype=np.float32)
+
+        return np.concatenate([
+            self.__forward(x[start:start + batch_size])
+            for start in range(0, len(x), batch_size)
+        ])
+
+
+def load_model(path):
+    '''
+        A NumpyModel of a Keras .h5 file or of a .npz file written by export.
+    '''
+    if path.endswith('.npz'):
+        return NumpyModel(*read_npz(path))
+
+    return NumpyModel(*read_h5(path))
+
+
+def report(h5_path, output_dir, num_samples=256, batch_sizes=(1, 32)):
+    '''
+        Exports the model at every precision and compares them on random
+        inputs: file size, largest and mean output difference from the
+        float32 weights, agreement of the argmax for classifiers, and the
+        time per sample. Keras is timed as well when it can be imported.
+    '''
+    rng = np.random.RandomState(7)
+    reference = load_model(h5_path)
+    x = rng.rand(num_samples, *reference.input_shape[1:]).astype(np.float32)
+    expected = reference.predict(x)
+
+    runs = []
+
+    try:
+        from keras.models import load_model as load_keras_model
+        runs.append(('keras', load_keras_model(h5_path), os.path.getsize(h5_path)))
+    except ImportError:
+        print('Keras is not installed, only the NumPy runtime is timed\n')
+
+    for precision in PRECISIONS:
+        path = os.path.join(output_dir, '{}_{}.npz'.format(
+            os.path.splitext(os.path.basename(h5_path))[0],
+            precision
+        ))
+        export(h5_path, path, precision)
+        runs.append((precision, load_model(path), os.path.getsize(path)))
+
+    print('{:<10}{:>10}{:>12}{:>12}{:>10}'.format('', 'size KB', 'max diff', 'mean diff', 'argmax') + ''.join(
+        '{:>14}'.format('ms/sample@%d' % size) for size in batch_sizes
+    ))
+
+    for name, model, size in runs:
+        output = model.predict(x)
+        diff = np.abs(output - expected)
+        agreement = (output.argmax(axis=1) == expected.argmax(axis=1)).mean() if output.ndim == 2 else np.nan
+        times = []
+
+        for batch_size in batch_sizes:
+            model.predict(x[:batch_size], batch_size=batch_size)
+
+            started = time.time()
+            model.predict(x, batch_size=batch_size)
+            times.append(1000 * (time.time() - started) / len(x))
+
+        print('{:<10}{:>10.0f}{:>12.2e}{:>12.2e}{:>9.1f}%'.format(
+            name,
+            size / 1024,
+            diff.max(),
+            diff.mean(),
+            100 * agreement
+        ) + ''.join('{:>14.3f}'.format(t) for t in times))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument(
+        '-m',
+        '--model_path',
+        required=True,
+        help='path to a Keras model (.h5)'
+    )
+
+    ap.add_argument(
+        '-o',
+        '--output_dir',
+        default='.',
+        help='directory to export the model to'
+    )
+
+    ap.add_argument(
+        '-p',
+        '--precision',
+        choices=PRECISIONS,
+        help='only export the model at this precision, without the report'
+    )
+
+    ap.add_argument(
+        '-n',
+        '--num_samples',
+        type=int,
+        default=256,
+        help='number of random inputs the precisions are compared on'
+    )
+
+    args = ap.parse_args()
+
+    if args.precision:
+        export(args.model_path, os.path.join(args.output_dir, '{}_{}.npz'.format(
+            os.path.splitext(os.path.basename(args.model_path))[0],
+            args.precision
+        )), args.precision)
+    else:
+        report(args.model_path, args.output_dir, args.num_samples)
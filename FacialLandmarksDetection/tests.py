@@ -0,0 +1,331 @@
+'''
+    Tests of the landmarks detector and of the modules shared by the
+    detectors. FacialLandmarksDetection holds the original of every module vendored into the other projects, see
+    VENDORED, and the copies are checked to be identical to it.
+
+        python -m unittest tests
+'''
+import os
+import cv2
+import copy
+import json
+import h5py
+import tempfile
+import importlib.util
+import numpy as np
+from unittest import TestCase, main, skipUnless
+
+from video_writer import VideoWriter
+from face_tracker import FaceTracker, iou
+from headless import find_videos, synthetic_video, ResultsWriter
+from numpy_runtime import read_h5, export, load_model, NumpyModel
+from landmarks_detector import LandmarksDetector
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Module: the projects it is copied into
+VENDORED = {
+    'video_writer.py': ['SmilesDetection'],
+    'headless.py': ['SmilesDetection'],
+    'face_tracker.py': ['SmilesDetection'],
+    'numpy_runtime.py': ['SmilesDetection', 'BreakingSimpleCaptchas']
+}
+
+# A small Sequential model saved the way Keras 2.2 saves one, with 'same'
+# padding of odd sizes, strided and overlapping windows, and the outputs of
+# every one of its layers as computed by Keras
+FIXTURES = os.path.join(ROOT, 'fixtures')
+
+HAS_KERAS = importlib.util.find_spec('keras') is not None
+
+
+def frames(n, height=48, width=64):
+    rng = np.random.RandomState(7)
+
+    for _ in range(n):
+        yield rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+
+
+def save_h5(path, layers, weights):
+    '''
+        Saves a Sequential model the way Keras 2.2 does.
+    '''
+    with h5py.File(path, 'w') as fh:
+        fh.attrs['model_config'] = json.dumps(dict(class_name='Sequential', config=layers)).encode('utf8')
+        group = fh.create_group('model_weights')
+        group.attrs['layer_names'] = [layer['config']['name'].encode('utf8') for layer in layers]
+
+        for layer in layers:
+            name = layer['config']['name']
+            layer_weights = weights.get(name, [])
+            names = ['%s/%s:0' % (name, weight) for weight in ['kernel', 'bias'][:len(layer_weights)]]
+
+            group.create_group(name).attrs['weight_names'] = [weight.encode('utf8') for weight in names]
+
+            for weight, array in zip(names, layer_weights):
+                group[name][weight] = array
+
+
+def write_model(path):
+    '''
+        A random model from 96x96 faces to 15 landmarks in [-1, 1], in the
+        format of numpy_runtime.export.
+    '''
+    rng = np.random.RandomState(7)
+    layers = [
+        dict(class_name='Flatten', config=dict(name='flatten_1', batch_input_shape=[None, 96, 96, 1])),
+        dict(class_name='Dense', config=dict(name='dense_1', activation='tanh'))
+    ]
+
+    np.savez(path, **{
+        'config': np.array(json.dumps(dict(layers=layers, precision='float32'))),
+        'dense_1/kernel': rng.randn(96 * 96, 30).astype(np.float32) / 50,
+        'dense_1/bias': rng.randn(30).astype(np.float32) / 10
+    })
+
+
+class Test(TestCase):
+    def test_vendored_copies(self):
+        for module, projects in VENDORED.items():
+            with open(os.path.join(ROOT, module), 'rb') as fh:
+                original = fh.read()
+
+            for project in projects:
+                path = os.path.join(ROOT, '..', project, module)
+
+                if not os.path.exists(path):
+                    continue
+
+                with open(path, 'rb') as fh:
+                    self.assertEqual(
+                        fh.read(),
+                        original,
+                        '%s differs from FacialLandmarksDetection/%s, copy it over' % (path, module)
+                    )
+
+
+    def test_video_writer(self):
+        import imageio
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'video.gif')
+
+            # More frames than the buffer holds, write has to wait for them
+            with VideoWriter(path, queue_size=2) as writer:
+                for frame in frames(10):
+                    writer.write(frame)
+
+            written = imageio.mimread(path)
+
+        self.assertEqual(len(written), 10)
+        self.assertEqual(written[0].shape[:2], (48, 64))
+
+        with self.assertRaises(ValueError):
+            writer.write(next(frames(1)))
+
+
+    def test_video_writer_error(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = VideoWriter(os.path.join(tmp_dir, 'missing', 'video.gif'))
+
+            # The encoder fails to open the file, write or close reports it
+            with self.assertRaises(IOError):
+                for frame in frames(100):
+                    writer.write(frame)
+
+                writer.close()
+
+
+    def test_numpy_runtime(self):
+        layers, weights = read_h5(os.path.join(FIXTURES, 'model.h5'))
+
+        with np.load(os.path.join(FIXTURES, 'model_outputs.npz')) as outputs:
+            x = outputs['inputs']
+
+            # The model up to every layer, so a mismatch points to the layer
+            for i, layer in enumerate(layers):
+                self.assertTrue(
+                    np.allclose(NumpyModel(layers[:i + 1], weights).predict(x), outputs[layer['config']['name']], atol=1e-6),
+                    'output of %s differs from Keras' % layer['config']['name']
+                )
+
+            self.assertTrue(np.allclose(load_model(os.path.join(FIXTURES, 'model.h5')).predict(x, batch_size=3), outputs['dense_1'], atol=1e-6))
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, 'model.npz')
+
+                export(os.path.join(FIXTURES, 'model.h5'), path, 'float32')
+                self.assertTrue(np.allclose(load_model(path).predict(x), outputs['dense_1'], atol=1e-6))
+
+                export(os.path.join(FIXTURES, 'model.h5'), path, 'int8')
+                self.assertTrue(np.allclose(load_model(path).predict(x), outputs['dense_1'], atol=1e-2))
+
+
+    def test_numpy_runtime_layer_configs(self):
+        layers, weights = read_h5(os.path.join(FIXTURES, 'model.h5'))
+
+        with np.load(os.path.join(FIXTURES, 'model_outputs.npz')) as outputs:
+            x = outputs['inputs']
+
+        # Without the biases of two layers, the same as with zero biases
+        no_bias = copy.deepcopy(layers)
+        no_bias_weights = dict(weights)
+        zero_bias_weights = dict(weights)
+
+        for layer in no_bias:
+            name = layer['config']['name']
+
+            if name in ['conv2d_1', 'dense_1']:
+                layer['config']['use_bias'] = False
+                no_bias_weights[name] = weights[name][:1]
+                zero_bias_weights[name] = [weights[name][0], np.zeros_like(weights[name][1])]
+
+        expected = NumpyModel(layers, zero_bias_weights).predict(x)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_h5(os.path.join(tmp_dir, 'model.h5'), no_bias, no_bias_weights)
+            export(os.path.join(tmp_dir, 'model.h5'), os.path.join(tmp_dir, 'model.npz'), 'float32')
+
+            for path in ['model.h5', 'model.npz']:
+                self.assertTrue(np.allclose(load_model(os.path.join(tmp_dir, path)).predict(x), expected, atol=1e-6))
+
+        # Dilated convolutions are refused rather than run undilated
+        dilated = copy.deepcopy(layers)
+        dilated[1]['config']['dilation_rate'] = [2, 2]
+
+        with self.assertRaisesRegex(ValueError, 'dilat'):
+            NumpyModel(dilated, weights)
+
+
+    @skipUnless(HAS_KERAS, 'needs Keras')
+    def test_numpy_runtime_keras(self):
+        from keras.models import load_model as load_keras_model
+
+        x = np.random.RandomState(7).rand(8, 96, 96, 1).astype(np.float32)
+
+        self.assertTrue(np.allclose(
+            load_model(os.path.join(ROOT, 'model.h5')).predict(x),
+            load_keras_model(os.path.join(ROOT, 'model.h5'), compile=False).predict(x),
+            atol=1e-4
+        ))
+
+
+    def test_landmarks_detector(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'model.npz')
+            write_model(path)
+
+            detector = LandmarksDetector(path, os.path.join(ROOT, 'cascades', 'haarcascade_frontalface_default.xml'), batch_size=4)
+            model = load_model(path)
+
+        batch_sizes = []
+        predict = detector._LandmarksDetector__cnn_model.predict
+
+        def counted_predict(rois, batch_size=32):
+            batch_sizes.append(batch_size)
+            return predict(rois, batch_size)
+
+        detector._LandmarksDetector__cnn_model.predict = counted_predict
+
+        # The Haar cascade does not see the synthetic faces, their rectangles,
+        # made taller than wide, are used
+        frames, truth = zip(*synthetic_video(5, height=240, width=320))
+        truth = [rectangles - [0, 0, 15, 0] for rectangles in truth]
+        faces = iter(truth)
+        detector.detect_faces = lambda gray, **kwargs: next(faces)
+
+        detections = detector.detect_batch(frames)
+
+        # The faces of the 5 frames through the CNN 4 at a time
+        self.assertEqual(batch_sizes, [4])
+        self.assertEqual(len(detections), 5)
+
+        # The same as running the faces one by one
+        for frame, rectangles, (found, landmarks) in zip(frames, truth, detections):
+            gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+
+            self.assertEqual(found.tolist(), rectangles.tolist())
+            self.assertEqual(landmarks.shape, (2, 30))
+
+            for (x, y, w, h), face_landmarks in zip(rectangles, landmarks):
+                face = cv2.resize(gray[y:y + h, x:x + w], (96, 96)) / 255.
+                expected = model.predict(face[None, :, :, None])[0] * 48 + 48
+                expected[0::2] = expected[0::2] * w / 96 + x
+                expected[1::2] = expected[1::2] * h / 96 + y
+
+                np.testing.assert_allclose(face_landmarks, expected, rtol=1e-5, atol=1e-3)
+
+        empty, = detector.predict([gray], [np.empty((0, 4), dtype=np.int32)])
+        self.assertEqual(empty.shape, (0, 30))
+
+
+    def test_iou(self):
+        overlaps = iou([(0, 0, 10, 10), (100, 100, 5, 5)], [(5, 0, 10, 10), (0, 0, 10, 10)])
+
+        np.testing.assert_allclose(overlaps, [[50 / 150., 1.], [0., 0.]])
+
+
+    def test_face_tracker(self):
+        import cv2
+
+        tracker = FaceTracker(detect_every=10)
+        truth = []
+
+        def detect_faces(gray):
+            return truth[-1]
+
+        for frame, rectangles in synthetic_video(30, height=240, width=320):
+            truth.append(rectangles)
+            tracked, ids = tracker.update(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), detect_faces)
+
+            # The faces keep their ids and the tracked rectangles follow them
+            self.assertEqual(ids.tolist(), [0, 1])
+            self.assertTrue((np.diag(iou(tracked, rectangles)) > 0.8).all())
+
+        self.assertEqual(tracker.frames, 30)
+        self.assertEqual(tracker.detections, 3)
+
+
+    def test_find_videos(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ['b.mp4', 'a.AVI', 'notes.txt']:
+                open(os.path.join(tmp_dir, name), 'w').close()
+
+            self.assertEqual(
+                find_videos([tmp_dir, 'camera.mov']),
+                [os.path.join(tmp_dir, 'a.AVI'), os.path.join(tmp_dir, 'b.mp4'), 'camera.mov']
+            )
+
+
+    def test_results_writer(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'results.npz')
+
+            with ResultsWriter(path) as results:
+                results.write('a.mp4', 0, boxes=[(0, 0, 10, 10), (5, 5, 10, 10)], labels=[0, 1])
+                results.write('a.mp4', 1, boxes=np.empty((0, 4)), labels=[])
+                results.write('b.mp4', 0, boxes=[(1, 2, 3, 4)], labels=[1])
+
+            with np.load(path) as arrays:
+                self.assertEqual(arrays['videos'].tolist(), ['a.mp4', 'b.mp4'])
+                self.assertEqual(arrays['frames'].tolist(), [2, 1])
+                self.assertEqual(arrays['video'].tolist(), [0, 0, 1])
+                self.assertEqual(arrays['frame'].tolist(), [0, 0, 0])
+                self.assertEqual(arrays['labels'].tolist(), [0, 1, 1])
+                self.assertEqual(arrays['boxes'].shape, (3, 4))
+
+            path = os.path.join(tmp_dir, 'results.jsonl')
+
+            with ResultsWriter(path) as results:
+                results.write('a.mp4', 3, boxes=[(0, 0, 10, 10)])
+
+            with open(path) as fh:
+                self.assertEqual(fh.read(), '{"video": "a.mp4", "frame": 3, "boxes": [[0, 0, 10, 10]]}\n')
+
+        with self.assertRaises(ValueError):
+            ResultsWriter('results.csv')
+
+
+if __name__ == "__main__":
+    main()
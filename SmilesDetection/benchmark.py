@@ -0,0 +1,118 @@
+'''
+    Benchmarks the smile detection stages on synthetic frames, so it runs
+    offline and without a camera or a display.
+
+    Haar cascades will not find faces in synthetic frames, so the cascade is
+    run for its cost only and the later stages are fed the true rectangles
+    of the synthetic faces instead. With --track_every the cascade only runs
+    when the FaceTracker asks for a detection, which shows how many cascade
+    calls tracking saves and how closely the tracked boxes follow the faces.
+'''
+import time
+import argparse
+import numpy as np
+
+from face_tracker import FaceTracker, iou
+from headless import StageTimer, synthetic_video
+from smiles_detector import SmilesDetector, preprocess, annotate
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument(
+        '-c',
+        '--cascade_path',
+        default='haarcascade_frontalface_default.xml',
+        help='path to the face haar cascade'
+    )
+
+    ap.add_argument(
+        '-m',
+        '--model_path',
+        required=True,
+        help='path to a trained CNN smile model, .h5 or .npz exported by numpy_runtime.py'
+    )
+
+    ap.add_argument(
+        '-n',
+        '--num_frames',
+        type=int,
+        default=300,
+        help='number of synthetic frames to process'
+    )
+
+    ap.add_argument(
+        '-f',
+        '--faces',
+        type=int,
+        default=2,
+        help='number of synthetic faces per frame'
+    )
+
+    ap.add_argument(
+        '-t',
+        '--track_every',
+        type=int,
+        default=0,
+        help='only run the face detector every N frames and track the faces in between'
+    )
+
+    args = ap.parse_args()
+
+    detector = SmilesDetector(args.model_path, args.cascade_path)
+    tracker = FaceTracker(detect_every=args.track_every) if args.track_every else None
+    timer = StageTimer()
+    cascade_calls = 0
+    overlaps = []
+
+    # Warm up the model so its one-off setup is not counted
+    detector.classify([np.zeros((300, 300), np.uint8)], [np.array([[0, 0, 100, 100]])])
+
+    started = time.perf_counter()
+
+    for frame, truth in synthetic_video(args.num_frames, args.faces):
+        frame_start = time.perf_counter()
+
+        with timer('preprocessing'):
+            scale = 300 / frame.shape[1]
+            frame, gray = preprocess(frame)
+            truth = np.round(truth * scale).astype(np.int32)
+
+        def detect_faces(gray):
+            global cascade_calls
+            cascade_calls += 1
+            detector.detect_faces(gray)
+
+            return truth
+
+        with timer('detection'):
+            if tracker is None:
+                rectangles = detect_faces(gray)
+            else:
+                rectangles, _ = tracker.update(gray, detect_faces)
+
+        if len(rectangles):
+            overlaps.append(iou(rectangles, truth).max(axis=1).mean())
+
+        with timer('classification'):
+            predictions, = detector.classify([gray], [rectangles])
+
+        with timer('rendering'):
+            annotate(frame.copy(), rectangles, predictions)
+
+        timer.add('total', time.perf_counter() - frame_start)
+
+    elapsed = time.perf_counter() - started
+
+    print('{} frames, {} faces per frame: {:.1f} frames/s overall'.format(
+        args.num_frames,
+        args.faces,
+        args.num_frames / elapsed
+    ))
+    print('Cascade calls: {} ({:.1f}x fewer than frames), mean IoU with the true faces: {:.3f}\n'.format(
+        cascade_calls,
+        args.num_frames / max(cascade_calls, 1),
+        np.mean(overlaps) if overlaps else 0.0
+    ))
+    print(timer.report())
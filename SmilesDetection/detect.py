@@ -1,11 +1,28 @@
-import cv2
-import imageio
-import imutils
+import time
 import argparse
-import numpy as np
 
-from keras.models import load_model
-from keras.preprocessing.image import img_to_array
+
+def detect_serial(detector, camera):
+    from smiles_detector import preprocess, annotate
+
+    i = 0
+
+    while True:
+        _, frame = camera.read()
+
+        if frame is None:
+            break
+
+        frame, _ = preprocess(frame)
+        frame_copy = frame.copy()
+
+        # Detect faces, then predict and label them
+        rectangles, predictions = detector.detect(frame)
+        ids = detector.tracker.ids if detector.tracker else None
+        annotate(frame_copy, rectangles, predictions, ids)
+
+        yield i, frame_copy, rectangles, predictions
+        i += 1
 
 
 if __name__ == '__main__':
@@ -22,7 +39,7 @@ if __name__ == '__main__':
         '-m',
         '--model_path',
         required=True,
-        help='path to a trained CNN smile model'
+        help='path to a trained CNN smile model, .h5 or .npz exported by numpy_runtime.py'
     )
 
     ap.add_argument(
@@ -37,75 +54,182 @@ if __name__ == '__main__':
         help='path to save the output to (optional)'
     )
 
-    args = ap.parse_args()
+    ap.add_argument(
+        '-p',
+        '--pipeline',
+        action='store_true',
+        help='run capture, detection, classification and rendering as separate threaded stages'
+    )
 
-    face_detector = cv2.CascadeClassifier(args.cascade_path)
-    model = load_model(args.model_path)
-    camera = cv2.VideoCapture(0) if 'video_path' not in args else cv2.VideoCapture(args.video_path)
-    output = []
+    ap.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=2,
+        help='number of face detection workers in the pipeline mode'
+    )
 
-    while True:
-        _, frame = camera.read()
+    ap.add_argument(
+        '-b',
+        '--batch_size',
+        type=int,
+        default=16,
+        help='maximum number of frames classified per CNN call in the pipeline mode'
+    )
 
-        if frame is None:
-            break
+    ap.add_argument(
+        '--headless',
+        action='store_true',
+        help='process the videos as fast as possible without displaying them'
+    )
 
-        frame = imutils.resize(frame, width=300)
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        frame_copy = frame.copy()
+    ap.add_argument(
+        '-i',
+        '--inputs',
+        nargs='+',
+        default=[],
+        help='video files and/or directories of videos to process in the headless mode'
+    )
 
-        # Detect faces
-        rectangles = face_detector.detectMultiScale(
-            gray, 
-            scaleFactor=1.1, 
-            minNeighbors=5, 
-            minSize=(30, 30),
-            flags=cv2.CASCADE_SCALE_IMAGE
-        )
-
-        # Extract faces, preprocess, and predict
-        for x, y, w, h in rectangles:
-            roi = gray[y:y + h, x:x + w]
-            roi = cv2.resize(roi, (28, 28))
-            roi = roi.astype(float) / 255.0
-            roi = img_to_array(roi)
-            roi = np.expand_dims(roi, axis=0)
-
-            # Predict and create a label
-            predictions = model.predict(roi)[0]
-            prediction = predictions.argmax()
-            p = 100 * predictions[prediction]
-            label = 'Smiling (%.2f%%)' % p if prediction else 'Not smiling (%.2f%%)' % p
-
-            cv2.putText(
-                frame_copy,
-                label,
-                (x, y - 10),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.45, 
-                (0, 0, 255),
-                2
-            )
+    ap.add_argument(
+        '-r',
+        '--results_path',
+        help='path to save the per-frame boxes and labels to, .jsonl or .npz (optional)'
+    )
 
-            cv2.rectangle(
-                frame_copy,
-                (x, y),
-                (x + w, y + h),
-                (0, 0, 255),
-                2
-            )
+    ap.add_argument(
+        '-t',
+        '--track_every',
+        type=int,
+        default=0,
+        help='only run the face detector every N frames and track the faces in between (optional)'
+    )
+
+    ap.add_argument(
+        '-s',
+        '--smooth',
+        action='store_true',
+        help='reuse and smooth the predictions of tracked faces that have not changed, needs -t'
+    )
 
-        cv2.imshow('Frame', frame_copy)
-        output.append(frame_copy)
+    args = ap.parse_args()
 
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+    if args.track_every and args.pipeline:
+        ap.error('tracking needs the frames in order and cannot be combined with the pipeline mode')
+
+    if args.smooth and not args.track_every:
+        ap.error('-s/--smooth needs the track ids of -t/--track_every')
+
+    # Imported once the arguments are fine, -h and usage errors should not
+    # wait for OpenCV, imutils and the model runtimes
+    import cv2
+    from pipeline import Pipeline
+    from face_tracker import FaceTracker
+    from prediction_cache import PredictionCache
+    from video_writer import VideoWriter
+    from headless import find_videos, ResultsWriter
+    from smiles_detector import SmilesDetector
+
+    if args.headless:
+        sources = find_videos(args.inputs + ([args.video_path] if args.video_path else []))
+
+        if not sources:
+            ap.error('the headless mode needs at least one video, see -v and -i')
+    else:
+        sources = [args.video_path if args.video_path else 0]
+
+    detector = SmilesDetector(args.model_path, args.cascade_path)
+    writer = VideoWriter(args.output_path) if args.output_path else None
+    results = ResultsWriter(args.results_path) if args.results_path else None
+
+    quit = False
+    total_frames = 0
+    started = time.time()
+
+    for source in sources:
+        camera = cv2.VideoCapture(source)
+
+        # Every video starts with fresh tracks
+        if args.track_every:
+            detector.tracker = FaceTracker(detect_every=args.track_every)
+
+        if args.smooth:
+            detector.cache = PredictionCache()
+
+        if args.pipeline:
+            pipeline = Pipeline(
+                detector,
+                num_workers=args.workers,
+                batch_size=args.batch_size
+            )
+            frames = pipeline.run(camera)
+        else:
+            pipeline = None
+            frames = detect_serial(detector, camera)
+
+        for i, frame_copy, rectangles, predictions in frames:
+            total_frames += 1
+
+            if results is not None:
+                tracks = dict(ids=detector.tracker.ids) if detector.tracker else {}
+                results.write(
+                    str(source),
+                    i,
+                    boxes=rectangles,
+                    labels=predictions.argmax(axis=1),
+                    probabilities=predictions,
+                    **tracks
+                )
+
+            if writer is not None:
+                writer.write(frame_copy)
+
+            if pipeline is not None and i and i % 100 == 0:
+                stats = pipeline.stats()
+                print('{:.2f} FPS, queue depths: {}'.format(stats['fps'], stats['queues']))
+
+            if args.headless:
+                continue
+
+            cv2.imshow('Frame', frame_copy)
+
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                quit = True
+                break
+
+        if pipeline is not None:
+            pipeline.stop()
+            stats = pipeline.stats()
+            print('Processed {} frames at {:.2f} FPS'.format(stats['frames'], stats['fps']))
+
+        if detector.tracker is not None:
+            print('Ran the face detector on {} of {} frames'.format(
+                detector.tracker.detections,
+                detector.tracker.frames
+            ))
+
+        if detector.cache is not None:
+            print('Reused {:.1f}% of the smile predictions'.format(100 * detector.cache.hit_rate))
+
+        camera.release()
+
+        if quit:
             break
 
-    if 'output_path' in args:
-        with imageio.get_writer(args.output_path, mode='I') as writer:
-            for frame in output:
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                writer.append_data(frame)
+    if args.headless:
+        elapsed = time.time() - started
+        print('Processed {} frames from {} videos in {:.2f}s ({:.2f} FPS)'.format(
+            total_frames,
+            len(sources),
+            elapsed,
+            total_frames / elapsed if elapsed else 0.0
+        ))
+
+    if results is not None:
+        results.close()
+
+    if writer is not None:
+        writer.close()
 
-    camera.release()
-    cv2.destroyAllWindows()
\ No newline at end of file
+    if not args.headless:
+        cv2.destroyAllWindows()
@@ -0,0 +1,203 @@
+'''
+    Helpers for running the detectors without a display: expanding the
+    input videos, saving per-frame results, generating synthetic videos and
+    timing the processing stages.
+'''
+import os
+import cv2
+import json
+import time
+import numpy as np
+from glob import glob
+from contextlib import contextmanager
+
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.gif')
+
+
+def find_videos(inputs, extensions=VIDEO_EXTENSIONS):
+    '''
+        Expands a list of video files and/or directories into a sorted list
+        of video file paths.
+    '''
+    paths = []
+
+    for path in inputs:
+        if os.path.isdir(path):
+            paths += sorted(
+                p for p in glob(os.path.join(path, '*'))
+                if p.lower().endswith(extensions)
+            )
+        else:
+            paths.append(path)
+
+    return paths
+
+
+class ResultsWriter():
+    '''
+        Saves per-frame detection results either as JSON Lines, written as
+        the frames are processed, or as a single NPZ file on close.
+
+        Every result is a set of per-face arrays (e.g. boxes, labels,
+        landmarks) with one row per face in the frame. In the NPZ file the
+        rows of all frames are concatenated and the 'video' and 'frame'
+        arrays give the video and frame index of every row.
+    '''
+    def __init__(self, path):
+        self.__path = path
+        self.__jsonl = path.endswith('.jsonl')
+
+        if self.__jsonl:
+            self.__file = open(path, 'w')
+        elif path.endswith('.npz'):
+            self.__videos = []
+            self.__frames = []
+            self.__rows = {'video': [], 'frame': []}
+        else:
+            raise ValueError('Results path must end with .jsonl or .npz: %s' % path)
+
+    def write(self, video, frame, **results):
+        if self.__jsonl:
+            record = dict(video=video, frame=frame)
+            record.update((k, np.asarray(v).tolist()) for k, v in results.items())
+            self.__file.write(json.dumps(record) + '\n')
+            return
+
+        if not self.__videos or self.__videos[-1] != video:
+            self.__videos.append(video)
+            self.__frames.append(0)
+
+        self.__frames[-1] += 1
+        faces = None
+
+        for key, value in results.items():
+            value = np.asarray(value)
+            faces = len(value)
+            self.__rows.setdefault(key, []).append(value)
+
+        if faces:
+            self.__rows['video'].append(np.full(faces, len(self.__videos) - 1))
+            self.__rows['frame'].append(np.full(faces, frame))
+
+    def close(self):
+        if self.__jsonl:
+            self.__file.close()
+            return
+
+        arrays = {
+            key: np.concatenate(rows) if rows else np.empty(0)
+            for key, rows in self.__rows.items()
+        }
+
+        np.savez_compressed(
+            self.__path,
+            videos=np.array(self.__videos),
+            frames=np.array(self.__frames),
+            **arrays
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def synthetic_video(n, faces=2, height=480, width=640, seed=42):
+    '''
+        Yields n BGR frames of textured square "faces" moving smoothly over a
+        blurred noise background, together with their true (N, 4) rectangles.
+        Good enough to benchmark every stage offline, though the Haar cascade
+        will not recognise the squares as faces.
+    '''
+    rng = np.random.RandomState(seed)
+
+    background = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    background = cv2.GaussianBlur(background, (0, 0), 8)
+
+    size = min(height, width) // 4
+    patches = [
+        cv2.GaussianBlur(rng.randint(0, 256, (size, size, 3)).astype(np.uint8), (0, 0), 1)
+        for _ in range(faces)
+    ]
+    centres = rng.uniform(size, [width - size, height - size], (faces, 2))
+    phases = rng.uniform(0, 2 * np.pi, faces)
+
+    for i in range(n):
+        frame = background.copy()
+        rectangles = np.empty((faces, 4), dtype=np.int32)
+
+        for j, patch in enumerate(patches):
+            # Slow circular motion, a few pixels per frame
+            angle = 2 * np.pi * i / 120 + phases[j]
+            x = int(centres[j, 0] + size / 2 * np.cos(angle) - size / 2)
+            y = int(centres[j, 1] + size / 2 * np.sin(angle) - size / 2)
+            x = min(max(x, 0), width - size)
+            y = min(max(y, 0), height - size)
+
+            frame[y:y + size, x:x + size] = patch
+            rectangles[j] = (x, y, size, size)
+
+        yield frame, rectangles
+
+
+class StageTimer():
+    '''
+        Collects wall-clock latencies of named processing stages.
+
+        Usage:
+            timer = StageTimer()
+
+            with timer('detection'):
+                ...
+
+            print(timer.summary())
+    '''
+    def __init__(self):
+        self.__latencies = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self.__latencies.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        '''
+            Returns the throughput (calls/s) and p50/p95/p99 latency (ms)
+            of every stage.
+        '''
+        summary = {}
+
+        for stage, latencies in self.__latencies.items():
+            latencies = np.array(latencies) * 1000
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+
+            summary[stage] = dict(
+                calls=len(latencies),
+                fps=1000 * len(latencies) / latencies.sum() if latencies.sum() else float('inf'),
+                p50=p50,
+                p95=p95,
+                p99=p99
+            )
+
+        return summary
+
+    def report(self):
+        lines = ['{:<16}{:>8}{:>12}{:>10}{:>10}{:>10}'.format(
+            'stage', 'calls', 'frames/s', 'p50 ms', 'p95 ms', 'p99 ms'
+        )]
+
+        for stage, s in self.summary().items():
+            lines.append('{:<16}{:>8}{:>12.1f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+                stage, s['calls'], s['fps'], s['p50'], s['p95'], s['p99']
+            ))
+
+        return '\n'.join(lines)
@@ -0,0 +1,234 @@
+'''
+    Multi-stage threaded version of the smile detection loop:
+
+        capture -> face detection (N workers) -> batched smile classification
+                -> rendering -> output
+
+    Stages are joined by bounded queues, so a slow stage applies backpressure
+    to the ones before it instead of letting frames pile up in memory. Frames
+    may be detected out of order by the workers, but are re-ordered before
+    rendering, so the output order always matches the input order.
+'''
+import time
+import queue
+import threading
+from smiles_detector import preprocess, annotate
+
+
+# Marks the end of the stream
+_DONE = object()
+
+
+class Pipeline():
+    def __init__(self,
+        detector,
+        num_workers=2,
+        batch_size=16,
+        queue_size=32,
+        width=300
+    ):
+        '''
+            detector   - a SmilesDetector instance.
+
+            num_workers - number of face detection threads. OpenCV releases
+                          the GIL in detectMultiScale, so these scale with
+                          cores.
+
+            batch_size  - maximum number of frames whose faces are
+                          classified in a single CNN call.
+
+            queue_size  - capacity of every inter-stage queue.
+
+            width       - width every frame is resized to before detection.
+        '''
+        self.__detector = detector
+        self.__num_workers = num_workers
+        self.__batch_size = batch_size
+        self.__width = width
+
+        self.__queues = dict(
+            capture=queue.Queue(queue_size),
+            detection=queue.Queue(queue_size),
+            classification=queue.Queue(queue_size),
+            rendering=queue.Queue(queue_size),
+        )
+
+        self.__stop = threading.Event()
+        self.__threads = []
+        self.__frames = 0
+        self.__started = None
+
+    def __put(self, name, item):
+        # Blocks while the queue is full, but gives up once stopped so that
+        # no thread hangs on a consumer that has gone away
+        while not self.__stop.is_set():
+            try:
+                self.__queues[name].put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def __get(self, name):
+        while not self.__stop.is_set():
+            try:
+                return self.__queues[name].get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return _DONE
+
+    def __capture(self, camera):
+        i = 0
+
+        while not self.__stop.is_set():
+            _, frame = camera.read()
+
+            if frame is None:
+                break
+
+            if not self.__put('capture', (i, frame)):
+                return
+
+            i += 1
+
+        for _ in range(self.__num_workers):
+            self.__put('capture', _DONE)
+
+    def __detect(self):
+        while True:
+            item = self.__get('capture')
+
+            if item is _DONE:
+                self.__put('detection', _DONE)
+                return
+
+            i, frame = item
+            frame, gray = preprocess(frame, self.__width)
+            rectangles = self.__detector.detect_faces(gray)
+
+            if not self.__put('detection', (i, frame, gray, rectangles)):
+                return
+
+    def __classify(self):
+        done = 0
+
+        while done < self.__num_workers:
+            item = self.__get('detection')
+
+            if item is _DONE:
+                done += 1
+                continue
+
+            # Take whatever else is ready, up to a full batch, without waiting
+            batch = [item]
+
+            while len(batch) < self.__batch_size:
+                try:
+                    item = self.__queues['detection'].get_nowait()
+                except queue.Empty:
+                    break
+
+                if item is _DONE:
+                    done += 1
+                    continue
+
+                batch.append(item)
+
+            all_predictions = self.__detector.classify(
+                [gray for _, _, gray, _ in batch],
+                [rectangles for _, _, _, rectangles in batch]
+            )
+
+            for (i, frame, _, rectangles), predictions in zip(batch, all_predictions):
+                if not self.__put('classification', (i, frame, rectangles, predictions)):
+                    return
+
+        self.__put('classification', _DONE)
+
+    def __render(self):
+        pending = {}
+        next_i = 0
+
+        while True:
+            item = self.__get('classification')
+
+            if item is _DONE:
+                break
+
+            i, frame, rectangles, predictions = item
+            pending[i] = (frame, rectangles, predictions)
+
+            # Emit frames strictly in capture order
+            while next_i in pending:
+                frame, rectangles, predictions = pending.pop(next_i)
+                frame = annotate(frame.copy(), rectangles, predictions)
+
+                if not self.__put('rendering', (next_i, frame, rectangles, predictions)):
+                    return
+
+                next_i += 1
+
+        self.__put('rendering', _DONE)
+
+    def run(self, camera):
+        '''
+            Starts all the stages on the given cv2.VideoCapture-like source
+            and yields (frame index, annotated frame, rectangles, predictions)
+            tuples in capture order.
+        '''
+        # Keras builds its predict function lazily, which is not thread-safe;
+        # build it here, on the calling thread, before any stage starts. The
+        # NumPy runtime has nothing to build
+        if hasattr(self.__detector.cnn_model, '_make_predict_function'):
+            self.__detector.cnn_model._make_predict_function()
+
+        self.__stop.clear()
+        self.__started = time.time()
+        self.__frames = 0
+
+        targets = [(self.__capture, (camera,))]
+        targets += [(self.__detect, ())] * self.__num_workers
+        targets += [(self.__classify, ()), (self.__render, ())]
+
+        self.__threads = [
+            threading.Thread(target=target, args=args, daemon=True)
+            for target, args in targets
+        ]
+
+        for thread in self.__threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self.__get('rendering')
+
+                if item is _DONE:
+                    break
+
+                self.__frames += 1
+                yield item
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.__stop.set()
+
+        for thread in self.__threads:
+            thread.join()
+
+        self.__threads = []
+
+    def stats(self):
+        '''
+            Returns the output frame rate so far and the current depth of
+            every inter-stage queue.
+        '''
+        elapsed = time.time() - self.__started if self.__started else 0
+
+        return dict(
+            frames=self.__frames,
+            fps=self.__frames / elapsed if elapsed else 0.0,
+            queues={name: q.qsize() for name, q in self.__queues.items()}
+        )
@@ -0,0 +1,100 @@
+'''
+    Per-face cache of smile predictions. An expression barely changes from one
+    frame to the next, so a tracked face whose ROI still looks the same as
+    when the CNN last saw it reuses that prediction instead of running the
+    CNN again.
+'''
+import numpy as np
+
+
+class PredictionCache():
+    def __init__(self,
+        ttl=30,
+        max_age=15,
+        max_delta=0.04,
+        alpha=0.5
+    ):
+        '''
+            ttl       - entries of faces that have not been seen for ttl frames
+                        are evicted.
+
+            max_age   - a cached prediction is reused for at most max_age
+                        frames, after which the CNN is run again regardless.
+
+            max_delta - maximum mean absolute difference between the [0, 1]
+                        scaled ROI and the ROI the cached prediction was made
+                        on for it to be reused.
+
+            alpha     - weight of a new prediction in the exponential moving
+                        average of the class probabilities. Lower values give
+                        steadier labels.
+        '''
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_delta = max_delta
+        self.alpha = alpha
+
+        self.hits = 0
+        self.misses = 0
+
+        self.__frame = 0
+        self.__entries = {}
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+
+        return self.hits / total if total else 0.0
+
+    def get(self, key, roi):
+        '''
+            Returns the smoothed probabilities cached for key if they are still
+            valid for the roi, otherwise None.
+        '''
+        entry = self.__entries.get(key)
+
+        if entry is not None:
+            entry['seen'] = self.__frame
+
+            fresh = self.__frame - entry['predicted'] < self.max_age
+            if fresh and np.abs(roi - entry['roi']).mean() <= self.max_delta:
+                self.hits += 1
+                return entry['probabilities']
+
+        self.misses += 1
+
+        return None
+
+    def put(self, key, roi, probabilities):
+        '''
+            Stores a new CNN prediction made on the roi and returns it blended
+            into the moving average of the face's probabilities.
+        '''
+        entry = self.__entries.get(key)
+
+        if entry is not None:
+            probabilities = self.alpha * probabilities + (1 - self.alpha) * entry['probabilities']
+
+        self.__entries[key] = dict(
+            roi=roi.copy(),
+            probabilities=probabilities,
+            predicted=self.__frame,
+            seen=self.__frame
+        )
+
+        return probabilities
+
+    def tick(self):
+        '''
+            Moves on to the next frame and evicts the faces that are gone.
+        '''
+        self.__frame += 1
+
+        for key in [
+            key for key, entry in self.__entries.items()
+            if self.__frame - entry['seen'] > self.ttl
+        ]:
+            del self.__entries[key]
@@ -0,0 +1,178 @@
+import cv2
+import imutils
+import threading
+import numpy as np
+
+import numpy_runtime
+
+
+def preprocess(frame, width=300):
+    '''
+        Resizes a raw frame to the working resolution and converts it to
+        grayscale. Returns the resized frame and its grayscale version.
+    '''
+    frame = imutils.resize(frame, width=width)
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    return frame, gray
+
+
+def label(predictions):
+    prediction = predictions.argmax()
+    p = 100 * predictions[prediction]
+
+    return 'Smiling (%.2f%%)' % p if prediction else 'Not smiling (%.2f%%)' % p
+
+
+def annotate(frame, rectangles, all_predictions, ids=None):
+    if ids is None:
+        ids = [None] * len(rectangles)
+
+    for (x, y, w, h), predictions, i in zip(rectangles, all_predictions, ids):
+        text = label(predictions)
+
+        if i is not None:
+            text = '#%d %s' % (i, text)
+
+        cv2.putText(
+            frame,
+            text,
+            (x, y - 10),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.45,
+            (0, 0, 255),
+            2
+        )
+
+        cv2.rectangle(
+            frame,
+            (x, y),
+            (x + w, y + h),
+            (0, 0, 255),
+            2
+        )
+
+    return frame
+
+
+class SmilesDetector():
+    def __init__(self, cnn_model_path, face_cascade_path, tracker=None, cache=None):
+        '''
+            cnn_model_path - a Keras model (.h5), or a model exported by
+                             numpy_runtime.py (.npz), which runs without Keras.
+
+            tracker - optional FaceTracker, used by detect() to skip running
+                      the face detector on most frames.
+
+            cache   - optional PredictionCache, used by detect() together with
+                      the tracker to skip classifying faces that have not
+                      changed and to smooth their labels over time.
+        '''
+        if cnn_model_path.endswith('.npz'):
+            self.__cnn_model = numpy_runtime.load_model(cnn_model_path)
+        else:
+            from keras.models import load_model
+            self.__cnn_model = load_model(cnn_model_path)
+        self.__face_cascade_path = face_cascade_path
+        self.tracker = tracker
+        self.cache = cache
+
+        # Haar cascades are not safe to share between threads, so every
+        # thread that detects faces lazily gets its own
+        self.__local = threading.local()
+
+    @property
+    def cnn_model(self):
+        return self.__cnn_model
+
+    def detect_faces(self,
+        gray,
+        scale_factor=1.1,
+        minNeighbors=5,
+        minSize=(30, 30)
+    ):
+        '''
+            Returns an (N, 4) array of face rectangles found in the gray image.
+        '''
+        if not hasattr(self.__local, 'face_detector'):
+            self.__local.face_detector = cv2.CascadeClassifier(self.__face_cascade_path)
+
+        rectangles = self.__local.face_detector.detectMultiScale(
+            gray,
+            scaleFactor=scale_factor,
+            minNeighbors=minNeighbors,
+            minSize=minSize,
+            flags=cv2.CASCADE_SCALE_IMAGE
+        )
+
+        # detectMultiScale returns an empty tuple when nothing is found
+        return np.asarray(rectangles, dtype=np.int32).reshape(-1, 4)
+
+    def find_faces(self, gray):
+        '''
+            Same as detect_faces, but goes through the tracker if there is one,
+            in which case the frames must be passed in in order. Returns the
+            rectangles and their track ids, which are None without a tracker.
+        '''
+        if self.tracker is None:
+            return self.detect_faces(gray), None
+
+        return self.tracker.update(gray, self.detect_faces)
+
+    def classify(self, grays, all_rectangles, all_ids=None):
+        '''
+            Classifies the faces of all the given frames in a single forward
+            pass. Returns the class probabilities split back per frame.
+
+            When the track ids of the faces are given and there is a cache,
+            only the faces without a valid cached prediction go through the
+            CNN and the returned probabilities are smoothed per track.
+        '''
+        counts = [len(rectangles) for rectangles in all_rectangles]
+        total = sum(counts)
+
+        if not total:
+            outputs = self.__cnn_model.output_shape[-1]
+            return [np.empty((0, outputs), dtype=np.float32) for _ in counts]
+
+        rois = np.empty((total, 28, 28, 1), dtype=np.float32)
+        i = 0
+
+        for gray, rectangles in zip(grays, all_rectangles):
+            for x, y, w, h in rectangles:
+                roi = cv2.resize(gray[y:y + h, x:x + w], (28, 28))
+                np.multiply(roi, 1 / 255.0, out=rois[i, ..., 0], casting='unsafe')
+                i += 1
+
+        if self.cache is None or all_ids is None:
+            predictions = self.__cnn_model.predict(rois, batch_size=total)
+        else:
+            predictions = self.__classify_cached(rois, np.concatenate(all_ids))
+
+        return np.split(predictions, np.cumsum(counts)[:-1])
+
+    def __classify_cached(self, rois, ids):
+        predictions = [self.cache.get(key, roi) for key, roi in zip(ids, rois)]
+        misses = [i for i, p in enumerate(predictions) if p is None]
+
+        if misses:
+            new = self.__cnn_model.predict(rois[misses], batch_size=len(misses))
+
+            for i, p in zip(misses, new):
+                predictions[i] = self.cache.put(ids[i], rois[i], p)
+
+        return np.array(predictions)
+
+    def detect(self, frame):
+        '''
+            Detects and classifies the faces in a single (already resized)
+            frame. Returns the rectangles and the class probabilities.
+        '''
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        rectangles, ids = self.find_faces(gray)
+        predictions, = self.classify([gray], [rectangles], None if ids is None else [ids])
+
+        if self.cache is not None:
+            self.cache.tick()
+
+        return rectangles, predictions
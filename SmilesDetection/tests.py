@@ -0,0 +1,235 @@
+'''
+    Tests of the smile detection pipeline and prediction cache. The shared
+    modules copied from FacialLandmarksDetection are tested there.
+
+        python -m unittest tests
+'''
+import os
+import json
+import time
+import tempfile
+import threading
+import numpy as np
+from unittest import TestCase, main
+
+from pipeline import Pipeline
+from headless import synthetic_video
+from prediction_cache import PredictionCache
+from smiles_detector import preprocess, SmilesDetector
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class Camera():
+    '''
+        cv2.VideoCapture-like source of synthetic frames, n of them or
+        endless, with the index of every frame written into its top left
+        corner, where it survives the resizing.
+    '''
+    def __init__(self, n=None):
+        self.frames = synthetic_video(10 ** 9 if n is None else n, faces=1, seed=7)
+        self.reads = 0
+
+    def read(self):
+        frame, _ = next(self.frames, (None, None))
+
+        if frame is None:
+            return False, None
+
+        frame[:40, :40] = self.reads % 256
+        self.reads += 1
+
+        return True, frame
+
+
+class FakeDetector():
+    '''
+        Finds one face per frame, where the frame index says, after a random
+        delay so that the workers finish out of order, and classifies it with
+        the index as the smiling probability.
+    '''
+    cnn_model = None
+
+    def __init__(self):
+        self.rng = np.random.RandomState(7)
+        self.lock = threading.Lock()
+        self.batch_sizes = []
+
+    def detect_faces(self, gray):
+        with self.lock:
+            delay = self.rng.uniform(0, 0.005)
+
+        time.sleep(delay)
+        i = int(gray[2, 2])
+
+        return np.array([[i % 50, 10, 20, 20]], dtype=np.int32)
+
+    def classify(self, grays, all_rectangles):
+        self.batch_sizes.append(len(grays))
+
+        return [
+            np.array([[1 - gray[2, 2] / 255., gray[2, 2] / 255.]] * len(rectangles))
+            for gray, rectangles in zip(grays, all_rectangles)
+        ]
+
+
+def write_model(path):
+    '''
+        A model in the format of numpy_runtime.export whose smiling
+        probability grows with the brightness of the face.
+    '''
+    layers = [
+        dict(class_name='Flatten', config=dict(name='flatten_1', batch_input_shape=[None, 28, 28, 1])),
+        dict(class_name='Dense', config=dict(name='dense_1', activation='softmax'))
+    ]
+    kernel = np.zeros((28 * 28, 2), dtype=np.float32)
+    kernel[:, 1] = 10. / kernel.shape[0]
+
+    np.savez(path, **{
+        'config': np.array(json.dumps(dict(layers=layers, precision='float32'))),
+        'dense_1/kernel': kernel,
+        'dense_1/bias': np.array([0., -5.], dtype=np.float32)
+    })
+
+
+class Test(TestCase):
+    def test_pipeline(self):
+        for num_workers in [1, 4]:
+            detector = FakeDetector()
+            pipeline = Pipeline(detector, num_workers=num_workers, batch_size=8, queue_size=4)
+            threads = threading.active_count()
+
+            self.assertEqual(pipeline.stats()['frames'], 0)
+
+            output = list(pipeline.run(Camera(60)))
+
+            # Every frame, in capture order, with its own faces and predictions
+            self.assertEqual([i for i, _, _, _ in output], list(range(60)))
+
+            for i, frame, rectangles, predictions in output:
+                self.assertEqual(frame.shape, preprocess(np.zeros((480, 640, 3), dtype=np.uint8))[0].shape)
+                self.assertEqual(rectangles.tolist(), [[i % 50, 10, 20, 20]])
+                np.testing.assert_allclose(predictions, [[1 - i / 255., i / 255.]])
+
+            self.assertTrue(max(detector.batch_sizes) <= 8)
+            self.assertEqual(sum(detector.batch_sizes), 60)
+
+            stats = pipeline.stats()
+            self.assertEqual(stats['frames'], 60)
+            self.assertTrue(stats['fps'] > 0)
+            self.assertEqual(sorted(stats['queues']), ['capture', 'classification', 'detection', 'rendering'])
+
+            # Every stage has finished
+            self.assertEqual(threading.active_count(), threads)
+
+
+    def test_pipeline_early_stop(self):
+        for num_workers in [1, 4]:
+            camera = Camera()
+            pipeline = Pipeline(FakeDetector(), num_workers=num_workers, batch_size=8, queue_size=4)
+            threads = threading.active_count()
+            frames = pipeline.run(camera)
+
+            self.assertEqual([next(frames)[0] for _ in range(5)], list(range(5)))
+
+            # Closing the output stops every stage, however full the queues
+            frames.close()
+
+            self.assertEqual(threading.active_count(), threads)
+            self.assertEqual(pipeline.stats()['frames'], 5)
+
+            # The bounded queues kept the camera from running far ahead: the
+            # frames output, in the 4 queues and in the hands of the stages
+            reads = camera.reads
+            self.assertTrue(reads <= 5 + 4 * 4 + 1 + num_workers + 8 + 1)
+
+            time.sleep(0.05)
+            self.assertEqual(camera.reads, reads)
+
+
+    def test_prediction_cache(self):
+        cache = PredictionCache(ttl=3, max_age=4, max_delta=0.1, alpha=0.25)
+        roi = np.full((28, 28, 1), 0.5, dtype=np.float32)
+        p = np.array([0.8, 0.2])
+
+        self.assertIsNone(cache.get('a', roi))
+        self.assertTrue(np.array_equal(cache.put('a', roi, p), p))
+
+        # Reused while the roi changes by at most max_delta on average
+        self.assertIs(cache.get('a', roi + 0.09), cache.get('a', roi))
+        self.assertIsNone(cache.get('a', roi + 0.2))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(cache.hit_rate, 0.5)
+
+        # New predictions are blended into the moving average
+        np.testing.assert_allclose(cache.put('a', roi, np.array([0., 1.])), [0.6, 0.4])
+        np.testing.assert_allclose(cache.get('a', roi), [0.6, 0.4])
+
+        # Predicted max_age frames ago, however alike the roi
+        for _ in range(3):
+            cache.tick()
+            self.assertIsNotNone(cache.get('a', roi))
+
+        cache.tick()
+        self.assertIsNone(cache.get('a', roi))
+
+        # Evicted ttl frames after last seen, while a face seen since stays
+        cache.put('b', roi, p)
+
+        for _ in range(3):
+            cache.tick()
+            cache.get('b', roi)
+
+        self.assertEqual(len(cache), 2)
+        cache.tick()
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.get('a', roi))
+
+
+    def test_classify_cached(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_model(os.path.join(tmp_dir, 'model.npz'))
+            detector = SmilesDetector(
+                os.path.join(tmp_dir, 'model.npz'),
+                os.path.join(ROOT, 'haarcascade_frontalface_default.xml'),
+                cache=PredictionCache(alpha=0.5)
+            )
+
+        predicted = []
+        predict = detector.cnn_model.predict
+
+        def counted_predict(rois, batch_size=32):
+            predicted.append(len(rois))
+            return predict(rois, batch_size)
+
+        detector.cnn_model.predict = counted_predict
+
+        gray = np.full((100, 200), 50, dtype=np.uint8)
+        gray[:, 100:] = 200
+        rectangles = np.array([[10, 10, 50, 50], [110, 10, 50, 50]])
+
+        # The faces are classified once, then reused while they look the same
+        first, = detector.classify([gray], [rectangles], [[0, 1]])
+        detector.cache.tick()
+        second, = detector.classify([gray], [rectangles], [[0, 1]])
+        uncached, = detector.classify([gray], [rectangles])
+
+        self.assertEqual(predicted, [2, 2])
+        np.testing.assert_allclose(first, uncached, atol=1e-6)
+        np.testing.assert_allclose(second, first)
+        self.assertTrue(first[1, 1] > first[0, 1])
+
+        # Only the face that changed goes through the model again, its
+        # prediction blended with the cached one
+        gray[:, :100] = 200
+        third, = detector.classify([gray], [rectangles], [[0, 1]])
+
+        self.assertEqual(predicted, [2, 2, 1])
+        np.testing.assert_allclose(third[0], (first[0] + first[1]) / 2, atol=1e-6)
+        np.testing.assert_allclose(third[1], first[1])
+        self.assertEqual((detector.cache.hits, detector.cache.misses), (3, 3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import cv2
+import queue
+import threading
+
+
+class VideoWriter():
+    '''
+        Streams BGR frames to a video file as they are produced.
+
+        Frames are encoded on a background thread. The buffer between the
+        caller and the encoder is bounded, so when encoding falls behind
+        write() blocks instead of growing the memory usage, which therefore
+        stays constant regardless of the length of the video.
+
+        Usage:
+            with VideoWriter('output.mp4') as writer:
+                for frame in frames:
+                    writer.write(frame)
+    '''
+    def __init__(self, path, queue_size=32, **kwargs):
+        '''
+            path       - path to the output file, the format is inferred by
+                         imageio from the extension.
+
+            queue_size - maximum number of frames waiting to be encoded.
+
+            kwargs     - passed on to imageio.get_writer, e.g. fps.
+        '''
+        self.__queue = queue.Queue(queue_size)
+        self.__error = None
+        self.__closed = False
+
+        self.__thread = threading.Thread(
+            target=self.__encode,
+            args=(path, kwargs),
+            daemon=True
+        )
+        self.__thread.start()
+
+    def __encode(self, path, kwargs):
+        try:
+            # Only imported by the encoding thread, scripts that never write a
+            # video do not load imageio and its plugins
+            import imageio
+
+            with imageio.get_writer(path, mode='I', **kwargs) as writer:
+                while True:
+                    frame = self.__queue.get()
+
+                    if frame is None:
+                        break
+
+                    writer.append_data(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        except BaseException as e:
+            self.__error = e
+
+    def __raise_error(self):
+        if self.__error is not None:
+            raise IOError('Failed to write the video: {}'.format(self.__error))
+
+    def write(self, frame):
+        '''
+            Queues a BGR frame for encoding, blocking while the buffer is full.
+            The frame must not be modified after it has been passed in.
+        '''
+        if self.__closed:
+            raise ValueError('write to a closed VideoWriter')
+
+        while True:
+            self.__raise_error()
+
+            try:
+                self.__queue.put(frame, timeout=0.1)
+                return
+            except queue.Full:
+                # The encoder may have died while the queue was full
+                if not self.__thread.is_alive():
+                    self.__raise_error()
+
+    def close(self):
+        '''
+            Flushes the remaining frames and finalises the file.
+        '''
+        if self.__closed:
+            return
+
+        self.__closed = True
+
+        while self.__thread.is_alive():
+            try:
+                self.__queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+
+        self.__thread.join()
+        self.__raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
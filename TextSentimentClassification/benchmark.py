@@ -0,0 +1,528 @@
+'''
+    Benchmarks of the text sentiment classification pipeline. Every stage has
+    its own subcommand, see python benchmark.py -h.
+
+    The IMDB movie reviews are used when --root points to the extracted
+    aclImdb directory, otherwise synthetic reviews are generated so that the
+    benchmarks also run offline.
+'''
+import os
+import time
+import random
+import tempfile
+import argparse
+import glob as gb
+from multiprocessing import cpu_count
+
+from preprocessing import (
+    stemmer,
+    lemmatizer,
+    tokenize,
+    tokenize_n_stem,
+    tokenize_n_lemmatize,
+    tokenize_corpus,
+    read_reviews,
+    Tokenizer,
+    LRUMemo,
+    LABELS
+)
+
+
+WORDS = '''
+    the a and of to is in it this that was as with for but film movie one
+    not you are his have he be on all at by an who they from so like her or
+    just about out if has what some good can more when very up no time even
+    she my which would story really only see their had were me well than we
+    much bad been get will do also into people other great first because how
+    him most don't made its then way make them too could any movies after
+    think characters watch films two many being seen character never plot
+    acting best did love little where life know ever man does here better
+    end still over off these say scene why while scenes such something go
+    through should back i'm those real watching now though doesn't years
+    running runners actors thought funny director worst awful brilliant
+'''.split()
+
+EXTRAS = ['<br /><br />', ':)', ':(', ';-)', ':D', '=P', '!', '?', '...', ',', '1/10', '10/10']
+
+
+def synthetic_reviews(n, seed=42):
+    '''
+        Generates n IMDB-like reviews of a few sentences each, with the HTML
+        line breaks, emoticons and punctuation of the real ones.
+    '''
+    rng = random.Random(seed)
+    reviews = []
+
+    for _ in range(n):
+        sentences = []
+
+        for _ in range(rng.randint(3, 15)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(5, 25))]
+
+            for _ in range(rng.randint(0, 2)):
+                words.insert(rng.randrange(len(words)), rng.choice(EXTRAS))
+
+            words[0] = words[0].capitalize()
+            sentences.append(' '.join(words) + rng.choice(['.', '!', '?']))
+
+        reviews.append(' '.join(sentences))
+
+    return reviews
+
+
+def synthetic_dataset(n, seed=42):
+    '''
+        Synthetic reviews with a sentiment each, told apart by a few words
+        that are more common in the reviews of one sentiment.
+    '''
+    rng = random.Random(seed)
+    cues = [['awful', 'worst', 'boring', ':('], ['brilliant', 'best', 'funny', ':)']]
+    texts, labels = [], []
+
+    for review in synthetic_reviews(n, seed):
+        label = rng.randint(0, 1)
+        words = review.split()
+
+        for _ in range(3):
+            words.insert(rng.randrange(len(words)), rng.choice(cues[label]))
+
+        texts.append(' '.join(words))
+        labels.append(label)
+
+    return texts, labels
+
+
+def load_reviews(root, n, seed=42):
+    '''
+        Reads a random sample of n reviews from the aclImdb directory at root.
+    '''
+    paths = sorted(gb.glob(os.path.join(root, '*', '*', '*.txt')))
+    paths = random.Random(seed).sample(paths, min(n, len(paths)))
+    reviews = []
+
+    for path in paths:
+        with open(path, 'r', encoding='utf8') as file:
+            reviews.append(file.read())
+
+    return reviews
+
+
+def timed(fun, *args):
+    started = time.perf_counter()
+    result = fun(*args)
+
+    return result, time.perf_counter() - started
+
+
+def reviews(args):
+    if args.root:
+        return load_reviews(args.root, args.num_texts)
+
+    return synthetic_reviews(args.num_texts)
+
+
+def benchmark_tokenize(args):
+    texts = reviews(args)
+
+    # Both sides memoize, the fast one in a memo of its own that starts as
+    # cold as memoized_stem and memoized_lemmatize
+    modes = {
+        'tokenize': (tokenize, Tokenizer()),
+        'stem': (tokenize_n_stem, Tokenizer(LRUMemo(stemmer.stem))),
+        'lemmatize': (tokenize_n_lemmatize, Tokenizer(LRUMemo(lemmatizer.lemmatize)))
+    }
+
+    print('{} texts, {} characters on average\n'.format(
+        len(texts),
+        sum(map(len, texts)) // max(len(texts), 1)
+    ))
+    print('{:<12}{:>16}{:>16}{:>10}{:>12}'.format(
+        'mode', 'legacy texts/s', 'fast texts/s', 'speedup', 'identical'
+    ))
+
+    for mode in args.modes:
+        legacy, fast = modes[mode]
+
+        expected, legacy_time = timed(lambda: [legacy(text) for text in texts])
+        actual, fast_time = timed(fast.tokenize_many, texts)
+
+        print('{:<12}{:>16.1f}{:>16.1f}{:>9.2f}x{:>12}'.format(
+            mode,
+            len(texts) / legacy_time,
+            len(texts) / fast_time,
+            legacy_time / fast_time,
+            str(actual == expected)
+        ))
+
+
+def benchmark_corpus(args):
+    texts = reviews(args)
+
+    print('{} texts, mode {}, chunks of {}\n'.format(len(texts), args.mode, args.chunksize))
+    print('{:>8}{:>12}{:>10}{:>12}'.format('n_jobs', 'texts/s', 'speedup', 'efficiency'))
+
+    baseline = None
+
+    for n_jobs in args.n_jobs:
+        _, elapsed = timed(
+            lambda: list(tokenize_corpus(texts, args.mode, n_jobs, args.chunksize))
+        )
+
+        baseline = baseline or elapsed * n_jobs
+
+        print('{:>8}{:>12.1f}{:>9.2f}x{:>11.0f}%'.format(
+            n_jobs,
+            len(texts) / elapsed,
+            baseline / elapsed,
+            100 * baseline / elapsed / n_jobs
+        ))
+
+
+def benchmark_memo(args):
+    fun = {'stem': stemmer.stem, 'lemmatize': lemmatizer.lemmatize}[args.mode]
+    tokens = [token for tokens in Tokenizer().tokenize_many(reviews(args)) for token in tokens]
+    memo = LRUMemo(fun, args.maxsize)
+
+    expected, plain_time = timed(lambda: [fun(token) for token in tokens])
+    actual, memo_time = timed(lambda: [memo(token) for token in tokens])
+
+    print('{} tokens, {} distinct, mode {}\n'.format(len(tokens), len(set(tokens)), args.mode))
+    print('{:<10}{:>14}{:>10}{:>10}{:>12}'.format('', 'tokens/s', 'speedup', 'hit rate', 'identical'))
+    print('{:<10}{:>14.0f}'.format('plain', len(tokens) / plain_time))
+    print('{:<10}{:>14.0f}{:>9.2f}x{:>9.1f}%{:>12}'.format(
+        'cold memo',
+        len(tokens) / memo_time,
+        plain_time / memo_time,
+        100 * memo.hit_rate,
+        str(actual == expected)
+    ))
+
+    # A memo loaded from the last run starts hot
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'memo.json')
+
+        _, save_time = timed(memo.save, path)
+        warm = LRUMemo(fun, args.maxsize)
+        _, load_time = timed(warm.load, path)
+
+    actual, warm_time = timed(lambda: [warm(token) for token in tokens])
+
+    print('{:<10}{:>14.0f}{:>9.2f}x{:>9.1f}%{:>12}'.format(
+        'warm memo',
+        len(tokens) / warm_time,
+        plain_time / warm_time,
+        100 * warm.hit_rate,
+        str(actual == expected)
+    ))
+    print('\nSaved {} words in {:.3f}s, loaded them in {:.3f}s'.format(len(memo), save_time, load_time))
+
+
+def write_synthetic_dataset(root, n):
+    '''
+        Writes n synthetic reviews to an aclImdb-like directory tree at root.
+    '''
+    for i, review in enumerate(synthetic_reviews(n)):
+        subset = ['train', 'test'][i % 2]
+        label = list(LABELS)[i // 2 % 2]
+        directory = os.path.join(root, subset, label)
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(os.path.join(directory, '%d_7.txt' % i), 'w', encoding='utf8') as file:
+            file.write(review)
+
+
+def benchmark_load(args):
+    def serial(root):
+        # The loop the original preprocess used
+        for subset in ['train', 'test']:
+            for label in LABELS:
+                for path in gb.glob(os.path.join(root, subset, label, '*')):
+                    with open(path, 'r', encoding='utf8') as file:
+                        file.read()
+
+    def parallel(root, **kwargs):
+        return [read_reviews(root, subset, args.n_jobs, **kwargs) for subset in ['train', 'test']]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = args.root
+
+        if not root:
+            root = os.path.join(tmp_dir, 'aclImdb')
+            write_synthetic_dataset(root, args.num_texts)
+
+        _, serial_time = timed(serial, root)
+        expected, threaded_time = timed(lambda: parallel(root, cache=False))
+        _, caching_time = timed(lambda: parallel(root, cache_dir=tmp_dir))
+        actual, cached_time = timed(lambda: parallel(root, cache_dir=tmp_dir))
+
+        cache_size = sum(
+            os.path.getsize(os.path.join(tmp_dir, '%s_cache.npz' % subset)) for subset in ['train', 'test']
+        )
+
+    print('{} reviews, {} threads, {:.1f} MB cache\n'.format(
+        sum(map(len, expected)),
+        args.n_jobs,
+        cache_size / 2 ** 20
+    ))
+    print('{:<24}{:>10}{:>10}'.format('', 'seconds', 'speedup'))
+
+    for name, elapsed in [
+        ('serial', serial_time),
+        ('threaded', threaded_time),
+        ('threaded, saving cache', caching_time),
+        ('from cache', cached_time)
+    ]:
+        print('{:<24}{:>10.3f}{:>9.2f}x'.format(name, elapsed, serial_time / elapsed))
+
+    print('\nIdentical: {}'.format(all(a.equals(e) for a, e in zip(actual, expected))))
+
+
+def benchmark_keras(args):
+    # Keras takes a while to import, so only the subcommand that needs it does
+    import numpy as np
+    from features import HashedFeatures
+    from custom_keras_wrapper import KerasClassifier
+
+    texts, labels = synthetic_dataset(args.num_texts)
+    X = HashedFeatures('stem', args.n_features, (1, 1)).transform(texts)
+    y = np.eye(2)[labels]
+
+    n_train = int(0.8 * len(texts))
+
+    configurations = [
+        ('old defaults', dict(batch_size=1, epochs=args.epochs, validation_split=0, patience=None)),
+        ('new defaults', dict())
+    ]
+
+    print('{} reviews, {} hashed features\n'.format(len(texts), args.n_features))
+    print('{:<14}{:>8}{:>12}{:>10}{:>12}'.format('', 'epochs', 'seconds', 'speedup', 'accuracy'))
+
+    baseline = None
+
+    for name, params in configurations:
+        classifier = KerasClassifier(**params)
+        _, elapsed = timed(classifier.fit, X[:n_train], y[:n_train])
+
+        baseline = baseline or elapsed
+
+        print('{:<14}{:>8}{:>12.1f}{:>9.2f}x{:>11.1f}%'.format(
+            name,
+            len(classifier.model.history.epoch),
+            elapsed,
+            baseline / elapsed,
+            100 * classifier.score(X[n_train:], y[n_train:])
+        ))
+
+
+def benchmark_bootstrap(args):
+    # validation pulls in matplotlib, so only the subcommand that needs it does
+    import numpy as np
+    from sklearn import metrics
+    from validation import bootstrap_scores
+
+    rng = np.random.RandomState(7)
+    y = rng.randint(0, 2, args.num_samples)
+    scores = np.clip(0.3 * y + 0.7 * rng.rand(args.num_samples), 0, 1)
+
+    def loop(n_resamples):
+        resampled = {'accuracy': [], 'f1': [], 'auc': []}
+
+        for _ in range(n_resamples):
+            rows = rng.randint(0, len(y), len(y))
+            resampled['accuracy'].append(metrics.accuracy_score(y[rows], scores[rows] >= 0.5))
+            resampled['f1'].append(metrics.f1_score(y[rows], scores[rows] >= 0.5))
+            resampled['auc'].append(metrics.roc_auc_score(y[rows], scores[rows]))
+
+        return resampled
+
+    # The loop is far too slow to run in full, its time is extrapolated
+    looped, loop_time = timed(loop, args.loop_resamples)
+    loop_time *= args.n_resamples / args.loop_resamples
+    results, elapsed = timed(bootstrap_scores, y, scores, 0.5, args.n_resamples)
+
+    print('{} samples, {} resamples\n'.format(args.num_samples, args.n_resamples))
+    print('{:<10}{:>12}{:>12}'.format('', 'seconds', 'speedup'))
+    print('{:<10}{:>12.2f}{:>12}'.format('loop', loop_time, '(estimated)'))
+    print('{:<10}{:>12.2f}{:>11.0f}x\n'.format('vectorized', elapsed, loop_time / elapsed))
+
+    print('{:<10}{:>10}{:>18}{:>12}'.format('', 'estimate', 'interval', 'loop std'))
+
+    for metric, result in results.items():
+        print('{:<10}{:>10.4f}{:>18}{:>12.4f}'.format(
+            metric,
+            result['estimate'],
+            '{:.4f}-{:.4f}'.format(result['low'], result['high']),
+            np.std(looped[metric])
+        ))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    subparsers = ap.add_subparsers(dest='command')
+    subparsers.required = True
+
+    data_parser = argparse.ArgumentParser(add_help=False)
+
+    data_parser.add_argument(
+        '-r',
+        '--root',
+        help='path to the aclImdb directory (optional, synthetic reviews are used otherwise)'
+    )
+
+    data_parser.add_argument(
+        '-n',
+        '--num_texts',
+        type=int,
+        default=2000,
+        help='number of reviews to use'
+    )
+
+    tokenize_parser = subparsers.add_parser(
+        'tokenize',
+        parents=[data_parser],
+        help='compare the Tokenizer with the tokenize functions'
+    )
+
+    tokenize_parser.add_argument(
+        '-m',
+        '--modes',
+        nargs='+',
+        choices=['tokenize', 'stem', 'lemmatize'],
+        default=['tokenize', 'stem', 'lemmatize'],
+        help='which of the tokenize functions to compare'
+    )
+
+    tokenize_parser.set_defaults(func=benchmark_tokenize)
+
+    corpus_parser = subparsers.add_parser(
+        'corpus',
+        parents=[data_parser],
+        help='measure how tokenize_corpus scales with the number of processes'
+    )
+
+    corpus_parser.add_argument(
+        '-m',
+        '--mode',
+        choices=['tokenize', 'stem', 'lemmatize'],
+        default='stem',
+        help='which of the tokenize functions to run'
+    )
+
+    corpus_parser.add_argument(
+        '-j',
+        '--n_jobs',
+        type=int,
+        nargs='+',
+        default=sorted({1, 2, 4, 8, 16, 32, cpu_count()} & set(range(1, cpu_count() + 1))),
+        help='numbers of processes to try, the first one is the baseline'
+    )
+
+    corpus_parser.add_argument(
+        '-c',
+        '--chunksize',
+        type=int,
+        default=256,
+        help='number of texts sent to a process at a time'
+    )
+
+    corpus_parser.set_defaults(func=benchmark_corpus)
+
+    memo_parser = subparsers.add_parser(
+        'memo',
+        parents=[data_parser],
+        help='compare stemming or lemmatizing with and without an LRUMemo'
+    )
+
+    memo_parser.add_argument(
+        '-m',
+        '--mode',
+        choices=['stem', 'lemmatize'],
+        default='stem',
+        help='which normalisation to memoize'
+    )
+
+    memo_parser.add_argument(
+        '-s',
+        '--maxsize',
+        type=int,
+        default=100000,
+        help='maximum number of words in the memo'
+    )
+
+    memo_parser.set_defaults(func=benchmark_memo)
+
+    load_parser = subparsers.add_parser(
+        'load',
+        parents=[data_parser],
+        help='compare reading the reviews serially, with threads and from the cache'
+    )
+
+    load_parser.add_argument(
+        '-j',
+        '--n_jobs',
+        type=int,
+        default=16,
+        help='number of threads reading the files'
+    )
+
+    load_parser.set_defaults(func=benchmark_load)
+
+    keras_parser = subparsers.add_parser(
+        'keras',
+        parents=[data_parser],
+        help='compare training the KerasClassifier with its old and new defaults'
+    )
+
+    keras_parser.add_argument(
+        '-e',
+        '--epochs',
+        type=int,
+        default=10,
+        help='number of epochs of the old defaults, 100 would take hours'
+    )
+
+    keras_parser.add_argument(
+        '-f',
+        '--n_features',
+        type=int,
+        default=2 ** 12,
+        help='number of hashed features'
+    )
+
+    keras_parser.set_defaults(func=benchmark_keras)
+
+    bootstrap_parser = subparsers.add_parser(
+        'bootstrap',
+        help='compare the vectorized bootstrap_scores with a loop over resamples'
+    )
+
+    bootstrap_parser.add_argument(
+        '-n',
+        '--num_samples',
+        type=int,
+        default=25000,
+        help='number of synthetic predictions'
+    )
+
+    bootstrap_parser.add_argument(
+        '-b',
+        '--n_resamples',
+        type=int,
+        default=10000,
+        help='number of bootstrap resamples'
+    )
+
+    bootstrap_parser.add_argument(
+        '-l',
+        '--loop_resamples',
+        type=int,
+        default=100,
+        help='number of resamples actually run by the loop'
+    )
+
+    bootstrap_parser.set_defaults(func=benchmark_bootstrap)
+
+    args = ap.parse_args()
+    args.func(args)
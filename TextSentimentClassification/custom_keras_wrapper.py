@@ -12,14 +12,31 @@ Expects two-dimensional input and output, i.e.:
     _, input_dim = np.shape(X)
     _, output_dim = np.shape(y)
 
+X and y can be dense arrays or scipy sparse matrices, which are densified one
+batch at a time. Alternatively, X can be a keras.utils.Sequence or a generator
+of (X, y) batches, in which case y is not used.
+
+The classifier can be pickled, with its model saved as its JSON architecture
+and weights and rebuilt when it is next used, so it works with n_jobs > 1.
+With isolate=True every fit, predict and score runs in a fresh process whose
+Keras session is freed when it is done, so a long search in one process does
+not keep growing the TensorFlow graph. In worker processes, e.g. those of
+GridSearchCV(n_jobs > 1), they run in the worker and clear its session.
+
 @author: Karolis
 """
 import warnings
+import itertools
 import numpy as np
+import multiprocessing
+from scipy import sparse
 
 from sklearn.base import BaseEstimator
 
-from keras.models import Sequential
+from keras.utils import Sequence
+from keras.callbacks import Callback
+from keras import backend as K
+from keras.models import Sequential, model_from_json
 from keras.layers import Dense, Dropout
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -30,73 +47,341 @@ default = [(Dense, {'units' : 512,
            (Dropout, {'rate' : 0.5}), 
            (Dense, {'activation' : 'softmax'})]
 
+
+def _dense(a):
+    return a.toarray() if sparse.issparse(a) else np.asarray(a)
+
+
+def _2d(a):
+    if sparse.issparse(a):
+        return a
+
+    a = np.asarray(a)
+
+    return a if a.ndim >= 2 else np.array(a, ndmin=2)
+
+
+class SparseSequence(Sequence):
+    '''
+        Batches of the rows of a sparse matrix X, and of y if given, that are
+        only densified when Keras asks for them. X can be an array as well.
+    '''
+    def __init__(self, X, y=None, batch_size=32, shuffle=False):
+        self.X = sparse.csr_matrix(X) if sparse.issparse(X) else np.asarray(X)
+        self.y = sparse.csr_matrix(y) if sparse.issparse(y) else y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+        self.__rows = np.arange(self.X.shape[0])
+
+        if shuffle:
+            np.random.shuffle(self.__rows)
+
+    def __len__(self):
+        return int(np.ceil(self.X.shape[0] / self.batch_size))
+
+    def __getitem__(self, i):
+        rows = self.__rows[i * self.batch_size:(i + 1) * self.batch_size]
+
+        if self.y is None:
+            return _dense(self.X[rows])
+
+        return _dense(self.X[rows]), _dense(self.y[rows])
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.__rows)
+
+
+class EarlyStopping(Callback):
+    '''
+        Stops training once the validation loss has not improved for patience
+        epochs and restores the weights of the best epoch, which EarlyStopping
+        of Keras 2.2.0 cannot do.
+    '''
+    def __init__(self, patience=5):
+        super(EarlyStopping, self).__init__()
+        self.patience = patience
+
+    def on_train_begin(self, logs=None):
+        self.best = np.inf
+        self.best_weights = None
+        self.wait = 0
+        self.stopped_epoch = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        loss = (logs or {}).get('val_loss')
+
+        if loss is None:
+            return
+
+        if loss < self.best:
+            self.best = loss
+            self.best_weights = self.model.get_weights()
+            self.wait = 0
+        else:
+            self.wait += 1
+
+            if self.wait >= self.patience:
+                self.stopped_epoch = epoch
+                self.model.stop_training = True
+
+    def on_train_end(self, logs=None):
+        if self.best_weights is not None:
+            self.model.set_weights(self.best_weights)
+
+
 class KerasClassifier(BaseEstimator):
     
     def __init__(self, 
                  structure=default,
-                 batch_size=1,
+                 batch_size=32,
                  epochs=100,
                  optimizer='sgd',
                  loss='categorical_crossentropy',
-                 scoring='accuracy'):
-        
-        self.structure = default
+                 scoring='accuracy',
+                 validation_split=0.1,
+                 patience=5,
+                 isolate=False):
+        '''
+            validation_split - fraction of the training data, picked at
+                               random, that is held out to stop the training
+                               early on. 0 disables it.
+
+            patience         - number of epochs without an improvement of the
+                               validation loss after which the training stops
+                               and the best weights are restored. None trains
+                               for all the epochs.
+
+            isolate          - run fit, predict and score in a new process
+                               each, see above. The data is copied to the
+                               process, so it has to be picklable.
+        '''
+        self.structure = structure
         self.batch_size = batch_size
         self.epochs = epochs
         self.optimizer = optimizer
         self.loss = loss
         self.scoring = scoring
+        self.validation_split = validation_split
+        self.patience = patience
+        self.isolate = isolate
+
+        self.__model = None
+        self.__serialised = None
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+
+        # Keras models cannot be pickled, their architecture and weights can
+        if self.__model is not None:
+            state['_KerasClassifier__serialised'] = self.__serialise()
+            state['_KerasClassifier__model'] = None
+
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+    def __serialise(self):
+        return self.__model.to_json(), self.__model.get_weights()
+
+
+    @property
+    def model(self):
+        # Rebuilds the model of an unpickled classifier when it is first needed
+        if self.__model is None and self.__serialised is not None:
+            architecture, weights = self.__serialised
+
+            self.__model = model_from_json(architecture)
+            self.__model.set_weights(weights)
+            self.__compile()
+
+        return self.__model
+
+
+    def __compile(self):
+        self.__model.compile(loss=self.loss, 
+                             optimizer=self.optimizer, 
+                             metrics=[self.scoring])
     
     
     def __build_model(self, input_dim, output_dim):
-        self.model = Sequential()
+        self.__model = Sequential()
+        self.__serialised = None
         
-        # First hidden layer
+        # First hidden layer, without changing the dicts of the structure
         layer, params = self.structure[0]
-        params.update({'input_shape' : (input_dim,)})
-        self.model.add(layer(**params))
+        params = dict(params, input_shape=(input_dim,))
+        self.__model.add(layer(**params))
         
         for layer, params in self.structure[1:-1]:
-            self.model.add(layer(**params))
+            self.__model.add(layer(**params))
           
         # Output layer
         layer, params = self.structure[-1]
-        params.update({'units' : output_dim})
-        self.model.add(layer(**params))
+        params = dict(params, units=output_dim)
+        self.__model.add(layer(**params))
     
-        self.model.compile(loss=self.loss, 
-                           optimizer=self.optimizer, 
-                           metrics=[self.scoring])
+        self.__compile()
         
     
-    def __fit(self, X, y):
-        try:        
-            _, input_dim = np.shape(X)
-            _, output_dim = np.shape(y)
-        except:
-            X = np.array(X, ndmin=2)            
-            y = np.array(y, ndmin=2)
-            
-        _, input_dim = np.shape(X)
-        _, output_dim = np.shape(y)
-            
+    def __split(self, X, y):
+        # Holds out a random validation set, the rows are often sorted by class
+        n_val = int(X.shape[0] * self.validation_split)
+
+        if not n_val:
+            return X, y, None
+
+        rows = np.random.RandomState(7).permutation(X.shape[0])
+        train, val = np.sort(rows[n_val:]), np.sort(rows[:n_val])
+
+        return X[train], y[train], (X[val], y[val])
+
+
+    def __as_sequence(self, data):
+        if data is None or isinstance(data, Sequence):
+            return data
+
+        X, y = data
+
+        return SparseSequence(X, y, self.batch_size) if sparse.issparse(X) else (X, _dense(y))
+
+
+    def __fit(self, X, y, validation_data=None, steps_per_epoch=None, validation_steps=None):
+        callbacks = [EarlyStopping(self.patience)] if self.patience else []
+
+        if isinstance(X, Sequence) or hasattr(X, '__next__'):
+            if self.patience and validation_data is None:
+                warnings.warn('patience has no effect without validation_data '
+                              'when X is a Sequence or a generator, training '
+                              'for all the epochs')
+
+            # Peek at the first batch for the input and output dimensions
+            if isinstance(X, Sequence):
+                X_batch, y_batch = X[0]
+            else:
+                X_batch, y_batch = next(X)
+                X = itertools.chain([(X_batch, y_batch)], X)
+
+            self.__build_model(np.shape(X_batch)[1], np.shape(y_batch)[1])
+
+            self.__model.fit_generator(X,
+                                       steps_per_epoch=steps_per_epoch,
+                                       epochs=self.epochs,
+                                       validation_data=self.__as_sequence(validation_data),
+                                       validation_steps=validation_steps,
+                                       callbacks=callbacks,
+                                       verbose=0)
+            return
+
+        X, y = _2d(X), _2d(y)
+
+        if validation_data is None:
+            X, y, validation_data = self.__split(X, y)
+
+        _, input_dim = X.shape
+        _, output_dim = y.shape
+
         self.__build_model(input_dim, output_dim)
-        
-        self.model.fit(X, 
-                       y,
-                       batch_size=self.batch_size,
-                       epochs=self.epochs,
-                       verbose=0)
+
+        # fit of Keras takes no Sequence as validation_data, fit_generator does
+        if sparse.issparse(X) or isinstance(validation_data, Sequence):
+            self.__model.fit_generator(SparseSequence(X, y, self.batch_size, shuffle=True),
+                                       epochs=self.epochs,
+                                       validation_data=self.__as_sequence(validation_data),
+                                       callbacks=callbacks,
+                                       verbose=0)
+        else:
+            if validation_data is not None:
+                X_val, y_val = validation_data
+                validation_data = (_dense(X_val), _dense(y_val))
+
+            self.__model.fit(X, 
+                             _dense(y),
+                             batch_size=self.batch_size,
+                             epochs=self.epochs,
+                             validation_data=validation_data,
+                             callbacks=callbacks,
+                             verbose=0)
     
     
-    def fit(self, X, y=None):        
-        self.__fit(X, y)
+    def fit(self, X, y=None, validation_data=None, steps_per_epoch=None, validation_steps=None):
+        '''
+            validation_data  - (X, y) or a Sequence to stop the training early
+                               on instead of a validation_split of X and y.
+                               Sequences and generators of batches need it to
+                               stop early, patience is ignored with a warning
+                               otherwise.
+
+            steps_per_epoch  - number of batches per epoch when X is a
+                               generator.
+
+            validation_steps - number of batches of validation_data when it is
+                               a generator.
+        '''
+        args = (X, y, validation_data, steps_per_epoch, validation_steps)
+
+        if self.isolate:
+            self.__model = None
+            self.__serialised = self.__isolated('fit', args)
+        else:
+            self.__fit(*args)
+
         return self
+
+
+    def __predict(self, X):
+        if sparse.issparse(X):
+            return self.model.predict_generator(SparseSequence(X, batch_size=self.batch_size))
+
+        return self.model.predict(X, self.batch_size)
+
+
+    def __score(self, X, y):
+        if sparse.issparse(X):
+            return self.model.evaluate_generator(SparseSequence(X, y, self.batch_size))[1]
+
+        return self.model.evaluate(X, _dense(y), self.batch_size, verbose=0)[1]
     
     
     def predict(self, X):
-        return self.model.predict(X, self.batch_size)
+        if self.isolate:
+            return self.__isolated('predict', (X,))
+
+        return self.__predict(X)
     
     
     def score(self, X, y):
-        return self.model.evaluate(X, y)[1]
\ No newline at end of file
+        if self.isolate:
+            return self.__isolated('score', (X, y))
+
+        return self.__score(X, y)
+
+
+    def __isolated(self, method, args):
+        # Worker processes, e.g. of GridSearchCV(n_jobs > 1), are isolated
+        # already and cannot always start processes of their own
+        if multiprocessing.current_process().name != 'MainProcess':
+            return self._run_isolated(method, args)
+
+        # A spawned process, as TensorFlow does not survive a fork
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            return pool.apply(self._run_isolated, (method, args))
+
+
+    def _run_isolated(self, method, args):
+        # Frees the Keras session when done, the model is rebuilt from its
+        # serialised architecture and weights the next time it is needed
+        try:
+            if method == 'fit':
+                self.__fit(*args)
+                return self.__serialise()
+
+            return {'predict' : self.__predict, 'score' : self.__score}[method](*args)
+        finally:
+            K.clear_session()
+            self.__model = None
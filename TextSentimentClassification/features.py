@@ -0,0 +1,217 @@
+'''
+    Out-of-core features for the sentiment models. The tokens of the tokenize
+    functions and their n-grams are hashed into a fixed number of columns of
+    a sparse CSR matrix, so there is no vocabulary to hold in memory and any
+    number of reviews can be turned into features chunk by chunk and fed to
+    a classifier that learns with partial_fit.
+'''
+import time
+import argparse
+import numpy as np
+from scipy import sparse
+from collections import deque
+from sklearn.linear_model import SGDClassifier
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from preprocessing import tokenize_corpus, iter_reviews, chunks
+
+
+def _identity(tokens):
+    return tokens
+
+
+class HashedFeatures():
+    def __init__(self,
+        mode='stem',
+        n_features=2 ** 20,
+        ngram_range=(1, 2),
+        n_jobs=None,
+        chunksize=256
+    ):
+        '''
+            mode        - 'tokenize', 'stem' or 'lemmatize', i.e. which of the
+                          tokenize functions the features are made of.
+
+            n_features  - number of columns the tokens are hashed into.
+
+            ngram_range - the smallest and the largest n-grams of tokens used.
+
+            n_jobs      - number of tokenizing processes, see tokenize_corpus.
+
+            chunksize   - number of texts sent to a process at a time.
+        '''
+        self.mode = mode
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.n_jobs = n_jobs
+        self.chunksize = chunksize
+
+        # The texts are already tokenized when they get to the vectorizer
+        self.vectorizer = HashingVectorizer(
+            preprocessor=_identity,
+            tokenizer=_identity,
+            token_pattern=None,
+            lowercase=False,
+            ngram_range=ngram_range,
+            n_features=n_features,
+            alternate_sign=False
+        )
+
+    def __tokenize(self, texts):
+        return tokenize_corpus(texts, self.mode, self.n_jobs, self.chunksize)
+
+    def iter_transform(self, texts, batch_size=10000):
+        '''
+            Yields the CSR features of batch_size texts at a time.
+        '''
+        for tokens in chunks(self.__tokenize(texts), batch_size):
+            yield self.vectorizer.transform(tokens)
+
+    def transform(self, texts, batch_size=10000):
+        '''
+            Returns the CSR features of all the texts.
+        '''
+        batches = list(self.iter_transform(texts, batch_size))
+
+        if not batches:
+            return sparse.csr_matrix((0, self.n_features))
+
+        return sparse.vstack(batches, format='csr')
+
+    def iter_batches(self, reviews, batch_size=10000):
+        '''
+            Turns an iterable of (text, label) pairs, e.g. iter_reviews, into
+            (X, y) batches of batch_size reviews without ever holding more
+            than a few batches in memory.
+        '''
+        labels = deque()
+
+        def texts():
+            for text, label in reviews:
+                labels.append(label)
+                yield text
+
+        for tokens in chunks(self.__tokenize(texts()), batch_size):
+            y = np.array([labels.popleft() for _ in tokens])
+
+            yield self.vectorizer.transform(tokens), y
+
+
+def fit_batches(classifier, batches, classes=(0, 1), verbose=False):
+    '''
+        Trains a classifier that supports partial_fit, e.g. SGDClassifier or
+        MultinomialNB, on (X, y) batches one at a time.
+    '''
+    seen = 0
+    started = time.time()
+
+    for i, (X, y) in enumerate(batches):
+        classifier.partial_fit(X, y, classes=classes)
+        seen += len(y)
+
+        if verbose:
+            print('Batch {}: {} reviews seen, {:.1f} reviews/s'.format(
+                i + 1,
+                seen,
+                seen / (time.time() - started)
+            ))
+
+    return classifier
+
+
+def score_batches(classifier, batches):
+    '''
+        Accuracy of a classifier over (X, y) batches.
+    '''
+    correct, total = 0, 0
+
+    for X, y in batches:
+        correct += (classifier.predict(X) == y).sum()
+        total += len(y)
+
+    return correct / total if total else 0.0
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument(
+        '-r',
+        '--root',
+        required=True,
+        help='path to the aclImdb directory'
+    )
+
+    ap.add_argument(
+        '-m',
+        '--mode',
+        choices=['tokenize', 'stem', 'lemmatize'],
+        default='stem',
+        help='which of the tokenize functions to make the features of'
+    )
+
+    ap.add_argument(
+        '-f',
+        '--n_features',
+        type=int,
+        default=2 ** 20,
+        help='number of hashed feature columns'
+    )
+
+    ap.add_argument(
+        '-g',
+        '--ngrams',
+        type=int,
+        default=2,
+        help='largest n-gram of tokens to use'
+    )
+
+    ap.add_argument(
+        '-b',
+        '--batch_size',
+        type=int,
+        default=5000,
+        help='number of reviews per partial_fit call'
+    )
+
+    ap.add_argument(
+        '-e',
+        '--epochs',
+        type=int,
+        default=3,
+        help='number of passes over the training reviews'
+    )
+
+    ap.add_argument(
+        '-j',
+        '--n_jobs',
+        type=int,
+        help='number of tokenizing processes (default: number of CPUs)'
+    )
+
+    args = ap.parse_args()
+
+    features = HashedFeatures(
+        args.mode,
+        args.n_features,
+        (1, args.ngrams),
+        args.n_jobs
+    )
+    classifier = SGDClassifier(loss='modified_huber', alpha=1e-5, random_state=7)
+
+    for epoch in range(args.epochs):
+        print('Epoch {}/{}'.format(epoch + 1, args.epochs))
+
+        # The reviews are sorted by sentiment on disk, partial_fit needs them mixed
+        reviews = iter_reviews(args.root, 'train', random_state=epoch)
+
+        fit_batches(
+            classifier,
+            features.iter_batches(reviews, args.batch_size),
+            verbose=True
+        )
+
+    print('Test accuracy: {:.2f}%'.format(100 * score_batches(
+        classifier,
+        features.iter_batches(iter_reviews(args.root, 'test'), args.batch_size)
+    )))
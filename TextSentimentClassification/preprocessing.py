@@ -5,14 +5,64 @@ Created on Mon Jun 19 13:30:51 2017
 @author: Karolis
 """
 import re
+import os
+import json
+import warnings
 import glob as gb
-import pandas as pd
+import numpy as np
+from itertools import islice
+from collections import deque, OrderedDict
+from multiprocessing import Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor
 
-import nltk
-from nltk.tokenize import TweetTokenizer
-stemmer =  nltk.SnowballStemmer('english')
-lemmatizer = nltk.WordNetLemmatizer()
-stopwords = nltk.corpus.stopwords.words('english') 
+
+class _Lazy():
+    '''
+        Stands in for an object that is only made when it is first used.
+        Importing NLTK and loading its corpora takes seconds, which every
+        script importing this module would pay even if it never tokenized.
+
+        Attributes are looked up on the object and kept, so stemmer.stem costs
+        a plain attribute lookup after the first one.
+    '''
+    def __init__(self, factory):
+        self.__factory = factory
+        self.__value = None
+
+    def __get(self):
+        if self.__value is None:
+            self.__value = self.__factory()
+
+        return self.__value
+
+    def __getattr__(self, name):
+        if name.startswith('_Lazy__'):
+            # Not yet set, e.g. while unpickling
+            raise AttributeError(name)
+
+        value = getattr(self.__get(), name)
+        setattr(self, name, value)
+
+        return value
+
+    def __iter__(self):
+        return iter(self.__get())
+
+    def __contains__(self, item):
+        return item in self.__get()
+
+    def __len__(self):
+        return len(self.__get())
+
+
+def _nltk():
+    import nltk
+    return nltk
+
+
+stemmer = _Lazy(lambda: _nltk().SnowballStemmer('english'))
+lemmatizer = _Lazy(lambda: _nltk().WordNetLemmatizer())
+stopwords = _Lazy(lambda: _nltk().corpus.stopwords.words('english'))
 
 
 def clean(text):
@@ -22,34 +72,176 @@ def clean(text):
     return text
 
 
-def preprocess(imdb_movie_reviews_root):
-    labels = {'pos' : 1, 'neg' : 0}
-    
-    preprocessed = {}
-    
-    for s in ['train', 'test']:
-        if s not in preprocessed:  
-            preprocessed[s] = {'review' : [], 'sentiment' : []}
-        
-        for l in  labels.keys():
-            path = 'aclImdb/%s/%s' % (s, l)
-            
-            for file_path in gb.glob('%s/*' % path):
-                with open(file_path, 'r', encoding='utf8') as file:
-                    txt = file.read()
-                    preprocessed[s]['review'].append(txt)
-                    preprocessed[s]['sentiment'].append(labels[l])
-                    
-    
-    return pd.DataFrame(preprocessed['train']), pd.DataFrame(preprocessed['test'])
+LABELS = {'pos' : 1, 'neg' : 0}
+
+
+def _read_texts(paths):
+    texts = []
+
+    for path in paths:
+        with open(path, 'r', encoding='utf8') as file:
+            texts.append(file.read())
+
+    return texts
+
+
+def _review_files(root, subset):
+    return [
+        (path, sentiment)
+        for label, sentiment in LABELS.items()
+        for path in sorted(gb.glob(os.path.join(root, subset, label, '*')))
+    ]
+
+
+def _mtimes(root, subset):
+    # Adding, removing or renaming a review changes the mtime of its directory
+    return np.array([
+        os.stat(os.path.join(root, subset, label)).st_mtime_ns for label in LABELS
+    ])
+
+
+def iter_reviews(
+    imdb_movie_reviews_root,
+    subset='train',
+    n_jobs=16,
+    chunksize=64,
+    random_state=None
+):
+    '''
+        Streams the (review, sentiment) pairs of the train or test subset of
+        the IMDB movie reviews. The files are read by n_jobs threads, chunksize
+        files at a time, and at most two chunks per thread are read ahead, so
+        the subset is never held in memory as a whole.
+
+        The positive reviews come before the negative ones unless a
+        random_state is given to shuffle them with.
+    '''
+    files = _review_files(imdb_movie_reviews_root, subset)
+
+    if random_state is not None:
+        order = np.random.RandomState(random_state).permutation(len(files))
+        files = [files[i] for i in order]
+
+    with ThreadPoolExecutor(n_jobs) as executor:
+        pending = deque()
+
+        def ready():
+            chunk, reviews = pending.popleft()
+
+            return zip(reviews.result(), [sentiment for _, sentiment in chunk])
+
+        for chunk in chunks(files, chunksize):
+            pending.append((
+                chunk,
+                executor.submit(_read_texts, [path for path, _ in chunk])
+            ))
+
+            if len(pending) > 2 * n_jobs:
+                for review in ready():
+                    yield review
+
+        while pending:
+            for review in ready():
+                yield review
+
+
+def _data_frame(reviews, sentiment):
+    # pandas is only imported by the readers, tokenizing does not need it
+    import pandas as pd
+    return pd.DataFrame({'review' : reviews, 'sentiment' : sentiment})
+
+
+def _load_cache(cache_path, mtimes):
+    try:
+        with np.load(cache_path) as cache:
+            if not np.array_equal(cache['mtimes'], mtimes):
+                return None
+
+            data = cache['data'].tobytes()
+            offsets = cache['offsets'].tolist()
+            sentiment = cache['sentiment'].astype(np.int64)
+    except (IOError, KeyError, ValueError):
+        return None
+
+    reviews = [
+        data[start:end].decode('utf8') for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+    return _data_frame(reviews, sentiment)
+
+
+def _save_cache(cache_path, mtimes, reviews, sentiment):
+    encoded = [review.encode('utf8') for review in reviews]
+
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(review) for review in encoded], out=offsets[1:])
+
+    tmp_path = cache_path + '.part'
+
+    with open(tmp_path, 'wb') as file:
+        np.savez(
+            file,
+            data=np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            offsets=offsets,
+            sentiment=np.array(sentiment, dtype=np.int8),
+            mtimes=mtimes
+        )
+
+    os.replace(tmp_path, cache_path)
+
+
+def read_reviews(imdb_movie_reviews_root, subset='train', n_jobs=16, cache=True, cache_dir=None):
+    '''
+        Reads the train or test subset of the IMDB movie reviews into a
+        DataFrame of review and sentiment columns, the files being read by
+        n_jobs threads.
+
+        Unless cache is False, the first read is saved to an NPZ of the UTF-8
+        bytes of all the reviews and their offsets in cache_dir, the root
+        directory by default. Later reads load that instead of the files until
+        a review is added to or removed from the subset.
+    '''
+    mtimes = _mtimes(imdb_movie_reviews_root, subset)
+    cache_path = os.path.join(
+        imdb_movie_reviews_root if cache_dir is None else cache_dir,
+        '%s_cache.npz' % subset
+    )
+
+    if cache:
+        data = _load_cache(cache_path, mtimes)
+
+        if data is not None:
+            return data
+
+    reviews, sentiment = [], []
+
+    for review, label in iter_reviews(imdb_movie_reviews_root, subset, n_jobs):
+        reviews.append(review)
+        sentiment.append(label)
+
+    if cache:
+        try:
+            _save_cache(cache_path, mtimes, reviews, sentiment)
+        except (IOError, OSError) as e:
+            warnings.warn('Could not cache the %s reviews: %s' % (subset, e))
+
+    return _data_frame(reviews, sentiment)
+
+
+def preprocess(imdb_movie_reviews_root, n_jobs=16, cache=True):
+    return (
+        read_reviews(imdb_movie_reviews_root, 'train', n_jobs, cache),
+        read_reviews(imdb_movie_reviews_root, 'test', n_jobs, cache)
+    )
            
            
 def tokenize(text):    
     # Split into sentences first then tokenize each sentence
     # TweetTokenizer is used to preserve the emoticons in the text
+    nltk = _nltk()
     tokens = [
         word for sentence in nltk.sent_tokenize(text)
-        for word in TweetTokenizer().tokenize(clean(sentence))
+        for word in nltk.tokenize.TweetTokenizer().tokenize(clean(sentence))
     ]
     
     # Remove stopwords
@@ -61,8 +253,284 @@ def tokenize(text):
 
            
 def tokenize_n_stem(text):
-    return [stemmer.stem(token) for token in tokenize(text)]  
+    return [memoized_stem(token) for token in tokenize(text)]  
     
     
 def tokenize_n_lemmatize(text):
-    return [lemmatizer.lemmatize(token) for token in tokenize(text)]  
\ No newline at end of file
+    return [memoized_lemmatize(token) for token in tokenize(text)]
+
+
+class Tokenizer():
+    '''
+        Faster equivalent of tokenize, tokenize_n_stem and tokenize_n_lemmatize
+        for tokenizing a lot of text. The regular expressions are compiled
+        once, a single TweetTokenizer is reused and the stopwords are looked up
+        in a frozenset instead of a list. Most cleaned sentences are nothing
+        but words of ASCII letters, which TweetTokenizer would split on the
+        spaces, so those skip it altogether. The tokens are identical to the
+        ones of the functions above.
+
+        normalise  - optional function applied to every token, e.g.
+                     stemmer.stem or lemmatizer.lemmatize.
+
+        stop_words - words to remove, the NLTK English stopwords by default.
+    '''
+    __tags = re.compile(r'<[^>]*>')
+    __emoticons = re.compile(r'(?::|;|=)(?:-)?(?:\)|\(|D|P)')
+    __non_words = re.compile(r'[\W]+')
+    __letters_only = re.compile(r'[a-z ]*')
+
+    def __init__(self, normalise=None, stop_words=None):
+        self.normalise = normalise
+
+        self.__stopwords = frozenset(
+            stopwords if stop_words is None else stop_words
+        )
+        nltk = _nltk()
+        self.__sent_tokenize = nltk.sent_tokenize
+        self.__tweet_tokenizer = nltk.tokenize.TweetTokenizer()
+
+    def __call__(self, text):
+        return self.tokenize(text)
+
+    def clean(self, text):
+        text = self.__tags.sub('', text)
+        emoticons = self.__emoticons.findall(text)
+        text = self.__non_words.sub(' ', text.lower()) + ' '.join(emoticons).replace('-', '')
+        return text
+
+    def tokenize(self, text):
+        stopwords = self.__stopwords
+        tokens = [
+            word for sentence in self.__sent_tokenize(text)
+            for word in self.__split(self.clean(sentence))
+            if not word.lower() in stopwords
+        ]
+
+        if self.normalise is not None:
+            normalise = self.normalise
+            tokens = [normalise(token) for token in tokens]
+
+        return tokens
+
+    def __split(self, sentence):
+        if self.__letters_only.fullmatch(sentence):
+            return sentence.split()
+
+        return self.__tweet_tokenizer.tokenize(sentence)
+
+    def tokenize_many(self, texts):
+        '''
+            Tokenizes an iterable of texts into a list of token lists.
+        '''
+        return [self.tokenize(text) for text in texts]
+
+
+class LRUMemo():
+    '''
+        Bounded least recently used memo of a function of a single word, such
+        as stemmer.stem or lemmatizer.lemmatize. Word frequencies are heavily
+        skewed, so a memo of the most frequent words answers most lookups.
+
+        fun     - the function to memoize.
+
+        maxsize - maximum number of words kept, the least recently used ones
+                  are evicted first.
+    '''
+    def __init__(self, fun, maxsize=100000):
+        self.fun = fun
+        self.maxsize = maxsize
+
+        self.hits = 0
+        self.misses = 0
+
+        self.__memo = OrderedDict()
+
+    def __len__(self):
+        return len(self.__memo)
+
+    def __call__(self, word):
+        memo = self.__memo
+
+        try:
+            value = memo[word]
+        except KeyError:
+            self.misses += 1
+            value = self.__put(word)
+        else:
+            self.hits += 1
+            memo.move_to_end(word)
+
+        return value
+
+    def __put(self, word, value=None):
+        memo = self.__memo
+        memo[word] = value = self.fun(word) if value is None else value
+
+        if len(memo) > self.maxsize:
+            memo.popitem(last=False)
+
+        return value
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hit_rate,
+            size=len(self),
+            maxsize=self.maxsize
+        )
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self.__memo.clear()
+
+    def warm(self, vocabulary):
+        '''
+            Fills the memo with the words of a vocabulary, most frequent first,
+            without counting them as misses.
+        '''
+        for word in reversed(list(vocabulary)):
+            if word not in self.__memo:
+                self.__put(word)
+
+        return self
+
+    def save(self, path):
+        '''
+            Saves the memo to a JSON file, replacing any earlier one only once
+            it has been written in full.
+        '''
+        tmp_path = path + '.part'
+
+        with open(tmp_path, 'w', encoding='utf8') as file:
+            json.dump(list(self.__memo.items()), file)
+
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        '''
+            Adds the words saved by save to the memo, so that a new run starts
+            with the memo of the last one.
+        '''
+        with open(path, 'r', encoding='utf8') as file:
+            items = json.load(file)
+
+        for word, value in items:
+            self.__memo.pop(word, None)
+            self.__put(word, value)
+
+        return self
+
+
+def _stem(word):
+    return stemmer.stem(word)
+
+
+def _lemmatize(word):
+    return lemmatizer.lemmatize(word)
+
+
+# Through functions, stemmer.stem would load NLTK right away
+memoized_stem = LRUMemo(_stem)
+memoized_lemmatize = LRUMemo(_lemmatize)
+
+NORMALISERS = {
+    'tokenize': None,
+    'stem': memoized_stem,
+    'lemmatize': memoized_lemmatize
+}
+
+_worker_tokenizer = None
+
+
+def _init_worker(mode):
+    global _worker_tokenizer
+    _worker_tokenizer = Tokenizer(NORMALISERS[mode])
+
+    # Load the NLTK resources once now rather than with the first chunk
+    _worker_tokenizer.tokenize('Warming up the tokenizers.')
+
+
+def _tokenize_chunk(texts):
+    memo = _worker_tokenizer.normalise
+
+    if memo is None:
+        return _worker_tokenizer.tokenize_many(texts), 0, 0
+
+    hits, misses = memo.hits, memo.misses
+    tokens = _worker_tokenizer.tokenize_many(texts)
+
+    # The worker's memo is a copy, its counts have to be sent back
+    return tokens, memo.hits - hits, memo.misses - misses
+
+
+def _collect(result, memo):
+    tokens, hits, misses = result.get()
+
+    if memo is not None:
+        memo.hits += hits
+        memo.misses += misses
+
+    return tokens
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def tokenize_corpus(texts, mode='tokenize', n_jobs=None, chunksize=256):
+    '''
+        Tokenizes an iterable of texts in a pool of n_jobs processes, all of
+        the CPUs by default, and yields their token lists in order. mode is
+        one of 'tokenize', 'stem' or 'lemmatize', matching the tokenize,
+        tokenize_n_stem and tokenize_n_lemmatize functions.
+
+        The texts are sent to the workers in chunks of chunksize, at most two
+        chunks per worker at a time, so a corpus streamed from disk is never
+        held in memory as a whole. Every worker builds its own Tokenizer and
+        loads the NLTK resources once when it starts.
+
+        Stems and lemmas go through memoized_stem and memoized_lemmatize, so
+        workers forked after memoized_stem.load(path) start with a warm memo.
+        The hits and misses of the workers are added to the counts of those
+        memos, but the words the workers memoize stay in the workers.
+    '''
+    if mode not in NORMALISERS:
+        raise ValueError('mode must be one of %s' % ', '.join(sorted(NORMALISERS)))
+
+    n_jobs = n_jobs or cpu_count()
+
+    if n_jobs == 1:
+        tokenizer = Tokenizer(NORMALISERS[mode])
+
+        for text in texts:
+            yield tokenizer.tokenize(text)
+
+        return
+
+    with Pool(n_jobs, _init_worker, (mode,)) as pool:
+        pending = deque()
+
+        for chunk in chunks(texts, chunksize):
+            pending.append(pool.apply_async(_tokenize_chunk, (chunk,)))
+
+            if len(pending) >= 2 * n_jobs:
+                for tokens in _collect(pending.popleft(), NORMALISERS[mode]):
+                    yield tokens
+
+        while pending:
+            for tokens in _collect(pending.popleft(), NORMALISERS[mode]):
+                yield tokens
@@ -4,14 +4,66 @@ Created on Mon Jun 19 14:27:37 2017
 
 @author: Karolis
 """
-
-from unittest import TestCase, main
+import os
+import sys
+import pickle
+import tempfile
+import subprocess
+import importlib.util
+import numpy as np
+from scipy import sparse
+from unittest import TestCase, main, skipUnless
 from preprocessing import (
     clean, 
     tokenize, 
     tokenize_n_stem, 
-    tokenize_n_lemmatize
+    tokenize_n_lemmatize,
+    stemmer,
+    lemmatizer,
+    stopwords,
+    tokenize_corpus,
+    iter_reviews,
+    read_reviews,
+    Tokenizer,
+    LRUMemo,
+    memoized_stem
+)
+from features import HashedFeatures, fit_batches, score_batches
+from validation import (
+    stratified_sample,
+    project,
+    bootstrap_scores,
+    compare_models,
+    report_results,
+    ConfusionMatrix
 )
+from sklearn import metrics
+from sklearn.base import clone
+from sklearn.linear_model import SGDClassifier
+
+
+TEXTS = [
+    'runners like running and thus they run',
+    "</a>This :) is :( a test :-)! It's <br /><br />rated 8/10 :D",
+    'Call 555 123 4567 now... or visit http://example.com =P',
+    'Ça, c\'est très   bien__fait ;-)',
+    ''
+]
+
+# The tests of custom_keras_wrapper run where Keras is installed
+HAS_KERAS = importlib.util.find_spec('keras') is not None
+
+
+def blobs(n=300, n_features=20, n_classes=3):
+    '''
+        Sparse, well separated classes and their one-hot labels.
+    '''
+    rng = np.random.RandomState(7)
+    labels = rng.randint(0, n_classes, n)
+    X = rng.rand(n, n_features) * (rng.rand(n, n_features) < 0.2)
+    X[np.arange(n), labels] += 3
+
+    return sparse.csr_matrix(X), np.eye(n_classes)[labels]
 
 
 class Test(TestCase):
@@ -42,7 +94,383 @@ class Test(TestCase):
             tokenize_n_lemmatize('runners like running and thus they run'),
             ['runner', 'like', 'running', 'thus', 'run']
         )    
-    
-    
+
+
+    def test_tokenizer_clean(self):
+        tokenizer = Tokenizer()
+
+        for text in TEXTS:
+            self.assertEqual(tokenizer.clean(text), clean(text))
+
+
+    def test_tokenizer_tokenize_many(self):
+        self.assertEqual(
+            Tokenizer().tokenize_many(TEXTS),
+            [tokenize(text) for text in TEXTS]
+        )
+
+
+    def test_tokenizer_stem(self):
+        self.assertEqual(
+            Tokenizer(stemmer.stem).tokenize_many(TEXTS),
+            [tokenize_n_stem(text) for text in TEXTS]
+        )
+
+
+    def test_tokenizer_lemmatize(self):
+        self.assertEqual(
+            Tokenizer(lemmatizer.lemmatize).tokenize_many(TEXTS),
+            [tokenize_n_lemmatize(text) for text in TEXTS]
+        )
+
+
+    def test_tokenize_corpus(self):
+        texts = TEXTS * 3
+
+        for n_jobs in [1, 2]:
+            self.assertEqual(
+                list(tokenize_corpus(iter(texts), 'stem', n_jobs=n_jobs, chunksize=2)),
+                [tokenize_n_stem(text) for text in texts]
+            )
+
+
+    def test_memoized_stem_counts(self):
+        text = 'runners like running and thus they run'
+        memoized_stem.clear()
+
+        tokenize_n_stem(text)
+        tokenize_n_stem(text)
+        self.assertEqual((memoized_stem.hits, memoized_stem.misses), (5, 5))
+
+        # The counts of the worker processes reach the memo of this one
+        list(tokenize_corpus([text] * 4, 'stem', n_jobs=2, chunksize=1))
+        self.assertEqual(memoized_stem.hits + memoized_stem.misses, 10 + 4 * 5)
+
+        memoized_stem.clear()
+
+
+    def test_lru_memo(self):
+        memo = LRUMemo(stemmer.stem, maxsize=2)
+
+        self.assertEqual(
+            [memo(word) for word in ['runners', 'running', 'runners', 'run']],
+            ['runner', 'run', 'runner', 'run']
+        )
+        self.assertEqual((memo.hits, memo.misses, len(memo)), (1, 3, 2))
+
+        # 'running' was the least recently used word
+        memo('running')
+        self.assertEqual(memo.misses, 4)
+
+
+    def test_lru_memo_warm_save_load(self):
+        memo = LRUMemo(stemmer.stem).warm(['runners', 'running'])
+        self.assertEqual((memo.misses, len(memo)), (0, 2))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'memo.json')
+            memo.save(path)
+            loaded = LRUMemo(stemmer.stem).load(path)
+
+        self.assertEqual(loaded('runners'), 'runner')
+        self.assertEqual(loaded('running'), 'run')
+        self.assertEqual(loaded.stats()['hit_rate'], 1.0)
+
+
+    def test_lazy_imports(self):
+        loaded = subprocess.check_output([
+            sys.executable,
+            '-c',
+            'import sys, preprocessing; print("nltk" in sys.modules, "pandas" in sys.modules)'
+        ], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(loaded.split(), [b'False', b'False'])
+
+        self.assertEqual(stemmer.stem('runners'), 'runner')
+        self.assertIn('the', stopwords)
+
+
+    def test_read_reviews(self):
+        with tempfile.TemporaryDirectory() as root:
+            for i, text in enumerate(TEXTS):
+                label = ['pos', 'neg'][i % 2]
+
+                if not os.path.exists(os.path.join(root, 'train', label)):
+                    os.makedirs(os.path.join(root, 'train', label))
+
+                with open(os.path.join(root, 'train', label, '%d.txt' % i), 'w', encoding='utf8') as file:
+                    file.write(text)
+
+            expected = [(TEXTS[i], 1) for i in [0, 2, 4]] + [(TEXTS[i], 0) for i in [1, 3]]
+
+            self.assertEqual(list(iter_reviews(root, n_jobs=2, chunksize=2)), expected)
+
+            for _ in range(2):
+                data = read_reviews(root, n_jobs=2)
+                self.assertEqual(list(zip(data.review, data.sentiment)), expected)
+
+            self.assertTrue(os.path.exists(os.path.join(root, 'train_cache.npz')))
+
+            # A new review invalidates the cache
+            with open(os.path.join(root, 'train', 'neg', 'new.txt'), 'w', encoding='utf8') as file:
+                file.write('new')
+
+            self.assertEqual(len(read_reviews(root)), len(TEXTS) + 1)
+
+
+    def test_hashed_features(self):
+        unigrams = HashedFeatures('stem', 2 ** 10, (1, 1), n_jobs=1)
+        bigrams = HashedFeatures('stem', 2 ** 10, (1, 2), n_jobs=1)
+
+        X = bigrams.transform(TEXTS, batch_size=2)
+        self.assertEqual(X.shape, (len(TEXTS), 2 ** 10))
+        self.assertGreater(X.nnz, unigrams.transform(TEXTS).nnz)
+
+        batches = list(bigrams.iter_transform(TEXTS, batch_size=2))
+        self.assertEqual([batch.shape[0] for batch in batches], [2, 2, 1])
+        self.assertEqual(abs(X - bigrams.transform(TEXTS)).sum(), 0)
+
+
+    def test_fit_batches(self):
+        reviews = [
+            ('a great movie, loved it', 1), ('an awful movie, hated it', 0)
+        ] * 20
+        features = HashedFeatures('stem', 2 ** 10, n_jobs=1)
+
+        batches = list(features.iter_batches(iter(reviews), batch_size=8))
+        self.assertEqual([y.tolist() for _, y in batches][0], [1, 0] * 4)
+
+        classifier = fit_batches(SGDClassifier(random_state=7), batches)
+        self.assertEqual(score_batches(classifier, batches), 1.0)
+
+
+    def test_stratified_sample(self):
+        y = np.r_[np.zeros(150), np.ones(48), [2, 2]]
+        rows = stratified_sample(y, 40)
+
+        self.assertEqual(np.bincount(y[rows].astype(int)).tolist(), [30, 10, 1])
+        self.assertTrue((np.diff(rows) > 0).all())
+        self.assertEqual(len(stratified_sample(y, 1000)), len(y))
+
+
+    def test_project(self):
+        X = sparse.random(200, 30, density=0.2, format='csr', random_state=0)
+        y = np.r_[np.zeros(150), np.ones(50)]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            rows, embedding = project(X, y, 40, n_components=5, cache_dir=cache_dir)
+            self.assertEqual(embedding.shape, (40, 2))
+
+            # Cached in memory and on disk
+            self.assertIs(project(X, y, 40, n_components=5)[1], embedding)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+
+    def test_bootstrap_scores(self):
+        rng = np.random.RandomState(0)
+        y = rng.randint(0, 2, 2000)
+        scores = np.clip(0.3 * y + 0.7 * rng.rand(2000), 0, 1)
+
+        results = bootstrap_scores(y, scores, n_resamples=2000)
+
+        self.assertAlmostEqual(results['accuracy']['estimate'], metrics.accuracy_score(y, scores >= 0.5))
+        self.assertAlmostEqual(results['f1']['estimate'], metrics.f1_score(y, scores >= 0.5))
+        self.assertAlmostEqual(results['auc']['estimate'], metrics.roc_auc_score(y, scores))
+
+        # The spread of a loop over resamples
+        rows = rng.randint(0, len(y), (200, len(y)))
+        looped = [metrics.roc_auc_score(y[row], scores[row]) for row in rows]
+
+        for result in results.values():
+            self.assertTrue(result['low'] < result['estimate'] < result['high'])
+
+        self.assertAlmostEqual(results['auc']['std'], np.std(looped), delta=0.2 * np.std(looped))
+
+        # Probabilities of both classes and one-hot labels
+        both = bootstrap_scores(np.eye(2)[y], np.c_[1 - scores, scores], n_resamples=2000)
+        self.assertEqual(both, results)
+
+
+    def test_compare_models(self):
+        rng = np.random.RandomState(0)
+        y = rng.randint(0, 2, 2000)
+        good = np.clip(0.4 * y + 0.6 * rng.rand(2000), 0, 1)
+        bad = np.clip(0.1 * y + 0.9 * rng.rand(2000), 0, 1)
+
+        results = compare_models(y, good, good, n_resamples=500)
+
+        for result in results.values():
+            self.assertEqual((result['difference'], result['std'], result['p_value']), (0, 0, 1))
+
+        results = compare_models(y, good, bad, n_resamples=500)
+
+        for result in results.values():
+            self.assertAlmostEqual(result['difference'], result['a'] - result['b'])
+            self.assertTrue(0 < result['low'] < result['difference'] < result['high'])
+            self.assertLess(result['p_value'], 0.01)
+
+
+    def test_report_results(self):
+        results = report_results([0.8, 0.9], [1.0, 1.0], verbose=False)
+
+        self.assertAlmostEqual(results['test_mean'], 0.85)
+        self.assertAlmostEqual(results['test_range'][1], 0.95)
+        self.assertEqual(results['train_std'], 0)
+        self.assertNotIn('train_mean', report_results([0.8, 0.9], verbose=False))
+
+
+    def test_confusion_matrix(self):
+        rng = np.random.RandomState(0)
+        y = rng.randint(0, 12, 1000)
+        y_hat = np.where(rng.rand(1000) < 0.7, y, rng.randint(0, 12, 1000))
+
+        confusion_matrix = ConfusionMatrix()
+
+        for start in range(0, len(y), 64):
+            confusion_matrix.update(y[start:start + 64], y_hat[start:start + 64])
+
+        self.assertEqual(confusion_matrix.counts.tolist(), metrics.confusion_matrix(y, y_hat).tolist())
+        self.assertAlmostEqual(confusion_matrix.accuracy, metrics.accuracy_score(y, y_hat))
+        self.assertTrue(np.allclose(confusion_matrix.normalized().sum(axis=1), 1))
+
+        confusion_matrix = ConfusionMatrix(['pos', 'neg'])
+        confusion_matrix.update(['pos', 'neg', 'neg'], ['pos', 'pos', 'neg'])
+        self.assertEqual(confusion_matrix.counts.tolist(), [[1, 0], [1, 1]])
+        self.assertRaises(ValueError, confusion_matrix.update, ['bad'], ['pos'])
+
+        # Probability columns are in the order of the classes, not of their values
+        confusion_matrix = ConfusionMatrix([5, 3])
+        confusion_matrix.update([5, 3, 3], np.array([[0.9, 0.1], [0.8, 0.2], [0.3, 0.7]]))
+        self.assertEqual(confusion_matrix.counts.tolist(), [[1, 0], [1, 1]])
+        self.assertRaises(ValueError, confusion_matrix.update, [5], np.ones((1, 3)))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'confusion_matrix.png')
+            confusion_matrix.plot(path)
+            self.assertTrue(os.path.getsize(path) > 0)
+
+
+    @skipUnless(HAS_KERAS, 'needs Keras')
+    def test_sparse_sequence(self):
+        from custom_keras_wrapper import SparseSequence
+
+        X, y = blobs(n=10)
+        batches = SparseSequence(X, y, batch_size=4)
+
+        self.assertEqual(len(batches), 3)
+        self.assertTrue(np.array_equal(batches[1][0], X[4:8].toarray()))
+        self.assertTrue(np.array_equal(batches[2][1], y[8:]))
+        self.assertTrue(np.array_equal(SparseSequence(X.toarray(), batch_size=4)[2], X[8:].toarray()))
+
+        # Shuffled every epoch, every row still comes once with its label
+        batches = SparseSequence(X, y, batch_size=4, shuffle=True)
+
+        for _ in range(2):
+            X_rows = np.concatenate([batches[i][0] for i in range(len(batches))])
+            y_rows = np.concatenate([batches[i][1] for i in range(len(batches))])
+            order = np.lexsort(X_rows.T)
+
+            self.assertTrue(np.array_equal(X_rows[order], X.toarray()[np.lexsort(X.toarray().T)]))
+            self.assertTrue(np.array_equal(y_rows.argmax(axis=1), X_rows[:, :3].argmax(axis=1)))
+
+            batches.on_epoch_end()
+
+
+    @skipUnless(HAS_KERAS, 'needs Keras')
+    def test_early_stopping(self):
+        from keras.models import Sequential
+        from keras.layers import Dense
+        from custom_keras_wrapper import EarlyStopping
+
+        model = Sequential([Dense(2, input_shape=(3,))])
+        early_stopping = EarlyStopping(patience=2)
+        early_stopping.set_model(model)
+        early_stopping.on_train_begin()
+
+        for epoch, loss in enumerate([3., 1., 2., 1.5]):
+            model.set_weights([np.full_like(w, epoch) for w in model.get_weights()])
+            early_stopping.on_epoch_end(epoch, dict(val_loss=loss))
+
+        early_stopping.on_train_end()
+
+        # Stopped 2 epochs after the best one, with its weights back
+        self.assertEqual(early_stopping.stopped_epoch, 3)
+        self.assertTrue(model.stop_training)
+        self.assertTrue(all((w == 1).all() for w in model.get_weights()))
+
+
+    @skipUnless(HAS_KERAS, 'needs Keras')
+    def test_keras_classifier_sparse(self):
+        from custom_keras_wrapper import KerasClassifier, SparseSequence
+
+        X, y = blobs()
+        classifier = KerasClassifier(epochs=30, optimizer='adam', patience=3).fit(X[:200], y[:200])
+
+        self.assertEqual(classifier.predict(X[200:]).shape, (100, 3))
+        self.assertGreater(classifier.score(X[200:], y[200:]), 0.9)
+
+        # Dense training data with a Sequence of validation data
+        classifier = KerasClassifier(epochs=5, optimizer='adam', validation_split=0)
+        classifier.fit(X[:200].toarray(), y[:200], validation_data=SparseSequence(X[200:], y[200:]))
+
+        self.assertEqual(classifier.predict(X[200:].toarray()).shape, (100, 3))
+
+
+    @skipUnless(HAS_KERAS, 'needs Keras')
+    def test_keras_classifier_generator_patience(self):
+        from custom_keras_wrapper import KerasClassifier
+
+        X, y = blobs(n=64)
+
+        def batches():
+            while True:
+                for start in range(0, 64, 16):
+                    yield X[start:start + 16].toarray(), y[start:start + 16]
+
+        with self.assertWarnsRegex(UserWarning, 'patience'):
+            KerasClassifier(epochs=1, patience=2).fit(batches(), steps_per_epoch=4)
+
+
+    @skipUnless(HAS_KERAS, 'needs Keras')
+    def test_keras_classifier_pickle(self):
+        from custom_keras_wrapper import KerasClassifier
+
+        X, y = blobs()
+        classifier = KerasClassifier(epochs=5, optimizer='adam').fit(X, y)
+        unpickled = pickle.loads(pickle.dumps(classifier))
+
+        self.assertTrue(np.array_equal(unpickled.predict(X), classifier.predict(X)))
+
+
+    @skipUnless(HAS_KERAS, 'needs Keras')
+    def test_keras_classifier_isolate(self):
+        from custom_keras_wrapper import KerasClassifier
+
+        X, y = blobs()
+        classifier = KerasClassifier(epochs=5, optimizer='adam', isolate=True).fit(X, y)
+
+        # Fitted and predicting in spawned processes, the same weights as here
+        predictions = classifier.predict(X)
+        self.assertTrue(np.allclose(predictions, classifier.model.predict(X.toarray()), atol=1e-6))
+        self.assertGreater(classifier.score(X, y), 0.9)
+
+
+    @skipUnless(HAS_KERAS, 'needs Keras')
+    def test_keras_classifier_clone_structure(self):
+        from keras.layers import Dense
+        from custom_keras_wrapper import KerasClassifier
+
+        structure = [(Dense, {'units': 7, 'activation': 'tanh'}), (Dense, {'activation': 'softmax'})]
+        X, y = blobs()
+        classifier = clone(KerasClassifier(structure=structure, epochs=1)).fit(X, y)
+
+        self.assertEqual(
+            [(layer.get_config()['units'], layer.get_config()['activation']) for layer in classifier.model.layers],
+            [(7, 'tanh'), (3, 'softmax')]
+        )
+
+        # The dicts of the structure are left as they were
+        self.assertEqual(structure[1][1], {'activation': 'softmax'})
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -5,65 +5,315 @@ Created on Mon Jun 19 17:28:47 2017
 @author: Karolis
 """
 
-import itertools
+import os
+import hashlib
 import numpy as np
+from scipy import sparse
+from scipy.stats import rankdata
 from sklearn import metrics
+from collections import OrderedDict
 import matplotlib.pyplot as plt
 from sklearn.manifold import TSNE
 from sklearn.decomposition import TruncatedSVD
 
 
+def _labels(y):
+    y = np.asarray(y.toarray() if sparse.issparse(y) else y)
+
+    return y.argmax(axis=1) if y.ndim == 2 else y
+
+
+class ConfusionMatrix():
+    '''
+        Confusion matrix accumulated from batches of predictions, so that any
+        number of them can be evaluated without holding them all in memory.
+
+            cm = ConfusionMatrix()
+
+            for X, y in batches:
+                cm.update(y, model.predict(X))
+
+            cm.plot('confusion_matrix.png')
+
+        classes are the labels in the order of the rows and the columns of
+        the matrix, and of the columns of one-hot/probability inputs. Without
+        them the labels must be integers 0, 1, ..., and the matrix grows to
+        fit the largest one seen.
+    '''
+    def __init__(self, classes=None):
+        if classes is None:
+            self.classes = np.arange(0)
+            self.__order = None
+        else:
+            self.classes = np.asarray(classes)
+            self.__order = np.argsort(self.classes)
+
+        self.counts = np.zeros((len(self.classes), len(self.classes)), dtype=np.int64)
+
+    def __index(self, y):
+        y = np.asarray(y.toarray() if sparse.issparse(y) else y)
+
+        if y.ndim == 2:
+            if self.__order is not None and y.shape[1] != len(self.classes):
+                raise ValueError('got {} columns for {} classes'.format(y.shape[1], len(self.classes)))
+
+            # Column j is the class classes[j], its index in the matrix
+            return y.argmax(axis=1)
+
+        if self.__order is None:
+            if len(y) and (y.min() < 0 or not np.array_equal(y, y.astype(np.int64))):
+                raise ValueError('labels must be non-negative integers when no classes are given')
+
+            return y.astype(np.int64)
+
+        positions = np.searchsorted(self.classes[self.__order], y).clip(0, len(self.classes) - 1)
+        index = self.__order[positions]
+
+        if (self.classes[index] != y).any():
+            raise ValueError('unknown labels {}'.format(np.unique(y[self.classes[index] != y])))
+
+        return index
+
+    def __grow(self, n_classes):
+        counts = np.zeros((n_classes, n_classes), dtype=np.int64)
+        counts[:len(self.counts), :len(self.counts)] = self.counts
+
+        self.counts = counts
+        self.classes = np.arange(n_classes)
+
+    def update(self, y_true, y_hat):
+        '''
+            Adds a batch of true labels and predictions, either labels or
+            one-hot/probability rows.
+        '''
+        y_true, y_hat = self.__index(y_true), self.__index(y_hat)
+
+        if len(y_true) != len(y_hat):
+            raise ValueError('got {} labels and {} predictions'.format(len(y_true), len(y_hat)))
+
+        if self.__order is None and len(y_true):
+            n_classes = max(y_true.max(), y_hat.max()) + 1
+
+            if n_classes > len(self.classes):
+                self.__grow(n_classes)
+
+        n_classes = len(self.classes)
+        self.counts += np.bincount(
+            y_true * n_classes + y_hat,
+            minlength=n_classes * n_classes
+        ).reshape(n_classes, n_classes)
+
+        return self
+
+    def normalized(self):
+        '''
+            Rows of the matrix divided by the number of samples of their class.
+        '''
+        totals = self.counts.sum(axis=1, keepdims=True)
+
+        return np.divide(self.counts, totals, out=np.zeros(self.counts.shape), where=totals > 0)
+
+    @property
+    def accuracy(self):
+        total = self.counts.sum()
+
+        return np.trace(self.counts) / total if total else 0.0
+
+    def plot(
+        self,
+        path=None,
+        normalize=True,
+        title='Confusion matrix',
+        cmap=plt.cm.Blues,
+        max_annotated=400
+    ):
+        '''
+            Draws the matrix and saves it to path, or returns the figure when
+            there is no path. The cells are only annotated when there are at
+            most max_annotated of them, the text is unreadable beyond that and
+            drawing it takes far longer than the image itself.
+        '''
+        matrix = self.normalized() if normalize else self.counts
+        n_classes = len(self.classes)
+
+        fig, ax = plt.subplots(figsize=(8, 6), dpi=90)
+        image = ax.imshow(matrix, interpolation='nearest', cmap=cmap)
+        ax.set_title(title)
+        fig.colorbar(image, ax=ax)
+
+        if n_classes <= 50:
+            tick_marks = np.arange(n_classes)
+            ax.set_xticks(tick_marks)
+            ax.set_xticklabels(self.classes, rotation=45)
+            ax.set_yticks(tick_marks)
+            ax.set_yticklabels(self.classes)
+
+        if matrix.size <= max_annotated:
+            thresh = matrix.max() / 2.
+            fmt = '{:.2f}' if normalize else '{:d}'
+
+            for (i, j), value in np.ndenumerate(matrix):
+                ax.text(
+                    j, 
+                    i, 
+                    fmt.format(value),
+                    horizontalalignment="center",
+                    color="white" if value > thresh else "black"
+                )
+
+        ax.set_ylabel('True label')
+        ax.set_xlabel('Predicted label')
+        fig.tight_layout()
+
+        if path is None:
+            return fig
+
+        fig.savefig(path)
+        plt.close(fig)
+
+
 def plot_confusion_matrix(
     y_true, 
     y_hat,
     normalize=True,
     title='Confusion matrix',
-    cmap=plt.cm.Blues
+    cmap=plt.cm.Blues,
+    path=None
 ):
     """
-    This function prints and plots the confusion matrix.
+    This function plots the confusion matrix, see ConfusionMatrix.
     Normalization can be applied by setting `normalize=True`.
+    The plot is saved to `path` if given, otherwise shown.
     """
-    
-    confusion_matrix = metrics.confusion_matrix(y_true, y_hat)
-    classes = np.unique(y_true)
-    
-    fig = plt.figure(figsize=(8, 6), dpi=90)
-    plt.imshow(confusion_matrix, interpolation='nearest', cmap=cmap)
-    plt.title(title)
-    plt.colorbar()
-    tick_marks = np.arange(len(classes))
-    plt.xticks(tick_marks, classes, rotation=45)
-    plt.yticks(tick_marks, classes)
-
-    if normalize:
-        confusion_matrix = np.round((
-            confusion_matrix.astype('float') / confusion_matrix.sum(axis=1)[:, np.newaxis]
-        ), 2)
-
-    thresh = confusion_matrix.max() / 2.
-
-    for i, j in itertools.product(
-        range(confusion_matrix.shape[0]), 
-        range(confusion_matrix.shape[1])
-    ):
-        plt.text(
-            j, 
-            i, 
-            confusion_matrix[i, j],
-            horizontalalignment="center",
-            color="white" if confusion_matrix[i, j] > thresh else "black"
-        )
+    confusion_matrix = ConfusionMatrix(np.unique(np.r_[_labels(y_true), _labels(y_hat)]))
+    confusion_matrix.update(y_true, y_hat)
 
-    plt.tight_layout()
-    plt.ylabel('True label')
-    plt.xlabel('Predicted label')
-    plt.show()
+    fig = confusion_matrix.plot(path, normalize, title, cmap)
+
+    if path is None:
+        plt.show()
+
+    return confusion_matrix
+
+
+def stratified_sample(y, max_samples, random_state=7):
+    '''
+        Sorted indices of at most about max_samples rows, picked at random
+        from every class in proportion to its size and at least one per class.
+    '''
+    if max_samples is None or len(y) <= max_samples:
+        return np.arange(len(y))
+
+    rng = np.random.RandomState(random_state)
+    _, y = np.unique(y, return_inverse=True)
+    rows = []
+
+    for c in range(y.max() + 1):
+        members = np.flatnonzero(y == c)
+        n = max(1, int(round(max_samples * len(members) / len(y))))
+        rows.append(rng.choice(members, n, replace=False))
+
+    return np.sort(np.concatenate(rows))
+
+
+def _fingerprint(X, y, *params):
+    fingerprint = hashlib.sha1(repr(params).encode())
+
+    if sparse.issparse(X):
+        X = sparse.csr_matrix(X)
+        arrays = [X.data, X.indices, X.indptr, np.array(X.shape)]
+    else:
+        arrays = [np.asarray(X)]
+
+    for a in arrays + [np.asarray(y)]:
+        fingerprint.update(str((a.dtype, a.shape)).encode())
+        fingerprint.update(np.ascontiguousarray(a).tobytes())
+
+    return fingerprint.hexdigest()
+
+
+_projections = OrderedDict()
+
+
+def project(
+    X,
+    y_true,
+    max_samples=2000,
+    n_components=50,
+    perplexity=30.0,
+    random_state=7,
+    cache_dir=None
+):
+    '''
+        Projects a stratified sample of at most max_samples rows of X to 2D
+        with a randomized TruncatedSVD to n_components followed by a
+        Barnes-Hut TSNE. Returns the indices of the sampled rows and their
+        2D coordinates.
+
+        Projections are cached by a hash of X, y_true and the parameters, in
+        memory and in cache_dir if given, so plotting other predictions of the
+        same data does not project it again.
+    '''
+    X = X if sparse.issparse(X) else np.asarray(X)
+    y_true = _labels(y_true)
+    key = _fingerprint(X, y_true, max_samples, n_components, perplexity, random_state)
+    path = os.path.join(cache_dir, 'projection_%s.npz' % key) if cache_dir else None
+
+    if key in _projections:
+        _projections.move_to_end(key)
+        return _projections[key]
+
+    if path and os.path.exists(path):
+        with np.load(path) as cached:
+            projection = cached['rows'], cached['embedding']
+    else:
+        rows = stratified_sample(y_true, max_samples, random_state)
+        reduced_X = X[rows]
+
+        if min(reduced_X.shape) > n_components:
+            reduced_X = TruncatedSVD(
+                n_components=n_components,
+                algorithm='randomized',
+                random_state=random_state
+            ).fit_transform(reduced_X)
+        elif sparse.issparse(reduced_X):
+            reduced_X = reduced_X.toarray()
+
+        embedding = TSNE(
+            n_components=2,
+            perplexity=min(perplexity, (len(rows) - 1) / 3.),
+            method='barnes_hut',
+            random_state=random_state
+        ).fit_transform(reduced_X)
+
+        projection = rows, embedding
+
+        if path:
+            np.savez(path, rows=rows, embedding=embedding)
+
+    _projections[key] = projection
+
+    # Only the few latest projections are kept in memory
+    while len(_projections) > 8:
+        _projections.popitem(last=False)
+
+    return projection
             
         
-def visualise_predictions(X, y_true, y_hat):        
-    reduced_X = TruncatedSVD(n_components=50).fit_transform(X)
-    reduced_X = TSNE(n_components=2).fit_transform(reduced_X) 
+def visualise_predictions(X, y_true, y_hat, max_samples=2000, random_state=7, cache_dir=None):
+    '''
+        Plots the predicted and the true classes of a sample of X projected
+        to 2D, see project. The projection of X is reused when it is plotted
+        again with other predictions.
+    '''
+    rows, reduced_X = project(
+        X,
+        y_true,
+        max_samples,
+        random_state=random_state,
+        cache_dir=cache_dir
+    )
+    y_true, y_hat = _labels(y_true)[rows], _labels(y_hat)[rows]
     
     colors = ['green' if y else 'red' for y in y_hat]
     
@@ -79,10 +329,34 @@ def visualise_predictions(X, y_true, y_hat):
     plt.show()
 	
 	
-def report_results(cv_scores, train_scores=None): 
+def report_results(cv_scores, train_scores=None, verbose=True): 
+    '''
+        Summarises cross-validation scores, printing the summary unless
+        verbose is False. Returns a dict of the summary statistics.
+    '''
+    cv_scores = np.asarray(cv_scores)
+
+    results = dict(
+        test_min=cv_scores.min(),
+        test_max=cv_scores.max(),
+        test_mean=cv_scores.mean(),
+        test_std=cv_scores.std(),
+        test_range=(
+            cv_scores.mean() - 2 * cv_scores.std(),
+            cv_scores.mean() + 2 * cv_scores.std()
+        )
+    )
+
+    if train_scores is not None:
+        train_scores = np.asarray(train_scores)
+        results.update(train_mean=train_scores.mean(), train_std=train_scores.std())
+
+    if not verbose:
+        return results
+
     print("Cross-Validation (CV) results:\n")
 
-    if train_scores != None:
+    if train_scores is not None:
         print(
             "Mean training score: %.2f%% +- %.2f%%" % 
             (train_scores.mean() * 100, train_scores.std() * 200)
@@ -98,5 +372,237 @@ def report_results(cv_scores, train_scores=None):
     
     print(
         "\n95/100 times the test score will be in range %.2f-%.2f%%" %
-        (((cv_scores.mean() - 2 * cv_scores.std()) * 100), ((cv_scores.mean() + 2 * cv_scores.std()) * 100))
-    )
\ No newline at end of file
+        (results['test_range'][0] * 100, results['test_range'][1] * 100)
+    )
+
+    return results
+
+
+def _positive_scores(y_score):
+    y_score = np.asarray(y_score, dtype=float)
+
+    # Probabilities of both classes, e.g. from predict_proba or Keras
+    return y_score[:, 1] if y_score.ndim == 2 else y_score
+
+
+def _placements(y, score):
+    '''
+        DeLong placement values. For a positive sample the fraction of the
+        negative ones it outranks, for a negative sample the fraction of the
+        positive ones that outrank it, ties counting half. Their mean over
+        either class is the AUC.
+    '''
+    pos = y == 1
+    n_pos, n_neg = pos.sum(), (~pos).sum()
+    ranks = rankdata(score)
+    placements = np.empty(len(y))
+
+    if n_pos and n_neg:
+        placements[pos] = (ranks[pos] - rankdata(score[pos])) / n_neg
+        placements[~pos] = 1 - (ranks[~pos] - rankdata(score[~pos])) / n_pos
+    else:
+        placements[:] = np.nan
+
+    return placements
+
+
+def _quantile_bins(values, y, n_bins):
+    bins = np.zeros(len(values), dtype=np.int64)
+
+    for c in [0, 1]:
+        in_class = y == c
+
+        if in_class.any() and not np.isnan(values[in_class]).any():
+            edges = np.percentile(values[in_class], np.linspace(0, 100, n_bins + 1)[1:-1])
+            bins[in_class] = np.searchsorted(edges, values[in_class])
+
+    return bins
+
+
+class _Cells():
+    '''
+        Groups the samples into the cells of the given integer columns, e.g.
+        the true class, a model's prediction and the bin of its placement
+        value, and keeps the count and the mean of the per-sample values of
+        every cell. A bootstrap resample of the samples is then a multinomial
+        draw of cell counts, so thousands of resamples are a single call.
+    '''
+    def __init__(self, columns, values):
+        keys = np.ravel_multi_index(columns, [column.max() + 1 for column in columns])
+        _, first, inverse, self.counts = np.unique(
+            keys,
+            return_index=True,
+            return_inverse=True,
+            return_counts=True
+        )
+
+        self.columns = [column[first] for column in columns]
+        self.means = [
+            np.bincount(inverse.ravel(), weights=value) / self.counts for value in values
+        ]
+
+    def resample(self, n_resamples, rng, chunksize=2000):
+        n = self.counts.sum()
+
+        for start in range(0, n_resamples, chunksize):
+            yield rng.multinomial(n, self.counts / n, size=min(chunksize, n_resamples - start))
+
+
+def _scores(counts, y, y_hat, placements, auc):
+    '''
+        Accuracy, F1 and AUC of every row of resampled cell counts, where auc
+        is the AUC of the original sample.
+    '''
+    n = counts.sum(axis=1)
+    tp = counts @ ((y == 1) & (y_hat == 1))
+    fp = counts @ ((y == 0) & (y_hat == 1))
+    fn = counts @ ((y == 1) & (y_hat == 0))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n_pos, n_neg = counts @ (y == 1), counts @ (y == 0)
+
+        # First order (DeLong) approximation of the AUC of the resample
+        resampled_auc = (
+            counts @ np.where(y == 1, placements, 0) / n_pos +
+            counts @ np.where(y == 0, placements, 0) / n_neg -
+            auc
+        )
+
+        return dict(
+            accuracy=(counts @ (y == y_hat)) / n,
+            f1=2 * tp / (2 * tp + fp + fn),
+            auc=resampled_auc
+        )
+
+
+def _interval(estimate, resampled, confidence):
+    resampled = resampled[np.isfinite(resampled)]
+    alpha = (1 - confidence) / 2
+
+    if not len(resampled):
+        return dict(estimate=estimate, low=np.nan, high=np.nan, std=np.nan)
+
+    low, high = np.percentile(resampled, [100 * alpha, 100 * (1 - alpha)])
+
+    return dict(estimate=estimate, low=low, high=high, std=resampled.std())
+
+
+def _point_scores(y_true, y_hat, score):
+    return dict(
+        accuracy=metrics.accuracy_score(y_true, y_hat),
+        f1=metrics.f1_score(y_true, y_hat),
+        auc=metrics.roc_auc_score(y_true, score) if len(np.unique(y_true)) == 2 else np.nan
+    )
+
+
+def bootstrap_scores(
+    y_true,
+    y_score,
+    threshold=0.5,
+    n_resamples=10000,
+    confidence=0.95,
+    n_bins=32,
+    random_state=7
+):
+    '''
+        Bootstrap confidence intervals of the accuracy, F1 and AUC of a binary
+        classifier. y_score are the predicted probabilities of the positive
+        class, or hard 0/1 predictions, and samples with a score of at least
+        threshold are predicted positive.
+
+        All the resamples are drawn at once as multinomial counts of a few
+        cells of samples, see _Cells. The AUC of a resample is approximated to
+        first order with the DeLong placement values, averaged within n_bins
+        quantile bins per class.
+
+        Returns {metric: {'estimate', 'low', 'high', 'std'}}.
+    '''
+    y_true = _labels(y_true).astype(np.int64)
+    score = _positive_scores(y_score)
+    y_hat = (score >= threshold).astype(np.int64)
+    placements = _placements(y_true, score)
+
+    cells = _Cells(
+        [y_true, y_hat, _quantile_bins(placements, y_true, n_bins)],
+        [placements]
+    )
+    y, cell_y_hat, _ = cells.columns
+    estimates = _point_scores(y_true, y_hat, score)
+    rng = np.random.RandomState(random_state)
+
+    resampled = {}
+
+    for counts in cells.resample(n_resamples, rng):
+        scores = _scores(counts, y, cell_y_hat, cells.means[0], estimates['auc'])
+
+        for metric, values in scores.items():
+            resampled.setdefault(metric, []).append(values)
+
+    return {
+        metric: _interval(estimates[metric], np.concatenate(values), confidence)
+        for metric, values in resampled.items()
+    }
+
+
+def compare_models(
+    y_true,
+    y_score_a,
+    y_score_b,
+    threshold=0.5,
+    n_resamples=10000,
+    confidence=0.95,
+    n_bins=16,
+    random_state=7
+):
+    '''
+        Paired bootstrap comparison of two binary classifiers on the same
+        samples, see bootstrap_scores. Both models are scored on the very
+        same resamples, so the spread of the differences excludes the
+        variation of the samples that both models share.
+
+        Returns {metric: {'a', 'b', 'difference', 'low', 'high', 'std',
+        'p_value'}}, with the confidence interval and the two-sided p-value
+        of the difference of model a and model b.
+    '''
+    y_true = _labels(y_true).astype(np.int64)
+    scores = [_positive_scores(y_score_a), _positive_scores(y_score_b)]
+    y_hats = [(score >= threshold).astype(np.int64) for score in scores]
+    placements = [_placements(y_true, score) for score in scores]
+
+    # Only the difference of the placements is binned, the AUC difference is
+    # linear in it
+    cells = _Cells(
+        [y_true] + y_hats + [_quantile_bins(placements[0] - placements[1], y_true, n_bins)],
+        placements
+    )
+    y, y_hat_a, y_hat_b, _ = cells.columns
+    estimates = [_point_scores(y_true, y_hat, score) for y_hat, score in zip(y_hats, scores)]
+    rng = np.random.RandomState(random_state)
+
+    differences = {}
+
+    for counts in cells.resample(n_resamples, rng):
+        a = _scores(counts, y, y_hat_a, cells.means[0], estimates[0]['auc'])
+        b = _scores(counts, y, y_hat_b, cells.means[1], estimates[1]['auc'])
+
+        for metric in a:
+            differences.setdefault(metric, []).append(a[metric] - b[metric])
+
+    results = {}
+
+    for metric, values in differences.items():
+        values = np.concatenate(values)
+        values = values[np.isfinite(values)]
+
+        result = _interval(estimates[0][metric] - estimates[1][metric], values, confidence)
+        result = dict(
+            a=estimates[0][metric],
+            b=estimates[1][metric],
+            difference=result.pop('estimate'),
+            p_value=min(1.0, 2 * min((values <= 0).mean(), (values >= 0).mean())) if len(values) else np.nan,
+            **result
+        )
+
+        results[metric] = result
+
+    return results
@@ -0,0 +1,187 @@
+'''
+    Startup cost of the command line entry points of the projects.
+
+    Every entry point is run in a fresh interpreter, from its project
+    directory, the way it is run by hand, e.g. python detect.py --help. The
+    best wall time of the runs, the peak resident memory of the process and
+    the heavy modules it imported are reported. Printing the help or
+    reporting a bad argument needs none of them, so an entry point that
+    imports one, or exceeds -t or -r, fails the benchmark:
+
+        python startup_benchmark.py -t 1.0 -r 150
+'''
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# (project directory, script or module, arguments)
+ENTRY_POINTS = [
+    ('SmilesDetection', 'detect.py', ['--help']),
+    ('SmilesDetection', 'detect.py', []),
+    ('FacialLandmarksDetection', 'detect.py', ['--help']),
+    ('BreakingSimpleCaptchas', 'break_captcha.py', ['--help']),
+    ('BreakingSimpleCaptchas', 'break_captcha.py', ['-m', 'model.npz']),
+    ('TextSentimentClassification', 'benchmark.py', ['--help']),
+    ('TextSentimentClassification', 'preprocessing', [])
+]
+
+HEAVY_MODULES = [
+    'tensorflow',
+    'keras',
+    'h5py',
+    'cv2',
+    'imageio',
+    'imutils',
+    'nltk',
+    'pandas',
+    'sklearn',
+    'matplotlib'
+]
+
+# Runs the entry point and, however it exits, reports the heavy modules it
+# imported on a line of stderr of its own
+RUNNER = '''
+import os, sys, atexit, runpy, importlib
+
+HEAVY_MODULES = {heavy!r}
+
+def report():
+    sys.stderr.write('\\n{marker}' + ' '.join(m for m in HEAVY_MODULES if m in sys.modules) + '\\n')
+
+atexit.register(report)
+target, sys.argv = sys.argv[1], sys.argv[1:]
+sys.path[0] = os.getcwd()
+
+if target.endswith('.py'):
+    runpy.run_path(target, run_name='__main__')
+else:
+    importlib.import_module(target)
+'''
+
+MARKER = 'heavy modules:'
+
+
+def _describe(target, args):
+    if target.endswith('.py'):
+        return ' '.join([target] + args) if args else target
+
+    return 'import ' + target
+
+
+def measure(directory, target, args=(), heavy_modules=HEAVY_MODULES):
+    '''
+        (wall time in seconds, peak RSS in MB, heavy modules imported, exit
+        code) of one run of the entry point. The peak RSS is None where the
+        platform has no os.wait4, i.e. on Windows.
+    '''
+    command = [sys.executable, '-c', RUNNER.format(heavy=list(heavy_modules), marker=MARKER), target] + list(args)
+
+    started = time.time()
+    process = subprocess.Popen(
+        command,
+        cwd=os.path.join(ROOT, directory),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+
+    if hasattr(os, 'wait4'):
+        # The rusage of this very child, rather than of all the children
+        stderr = process.stderr.read()
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.time() - started
+        process.stderr.close()
+
+        # Reaped already, Popen must not wait for it again
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+        # Kilobytes on Linux, bytes on macOS
+        peak_rss = rusage.ru_maxrss / (1024. ** 2 if sys.platform == 'darwin' else 1024.)
+    else:
+        _, stderr = process.communicate()
+        elapsed = time.time() - started
+        peak_rss = None
+
+    heavy = [
+        line[len(MARKER):].split()
+        for line in stderr.decode('utf8', 'replace').splitlines() if line.startswith(MARKER)
+    ]
+
+    return elapsed, peak_rss, heavy[-1] if heavy else [], process.returncode
+
+
+def benchmark(entry_points=ENTRY_POINTS, repeats=3, max_time=None, max_rss=None):
+    '''
+        Prints the startup cost of every entry point, the best time of
+        repeats runs, and returns the descriptions of the ones that crash,
+        import a heavy module or exceed max_time seconds or max_rss MB.
+        Printing the help exits with 0 and argparse errors with 2.
+    '''
+    failures = []
+
+    # The interpreter itself, for reference
+    baseline = min(measure('.', 'sys')[0] for _ in range(repeats))
+
+    print('{:<30}{:<38}{:>8}{:>10}  {}'.format('project', 'entry point', 'time s', 'RSS MB', 'heavy modules'))
+    print('{:<30}{:<38}{:>8.3f}{:>10}'.format('', 'python', baseline, ''))
+
+    for directory, target, args in entry_points:
+        runs = [measure(directory, target, args) for _ in range(repeats)]
+        elapsed = min(run[0] for run in runs)
+        peak_rss = None if runs[0][1] is None else max(run[1] for run in runs)
+        heavy = runs[-1][2]
+        crashed = any(run[3] not in (0, 2) for run in runs)
+        description = _describe(target, args)
+
+        print('{:<30}{:<38}{:>8.3f}{:>10}  {}'.format(
+            directory,
+            description,
+            elapsed,
+            '-' if peak_rss is None else '{:.0f}'.format(peak_rss),
+            ', '.join(heavy) or '-'
+        ) + ('  (crashed)' if crashed else ''))
+
+        if crashed or heavy or \
+           (max_time is not None and elapsed > max_time) or \
+           (max_rss is not None and peak_rss is not None and peak_rss > max_rss):
+            failures.append('{}: {}'.format(directory, description))
+
+    return failures
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+
+    ap.add_argument(
+        '-n',
+        '--repeats',
+        type=int,
+        default=3,
+        help='number of runs of every entry point, the best time is reported'
+    )
+
+    ap.add_argument(
+        '-t',
+        '--max_time',
+        type=float,
+        help='startup time in seconds no entry point may exceed (optional)'
+    )
+
+    ap.add_argument(
+        '-r',
+        '--max_rss',
+        type=float,
+        help='peak RSS in MB no entry point may exceed (optional)'
+    )
+
+    args = ap.parse_args()
+
+    failures = benchmark(repeats=args.repeats, max_time=args.max_time, max_rss=args.max_rss)
+
+    if failures:
+        print('\nCrashed, too slow to start or importing heavy modules:\n  ' + '\n  '.join(failures))
+        sys.exit(1)